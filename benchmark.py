@@ -0,0 +1,197 @@
+"""Offline benchmark of the synchronization, with a fake Tape client and a local PostgreSQL.
+
+Example:
+
+    POSTGRES_HOST=localhost POSTGRES_PORT=5432 POSTGRES_USERNAME=postgres \\
+    POSTGRES_PASSWORD=postgres POSTGRES_DATABASE=bench \\
+    python benchmark.py --apps 4 --records 5000 --workers 4 --output bench_results.json
+
+Three runs are measured: a full load into empty tables, an incremental
+sync after touching part of the records and a sync with no changes.
+"""
+import argparse
+import cProfile
+import datetime
+import json
+import os
+import resource
+import subprocess
+import threading
+import time
+import tracemalloc
+
+# The modules of the service read their settings on import
+os.environ.setdefault('TIMEZONE_OFFSET', '-3')
+os.environ.setdefault('TAPE_RATE_LIMIT_PER_HOUR', str(10 ** 9))
+os.environ.setdefault('TAPE_RATE_LIMIT_BURST', str(10 ** 9))
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--apps', type=int, default=2, help='number of synthetic apps')
+    parser.add_argument('--records', type=int, default=2000, help='records per app')
+    parser.add_argument('--field-types', default=None,
+                        help='comma separated Tape field types of each app (default: one of each common type)')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds of latency of each Tape request')
+    parser.add_argument('--rate-limit', type=int, default=None, help='Tape requests allowed per hour')
+    parser.add_argument('--workers', type=int, default=1, help='SYNC_WORKERS')
+    parser.add_argument('--prefetch', type=int, default=2, help='PREFETCH_DEPTH')
+    parser.add_argument('--touch', type=float, default=0.05, help='fraction of records modified before the incremental run')
+    parser.add_argument('--profile', default=None, help='write a cProfile dump of all runs to this file')
+    parser.add_argument('--output', default='bench_results.json', help='JSON file with the results')
+    return parser.parse_args()
+
+
+ARGS = _parse_args()
+os.environ['SYNC_WORKERS'] = str(ARGS.workers)
+os.environ['PREFETCH_DEPTH'] = str(ARGS.prefetch)
+if ARGS.rate_limit:
+    os.environ['TAPE_RATE_LIMIT_PER_HOUR'] = str(ARGS.rate_limit)
+    os.environ['TAPE_RATE_LIMIT_BURST'] = '50'
+
+# pylint: disable=wrong-import-position
+import get_mydb
+import tape_insert_records
+from fake_tape import DEFAULT_FIELD_TYPES, FakeApp, FakeTapeClient
+from metrics import DB_STATEMENTS
+from tape_client import set_client_factory
+from tape_converters import RecordConverter
+from tape_create_tables import create_tables
+from tape_insert_records import insert_records
+from tape_metadata_cache import metadata_cache
+from logging_tools import logger
+
+
+class Stats:
+    """Seconds spent in each stage of a run, by the instrumented functions."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def add_stage(self, stage: str, seconds: float):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+
+STATS = Stats()
+
+
+def _db_statements() -> float:
+    return sum(DB_STATEMENTS.values().values())
+
+
+def _timed(stage: str, function):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            STATS.add_stage(stage, time.perf_counter() - start)
+    return wrapper
+
+
+def _instrument():
+    """Time each stage of the write path."""
+    tape_insert_records._detect_changes = _timed('detect_changes', tape_insert_records._detect_changes)
+    RecordConverter.convert_page = _timed('convert', RecordConverter.convert_page)
+    tape_insert_records._execute_upsert_query = _timed('write', tape_insert_records._execute_upsert_query)
+    tape_insert_records._execute_update_query = _timed('write', tape_insert_records._execute_update_query)
+    tape_insert_records._execute_touch_query = _timed('write', tape_insert_records._execute_touch_query)
+
+
+def _reset_database(apps: list):
+    """Drop the tables and the state left by previous benchmarks."""
+    with get_mydb.borrow_db() as mydb:
+        cursor = mydb.cursor()
+        cursor.execute("CREATE SCHEMA IF NOT EXISTS tape")
+        cursor.execute("CREATE SCHEMA IF NOT EXISTS tape_sync")
+        for app in apps:
+            cursor.execute(f"DROP TABLE IF EXISTS tape.bench_ws_{app.workspace_id}__bench_app_{app.app_id}")
+        cursor.execute("SELECT to_regclass('tape_sync.app_state') IS NOT NULL")
+        if cursor.fetchone()[0]:
+            cursor.execute("DELETE FROM tape_sync.app_state WHERE app_id = ANY(%s)", ([app.app_id for app in apps],))
+        mydb.commit()
+    metadata_cache.invalidate()
+
+
+def _measure(name: str, tape: FakeTapeClient, apps_ids: list, num_records: int) -> dict:
+    """Run one synchronization cycle and collect its measurements."""
+    global STATS
+    STATS = Stats()
+    requests, fetch_seconds, statements = tape.requests, tape.fetch_seconds, _db_statements()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    creation = create_tables(tape, apps_ids)
+    insertion = insert_records(tape, apps_ids)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stages = dict(STATS.stages, fetch=tape.fetch_seconds - fetch_seconds)
+    result = {
+        'name': name,
+        'codes': {'create_tables': creation, 'insert_records': insertion},
+        'elapsed_seconds': round(elapsed, 3),
+        'records': num_records,
+        'records_per_second': round(num_records / elapsed, 1) if elapsed else None,
+        'stage_seconds': {stage: round(seconds, 3) for stage, seconds in sorted(stages.items())},
+        'db_round_trips': int(_db_statements() - statements),
+        'tape_requests': tape.requests - requests,
+        'peak_python_memory_mb': round(peak / 2 ** 20, 1),
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    logger.info(f"Benchmark `{name}`: {json.dumps(result)}")
+    return result
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    field_types = ARGS.field_types.split(',') if ARGS.field_types else DEFAULT_FIELD_TYPES
+    apps = [FakeApp(900000 + index, 900, ARGS.records, field_types, seed=index) for index in range(ARGS.apps)]
+    apps_ids = [app.app_id for app in apps]
+    tape = FakeTapeClient(apps, latency=ARGS.latency, rate_limit=ARGS.rate_limit)
+    # The sync workers share the fake client instead of authenticating against Tape
+    set_client_factory(lambda: tape)
+
+    _instrument()
+    _reset_database(apps)
+
+    profiler = cProfile.Profile() if ARGS.profile else None
+    if profiler:
+        profiler.enable()
+
+    runs = [_measure('full', tape, apps_ids, ARGS.apps * ARGS.records)]
+
+    touched = int(ARGS.records * ARGS.touch)
+    for app in apps:
+        app.touch(touched, datetime.datetime.now().replace(microsecond=0))
+    runs.append(_measure('incremental', tape, apps_ids, ARGS.apps * touched))
+
+    runs.append(_measure('unchanged', tape, apps_ids, 0))
+
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(ARGS.profile)
+
+    results = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': _git_commit(),
+        'config': vars(ARGS),
+        'runs': runs,
+    }
+    with open(ARGS.output, 'w', encoding='utf-8') as output:
+        json.dump(results, output, indent=2)
+    logger.info(f"Resultados gravados em `{ARGS.output}`")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Auxiliary tools for bulk loading with PostgreSQL `COPY`"""
+import io
+
+from psycopg2._psycopg import cursor
+
+
+_COPY_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '\t': '\\t',
+    '\n': '\\n',
+    '\r': '\\r',
+})
+
+
+def _array_literal(values: list) -> str:
+    """Write a list as a PostgreSQL array literal, e.g. `{"a","b"}`."""
+    elements = ('NULL' if value is None else '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+                for value in values)
+    return '{' + ','.join(elements) + '}'
+
+
+def copy_encode(value) -> str:
+    """Encode a value for the `COPY ... FROM STDIN` text format.
+
+    Args:
+        value: Value to be encoded. `None` becomes SQL `NULL` and lists become arrays.
+
+    Returns:
+        str: The escaped value
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, (list, tuple)):
+        value = _array_literal(value)
+    return str(value).translate(_COPY_ESCAPES)
+
+
+def copy_buffer(rows: list) -> io.StringIO:
+    """Write rows in the `COPY ... FROM STDIN` text format, ready to be read."""
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(map(copy_encode, row)))
+        buffer.write('\n')
+    buffer.seek(0)
+    return buffer
+
+
+def copy_rows(cursor: cursor, table: str, columns: list, rows: list):
+    """Stream rows into `table` with a single `COPY FROM STDIN`.
+
+    Args:
+        cursor (cursor): database cursor
+        table (str): Qualified table name, e.g. `tape.workspace__app`
+        columns (list): Column names, in the same order as the row values
+        rows (list): Rows to be copied
+
+    Raises:
+        dbError: DB exception
+    """
+    buffer = copy_buffer(rows)
+    column_list = ', '.join(f'"{column}"' for column in columns)
+    cursor.copy_expert(f"COPY {table} ({column_list}) FROM STDIN", buffer)
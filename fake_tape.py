@@ -0,0 +1,153 @@
+"""Synthetic stand-in for the `pytape` client, for benchmarks without the Tape API."""
+import datetime
+import random
+import threading
+import time
+
+from pytape.transport import TransportException
+
+
+# Field types generated when none are given
+DEFAULT_FIELD_TYPES = ['single_text', 'number', 'money', 'date', 'category', 'contact', 'app', 'calculation', 'file']
+
+_EPOCH = datetime.datetime(2022, 1, 1)
+
+
+def field_values(field_type: str, rng: random.Random) -> list:
+    """Generate the `values` of a field of the given type, shaped as the Tape API returns them."""
+    word = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(4, 12)))
+    if field_type == 'contact':
+        return [{'value': {'name': f'{word} {index}'}} for index in range(rng.randint(0, 3))]
+    if field_type == 'category':
+        return [{'value': {'text': f'{word}-{index}'}} for index in range(rng.randint(0, 3))]
+    if field_type == 'app':
+        return [{'value': {'title': f'{word} #{index}', 'record_id': rng.randint(1, 10 ** 6)}} for index in range(rng.randint(0, 3))]
+    if field_type == 'date':
+        return [{'start': (_EPOCH + datetime.timedelta(days=rng.randint(0, 1000))).strftime('%Y-%m-%d %H:%M:%S')}]
+    if field_type in ('number', 'progress', 'rating'):
+        return [{'value': str(rng.randint(0, 10 ** 6) / 100)}]
+    if field_type == 'money':
+        return [{'value': str(rng.randint(0, 10 ** 8) / 100), 'currency': 'BRL'}]
+    if field_type == 'calculation':
+        return [{'value_string': word}]
+    if field_type == 'file':
+        return [{'value': {'link': f'https://files.example.com/{word}.pdf'}}]
+    if field_type == 'embed':
+        return [{'embed': {'url': f'https://example.com/{word}'}}]
+    return [{'value': ' '.join([word] * rng.randint(1, 20))}]
+
+
+class FakeApp:
+    """A synthetic app with `num_records` records over the given field types."""
+
+    def __init__(self, app_id: int, workspace_id: int, num_records: int, field_types: list, seed: int = 0):
+        self.app_id = app_id
+        self.workspace_id = workspace_id
+        self.seed = seed
+        self.fields = [{'field_id': app_id * 1000 + index, 'external_id': f'{field_type}_{index}', 'type': field_type}
+                       for index, field_type in enumerate(field_types)]
+        # (last_modified_on, record_id, version), newest first
+        self._records = [(_EPOCH + datetime.timedelta(minutes=num_records - index), app_id * 10 ** 7 + index, 0)
+                         for index in range(num_records)]
+
+    @property
+    def info(self) -> dict:
+        return {'app_id': self.app_id, 'workspace_id': self.workspace_id, 'slug': f'bench-app-{self.app_id}',
+                'fields': self.fields}
+
+    def touch(self, count: int, now: datetime.datetime):
+        """Modify `count` random records, moving them to the top of the newest-first order."""
+        rng = random.Random(self.seed + count)
+        touched = set(rng.sample(range(len(self._records)), min(count, len(self._records))))
+        records = [(now, record_id, version + 1) if index in touched else (last_modified, record_id, version)
+                   for index, (last_modified, record_id, version) in enumerate(self._records)]
+        self._records = sorted(records, reverse=True)
+
+    def delete(self, count: int):
+        """Delete the `count` oldest records."""
+        self._records = self._records[:max(len(self._records) - count, 0)]
+
+    def record(self, index: int) -> dict:
+        """Build the record at `index`, always the same for the same record version."""
+        last_modified, record_id, version = self._records[index]
+        rng = random.Random(record_id * 31 + version)
+        return {
+            'record_id': record_id,
+            'created_on': (_EPOCH + datetime.timedelta(seconds=record_id % 10 ** 7)).strftime('%Y-%m-%d %H:%M:%S'),
+            'last_modified_on': last_modified.strftime('%Y-%m-%d %H:%M:%S'),
+            'fields': [{'external_id': field['external_id'], 'type': field['type'], 'values': field_values(field['type'], rng)}
+                       for field in self.fields],
+        }
+
+
+class FakeTapeClient:
+    """Drop-in for `pytape.client.Client` serving `FakeApp`s.
+
+    Each request sleeps for `latency` seconds. When `rate_limit` is given,
+    requests beyond it within the current hour raise a `TransportException`
+    with the same `x-rate-limit-*` headers as the Tape API.
+    """
+
+    def __init__(self, apps: list, latency: float = 0.0, rate_limit: int = None):
+        self.apps = {app.app_id: app for app in apps}
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.requests = 0
+        self.fetch_seconds = 0.0
+        self._window_start = time.time()
+        self._window_requests = 0
+        self._lock = threading.Lock()
+        self.App = _AppArea(self)
+        self.Workspace = _WorkspaceArea(self)
+
+    def _request(self):
+        with self._lock:
+            self.requests += 1
+            if self.rate_limit is not None:
+                if time.time() - self._window_start >= 3600:
+                    self._window_start, self._window_requests = time.time(), 0
+                self._window_requests += 1
+                remaining = self.rate_limit - self._window_requests
+                if remaining < 0:
+                    reset = int(self._window_start + 3600 - time.time())
+                    raise TransportException({'status': '429', 'x-rate-limit-remaining': '0',
+                                              'x-rate-limit-reset': str(reset)}, '{}')
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class _AppArea:
+
+    def __init__(self, client: FakeTapeClient):
+        self.client = client
+
+    def find(self, app_id: int) -> dict:
+        self.client._request()
+        return self.client.apps[app_id].info
+
+    def get_records(self, app_id: int, limit: int = 100, cursor: str = None, **kwargs) -> dict:
+        start = time.perf_counter()
+        self.client._request()
+        app = self.client.apps[app_id]
+        offset = int(cursor or 0)
+        end = min(offset + limit, len(app._records))
+        response = {
+            'total': len(app._records),
+            'records': [app.record(index) for index in range(offset, end)],
+            'cursor': str(end) if end < len(app._records) else None,
+        }
+        with self.client._lock:
+            self.client.fetch_seconds += time.perf_counter() - start
+        return response
+
+
+class _WorkspaceArea:
+
+    def __init__(self, client: FakeTapeClient):
+        self.client = client
+
+    def get_all_for_org(self) -> dict:
+        self.client._request()
+        workspace_ids = sorted({app.workspace_id for app in self.client.apps.values()})
+        return {'workspaces': [{'workspace_id': workspace_id, 'slug': f'bench-ws-{workspace_id}'}
+                               for workspace_id in workspace_ids]}
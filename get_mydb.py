@@ -1,26 +1,84 @@
+from contextlib import contextmanager
 from os import getenv
+import threading
+import time
 
 import psycopg2
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
-
-from get_time import get_hour
+import psycopg2.extensions
+from psycopg2.pool import ThreadedConnectionPool
 
+from metrics import observe_db_statement
 from logging_tools import logger
 
 
-def get_db():
-    try:
-        mydb = psycopg2.connect(
-                    host=getenv('POSTGRES_HOST'),
-                    user=getenv('POSTGRES_USERNAME'),
-                    password=getenv('POSTGRES_PASSWORD'),
-                    dbname=getenv('POSTGRES_DATABASE'),
-                    port=getenv('POSTGRES_PORT'))
-        mydb.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-    except psycopg2.Error as err:
-        # Não alcance, inatividade do banco ou credenciais inválidas
-        #message = f"Erro inesperado no acesso inicial ao BD. Terminando o programa. {err}"
-        #logger.error(message)
-        pass
-    else:
-        return mydb
+# Maximum number of simultaneous connections, one per sync worker plus one spare
+DB_POOL_SIZE = int(getenv('DB_POOL_SIZE', str(int(getenv('SYNC_WORKERS', '1')) + 1)))
+# Maximum delay in seconds between attempts to reach the database
+DB_MAX_BACKOFF = 60
+
+DB_PARAMS = {
+    'host': getenv('POSTGRES_HOST'),
+    'user': getenv('POSTGRES_USERNAME'),
+    'password': getenv('POSTGRES_PASSWORD'),
+    'dbname': getenv('POSTGRES_DATABASE'),
+    'port': getenv('POSTGRES_PORT'),
+}
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """Cursor accounting the count and latency of its statements in `metrics`."""
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            observe_db_statement(query, time.perf_counter() - start)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            observe_db_statement(sql, time.perf_counter() - start)
+
+
+_pool = ThreadedConnectionPool(0, DB_POOL_SIZE, cursor_factory=InstrumentedCursor, **DB_PARAMS)
+# `ThreadedConnectionPool` raises when exhausted, so borrowers wait on this semaphore instead
+_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+
+
+def _get_connection():
+    """Take a connection from the pool, waiting with exponential backoff while the DB is unreachable."""
+    delay = 1
+    while True:
+        try:
+            return _pool.getconn()
+        except psycopg2.Error as err:
+            # Não alcance, inatividade do banco ou credenciais inválidas
+            message = f"BD inacessível. Nova tentativa em {delay}s. {err}"
+            logger.warning(message)
+            time.sleep(delay)
+            delay = min(delay * 2, DB_MAX_BACKOFF)
+
+
+@contextmanager
+def borrow_db():
+    """Borrow a connection from the bounded pool, returning it when done.
+
+    Any transaction left open is rolled back before the connection goes back to the pool.
+
+    Yields:
+        connection: database connection
+    """
+    with _slots:
+        mydb = _get_connection()
+        try:
+            yield mydb
+        finally:
+            if not mydb.closed:
+                try:
+                    mydb.rollback()
+                except psycopg2.Error:
+                    pass
+            _pool.putconn(mydb, close=bool(mydb.closed))
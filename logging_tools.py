@@ -1,6 +1,17 @@
 """Auxiliary tools for logging"""
+import atexit
 import logging
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
+from os import getenv
+import queue
+import random
+
+
+# Minimum level of the messages written (default DEBUG)
+LOG_LEVEL = getenv('LOG_LEVEL', 'DEBUG').upper()
+# Fraction of the written records logged one by one, at DEBUG level (default 0, 1 logs all of them)
+LOG_RECORD_SAMPLE = float(getenv('LOG_RECORD_SAMPLE', '0'))
 
 
 class CustomFormatter(logging.Formatter):
@@ -24,11 +35,12 @@ class CustomFormatter(logging.Formatter):
             logging.ERROR: self.red + self.fmt + self.reset,
             logging.CRITICAL: self.bold_red + self.fmt + self.reset
         }
+        # One formatter per level, built once
+        self.formatters = {level: logging.Formatter(log_fmt) for level, log_fmt in self.FORMATS.items()}
+        self.default_formatter = logging.Formatter(self.fmt)
 
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
-        return formatter.format(record)
+        return self.formatters.get(record.levelno, self.default_formatter).format(record)
 
     def converter(self, timestamp):
         # logging.Formatter uses time.localtime here and returns a time.struct_time
@@ -44,12 +56,20 @@ class CustomFormatter(logging.Formatter):
         return converted.strftime(datefmt)
 
 
-logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
+class _InProcessQueueHandler(QueueHandler):
+    """Queue handler leaving the formatting to the writer thread.
+
+    Records never leave the process, so they are queued as they are instead
+    of being formatted and stripped for pickling on the thread that logs.
+    """
+
+    def prepare(self, record):
+        return record
+
 
 # Create custom logger logging all five levels
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
+logger.setLevel(LOG_LEVEL)
 
 # Define format for logs
 fmt = '%(asctime)s -> %(message)s'
@@ -59,5 +79,24 @@ stdout_handler = logging.StreamHandler()
 stdout_handler.setLevel(logging.DEBUG)
 stdout_handler.setFormatter(CustomFormatter(fmt))
 
+# Messages are queued and written to the console by a background thread
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, stdout_handler, respect_handler_level=True)
+log_listener.start()
+# Writes what is still queued when the program ends
+atexit.register(log_listener.stop)
+
 # Add handler to the logger
-logger.addHandler(stdout_handler)
+logger.addHandler(_InProcessQueueHandler(log_queue))
+
+
+def log_records(action: str, table_name: str, record_ids: list):
+    """Log the records of a page one by one, at DEBUG level, for the `LOG_RECORD_SAMPLE` fraction of them.
+
+    Pages are summarized by their callers, so this costs nothing unless enabled.
+    """
+    if not LOG_RECORD_SAMPLE or not logger.isEnabledFor(logging.DEBUG):
+        return
+    for record_id in record_ids:
+        if LOG_RECORD_SAMPLE >= 1 or random.random() < LOG_RECORD_SAMPLE:
+            logger.debug(f"Registro de ID={record_id} {action} na tabela `{table_name}`")
@@ -6,9 +6,17 @@ from pytape import api
 from pytape.transport import TransportException
 
 from get_time import get_hour
+from metrics import CYCLE_SECONDS, STEP_SECONDS, log_cycle_summary, snapshot, start_metrics_server
 from tape_create_tables import create_tables
-from tape_insert_records import insert_records
+import tape_async
+import tape_insert_records
+from tape_leases import claim_apps
+from tape_rate_limit import scheduler
+from tape_reconcile import reconcile_records
+from tape_sync_state import request_full_resync, request_table_refresh
+from tape_webhook import start_webhook_server
 from tape_tools import handling_tape_error
+from tape_workers import cycle_code
 
 from logging_tools import logger
 
@@ -16,15 +24,29 @@ from logging_tools import logger
 if __name__ == '__main__':
     # Database update period in seconds
     timeOffset = int(getenv('TIMEOFFSET'))
+    # Engine of the records synchronization: "threads" or "asyncio"
+    syncEngine = getenv('SYNC_ENGINE', 'threads')
+    insert_records = tape_async.insert_records if syncEngine == 'asyncio' else tape_insert_records.insert_records
 
     # tape credentials
     user_key = getenv('TAPE_USER_KEY')
     # Apps IDs
     apps_ids = list(map(int, getenv('TAPE_APPS_IDS').split(',')))
+    # Apps to be fully resynchronized, ignoring their high-water marks ("all" for every app)
+    full_resync = getenv('TAPE_FULL_RESYNC_APPS', '')
+    # Apps whose tables are rebuilt in shadow tables and swapped in ("all" for every app)
+    table_refresh = getenv('TAPE_REFRESH_APPS', '')
 
     MESSAGE = "==== SAVE DATA FROM TAPE ===="
     logger.debug(MESSAGE)
 
+    start_metrics_server()
+
+    if full_resync:
+        request_full_resync(apps_ids if full_resync == 'all' else list(map(int, full_resync.split(','))))
+    if table_refresh:
+        request_table_refresh(apps_ids if table_refresh == 'all' else list(map(int, table_refresh.split(','))))
+
     # tape authentication
     try:
         tape = api.BearerClient(user_key)
@@ -35,30 +57,60 @@ if __name__ == '__main__':
             logger.error("Terminando o programa...")
         sys.exit()
     else:
+        # Alterações recebidas pelo webhook entre os ciclos, se habilitado
+        try:
+            start_webhook_server(tape, apps_ids)
+        except ValueError as err:
+            logger.error(f"{err}. Terminando o programa...")
+            sys.exit(1)
+
         CYCLE = 1
         while True:
             MESSAGE = f"==== Ciclo {CYCLE} ===="
             logger.info(MESSAGE)
 
-            CREATION = create_tables(tape, apps_ids)
+            CYCLE_START = time.perf_counter()
+            SNAPSHOT = snapshot()
+
+            # Aplicativos desta réplica no ciclo, todos se `SHARDING` não estiver habilitado
+            OWNED_APPS = claim_apps(apps_ids)
 
-            if CREATION == 0:
+            with STEP_SECONDS.time(step='create_tables'):
+                CREATION = create_tables(tape, OWNED_APPS)
 
-                INSERTION = insert_records(tape, apps_ids)
+            # `3`: erro inesperado em alguns aplicativos, que são tentados novamente apenas no ciclo seguinte
+            if CREATION in (0, 3):
+                with STEP_SECONDS.time(step='insert_records'):
+                    INSERTION = insert_records(tape, OWNED_APPS)
 
-                # Caso o limite de requisições seja atingido, espera-se mais 1 hora até a seguinte iteração
+                if INSERTION in (0, 3):
+                    # Remoção dos registros excluídos no Tape, com periodicidade própria
+                    with STEP_SECONDS.time(step='reconcile_records'):
+                        INSERTION = cycle_code([INSERTION, reconcile_records(tape, OWNED_APPS)])
+
+            CYCLE_ELAPSED = time.perf_counter() - CYCLE_START
+            CYCLE_SECONDS.observe(CYCLE_ELAPSED)
+            log_cycle_summary(SNAPSHOT, CYCLE_ELAPSED)
+
+            if CREATION in (0, 3):
+
+                # Caso o limite de requisições seja atingido, espera-se a sua renovação até a seguinte iteração
                 if INSERTION == 1:
-                    hour = get_hour(hours=1)
-                    MESSAGE = f"Esperando a hora seguinte. Até às {hour}"
+                    wait = scheduler.seconds_until_reset()
+                    hour = get_hour(seconds=wait)
+                    MESSAGE = f"Esperando a renovação do limite de requisições. Até às {hour}"
                     logger.info(MESSAGE)
-                    time.sleep(3600)
+                    time.sleep(wait)
                     try:
                         tape = api.BearerClient(user_key)
                     except:
                         MESSAGE = 'Erro na obtenção do novo cliente Tape! Tentando novamente...'
                         logger.warning(MESSAGE)
 
-                elif INSERTION == 0:
+                elif INSERTION in (0, 3):
+                    if 3 in (CREATION, INSERTION):
+                        MESSAGE = "Ciclo concluído com erros em alguns aplicativos. Serão sincronizados no próximo ciclo."
+                        logger.warning(MESSAGE)
                     # Nesse caso foi criado o primeiro snapshot do tape no BD. Próxima iteração no dia seguinte
                     hours = get_hour(seconds=timeOffset)
                     MESSAGE = f"Esperando as próximas {timeOffset/3600}hs. Até às {hours}"
@@ -82,10 +134,11 @@ if __name__ == '__main__':
                     # time.sleep(1)
 
             elif CREATION == 1:
-                hour = get_hour(hours=1)
-                MESSAGE = f"Esperando a hora seguinte às {hour}"
+                wait = scheduler.seconds_until_reset()
+                hour = get_hour(seconds=wait)
+                MESSAGE = f"Esperando a renovação do limite de requisições às {hour}"
                 logger.info(MESSAGE)
-                time.sleep(3600)
+                time.sleep(wait)
                 try:
                     tape = api.BearerClient(user_key)
                 except:
@@ -0,0 +1,239 @@
+"""Counters, gauges and histograms of the synchronization, exposed in the Prometheus text format."""
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import getenv
+import resource
+import threading
+import time
+
+from logging_tools import logger
+
+
+# Port of the metrics endpoint, disabled unless set (`0`)
+METRICS_PORT = int(getenv('METRICS_PORT', '0'))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800, 3600)
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def values(self) -> dict:
+        """Copy of the current values, by label values."""
+        with self._lock:
+            return dict(self._values)
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for key, value in sorted(self.values().items()):
+            lines.append(f'{self.name}{_format_labels(self.label_names, key)} {value}')
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonically increasing count."""
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Value that goes up and down."""
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, e.g. latencies in seconds."""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            counts = [bucket_count + (value <= bound) for bucket_count, bound in zip(counts, self.buckets)]
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds spent in the `with` block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for key, (counts, total, count) in sorted(self.values().items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                labels = _format_labels(self.label_names, key, 'le="%s"' % bound)
+                lines.append(f'{self.name}_bucket{labels} {bucket_count}')
+            labels = _format_labels(self.label_names, key, 'le="+Inf"')
+            lines.append(f'{self.name}_bucket{labels} {count}')
+            labels = _format_labels(self.label_names, key)
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class Registry:
+    """Set of metrics rendered together."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+CYCLE_SECONDS = registry.register(Histogram(
+    'tape_sync_cycle_seconds', 'Duration of a cycle of the main loop.'))
+STEP_SECONDS = registry.register(Histogram(
+    'tape_sync_step_seconds', 'Duration of a step of the cycle.', ('step',)))
+TAPE_REQUESTS = registry.register(Counter(
+    'tape_api_requests_total', 'Requests sent to the Tape API.', ('app_id', 'method')))
+TAPE_ERRORS = registry.register(Counter(
+    'tape_api_errors_total', 'Requests to the Tape API that failed.', ('method', 'status')))
+TAPE_REQUEST_SECONDS = registry.register(Histogram(
+    'tape_api_request_seconds', 'Latency of the requests to the Tape API.', ('method',)))
+RATE_LIMIT_REMAINING = registry.register(Gauge(
+    'tape_api_rate_limit_remaining', 'Requests left in the current rate limit window, as last known.'))
+PAGE_SECONDS = registry.register(Histogram(
+    'tape_sync_page_seconds', 'Latency of fetching a page of records.', ('app_id',)))
+PAGE_SIZE = registry.register(Gauge(
+    'tape_sync_page_size', 'Records requested per page, as adapted to the latency of an app.', ('app_id',)))
+PAGE_RETRIES = registry.register(Counter(
+    'tape_sync_page_retries_total', 'Page requests retried after a gateway error or a timeout.', ('app_id', 'status')))
+RECORDS_FETCHED = registry.register(Counter(
+    'tape_sync_records_fetched_total', 'Records fetched from Tape.', ('app_id',)))
+RECORDS_WRITTEN = registry.register(Counter(
+    'tape_sync_records_written_total', 'Records inserted or updated in the database.', ('app_id',)))
+RECORDS_SKIPPED = registry.register(Counter(
+    'tape_sync_records_skipped_total', 'Records fetched but already up to date in the database.', ('app_id',)))
+RECORDS_DELETED = registry.register(Counter(
+    'tape_sync_records_deleted_total', 'Rows removed because their records were deleted in Tape.', ('app_id',)))
+LAST_SYNC = registry.register(Gauge(
+    'tape_sync_last_success_timestamp_seconds', 'Unix time of the last finished pass of an app.', ('app_id',)))
+PEAK_RSS = registry.register(Gauge(
+    'tape_sync_peak_rss_bytes', 'Peak resident memory of the process seen during the last pass of an app.', ('app_id',)))
+WEBHOOK_EVENTS = registry.register(Counter(
+    'tape_webhook_events_total', 'Webhook events received, by resulting action.', ('action',)))
+DB_STATEMENTS = registry.register(Counter(
+    'db_statements_total', 'Statements sent to the database.', ('statement',)))
+DB_STATEMENT_SECONDS = registry.register(Histogram(
+    'db_statement_seconds', 'Latency of the statements sent to the database.', ('statement',)))
+
+
+def current_rss_bytes() -> int:
+    """Resident memory of the process, or its peak where `/proc` is not available."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        # `ru_maxrss` is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def observe_db_statement(sql, seconds: float):
+    """Account a database statement, labelled by its first keyword."""
+    if isinstance(sql, bytes):
+        sql = sql.decode(errors='replace')
+    statement = str(sql).lstrip().split(None, 1)[0].upper() if str(sql).strip() else 'UNKNOWN'
+    DB_STATEMENTS.inc(statement=statement)
+    DB_STATEMENT_SECONDS.observe(seconds, statement=statement)
+
+
+def snapshot() -> dict:
+    """Values of the per-app counters, to summarize a cycle afterwards."""
+    return {metric.name: metric.values() for metric in (TAPE_REQUESTS, RECORDS_FETCHED, RECORDS_WRITTEN, RECORDS_SKIPPED)}
+
+
+def log_cycle_summary(since: dict, elapsed: float):
+    """Log the records and requests of each app since `since`, a `snapshot()`."""
+    now = snapshot()
+
+    def delta(metric, key):
+        return now[metric.name].get(key, 0) - since.get(metric.name, {}).get(key, 0)
+
+    requests_by_app = {}
+    for key in now[TAPE_REQUESTS.name]:
+        app_id = key[0]
+        requests_by_app[app_id] = requests_by_app.get(app_id, 0) + delta(TAPE_REQUESTS, key)
+
+    apps = {app_id for app_id, in now[RECORDS_FETCHED.name]} | set(requests_by_app)
+    for app_id in sorted(apps - {'None'}):
+        fetched = delta(RECORDS_FETCHED, (app_id,))
+        written = delta(RECORDS_WRITTEN, (app_id,))
+        skipped = delta(RECORDS_SKIPPED, (app_id,))
+        message = f"Aplicativo {app_id}: {fetched:.0f} registros lidos, {written:.0f} gravados, "\
+            f"{skipped:.0f} sem alteração, {requests_by_app.get(app_id, 0):.0f} requisições ao Tape"
+        logger.info(message)
+
+    remaining = RATE_LIMIT_REMAINING.values().get(())
+    message = f"Ciclo concluído em {elapsed:.1f}s. Requisições restantes no limite: "\
+        f"{'desconhecido' if remaining is None else int(remaining)}"
+    logger.info(message)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not logged
+        pass
+
+
+def start_metrics_server(port: int = METRICS_PORT):
+    """Serve the metrics at `http://0.0.0.0:{port}/metrics` from a background thread, if `port` is set."""
+    if not port:
+        return None
+    server = ThreadingHTTPServer(('0.0.0.0', port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.debug(f"Métricas disponíveis na porta {port}")
+    return server
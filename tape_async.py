@@ -0,0 +1,408 @@
+"""Asyncio engine of `insert_records`, selected with `SYNC_ENGINE=asyncio`.
+
+Pages of records are requested with `aiohttp` straight from the Tape REST
+API and written with `asyncpg`, so every app is synchronized concurrently
+on a single thread. Requests go through the same `scheduler` as the
+threaded engine, and a semaphore bounds the pages in flight across apps.
+"""
+import asyncio
+import functools
+import io
+import itertools
+import json
+from os import getenv
+import re
+
+import aiohttp
+import asyncpg
+import ijson
+from pytape.client import Client
+from pytape.transport import TransportException
+
+from psycopg2 import Error as dbError
+
+from copy_tools import copy_buffer
+from get_mydb import DB_PARAMS, DB_POOL_SIZE, borrow_db
+from metrics import PAGE_RETRIES, PAGE_SECONDS, RECORDS_FETCHED
+from tape_children import (CHILD_COLUMNS, CHILD_STAGING, DROP_CHILD_STAGING, NORMALIZED_FIELDS, child_rows,
+                           delete_children_statement, insert_children_statement, multi_valued_columns)
+from tape_client import api_error, api_params, thread_client
+from tape_converters import HASH_COLUMN, LAST_MODIFIED_ON, RECORD_ID, SIMPLE_ATTRIBUTES, RecordConverter
+from tape_insert_records import (detect_changes_statement, handle_schema_change, split_by_content, staging_statement,
+                                 touch_statement, update_statement, upsert_statement)
+from tape_leases import TRY_LOCK_APP, UNLOCK_APP
+from tape_metadata_cache import metadata_cache
+from tape_page_size import PAGE_MAX_RETRIES, atimed, backoff_seconds, is_retryable, page_sizer
+from tape_pages import PREFETCH_DEPTH
+from tape_pass import PassSteps, parse_timestamp, run_pass
+from tape_rate_limit import scheduler
+from tape_refresh import refresh_table
+from tape_schema import is_schema_drift
+from tape_stream import TAPE_STREAMING, PageBuilder, records_url
+from tape_sync_state import (DISCARD_CHECKPOINT, FINISH_BACKFILL, FINISH_PASS, SAVE_PAGE_SIZE, SAVE_PAGE_STATE, SELECT_STATE,
+                             refresh_failed, state_from_row)
+from tape_workers import cycle_code
+
+from logging_tools import log_records, logger
+
+
+# Maximum number of page requests in flight, across all apps
+ASYNC_MAX_INFLIGHT = int(getenv('ASYNC_MAX_INFLIGHT', '8'))
+
+_REQUEST_TIMEOUT = 300
+
+_DONE = object()
+
+
+def _numbered(statement: str) -> str:
+    """Translate the `%s` placeholders of psycopg2 into the `$1, $2, ...` of asyncpg."""
+    counter = itertools.count(1)
+    return re.sub('%s', lambda _: f'${next(counter)}', statement)
+
+
+async def _threaded(function, *args):
+    """Run a blocking function, e.g. a `pytape` or psycopg2 call, in the default executor."""
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(function, *args))
+
+
+class _Engine:
+    """HTTP session, database pool and in-flight limit shared by the apps of a cycle."""
+
+    def __init__(self, tape: Client, session: aiohttp.ClientSession, pool: asyncpg.pool.Pool,
+                 lock_connection: asyncpg.Connection):
+        self.tape = tape
+        self.session = session
+        self.pool = pool
+        self.inflight = asyncio.Semaphore(ASYNC_MAX_INFLIGHT)
+        # Session advisory locks of the apps, see `tape_leases.app_lock`, on a connection of their own
+        self.lock_connection = lock_connection
+        self._lock_connection_busy = asyncio.Lock()
+
+    async def set_app_lock(self, app_id: int, locked: bool) -> bool:
+        """Acquire, without waiting, or release the advisory lock of an app."""
+        async with self._lock_connection_busy:
+            return await self.lock_connection.fetchval(_numbered(TRY_LOCK_APP if locked else UNLOCK_APP), app_id)
+
+    async def get_record_rows(self, app_id: int, converter: RecordConverter, **args) -> dict:
+        """Request a page of records and convert it into rows, as `tape_stream.get_record_rows`.
+
+        The response is parsed incrementally when `TAPE_STREAMING` is set.
+
+        Raises:
+            TransportException: tape transport error exception
+        """
+        async with self.session.get(records_url(app_id), params=api_params(args)) as response:
+            if response.status >= 400:
+                raise api_error(response.status, response.headers, await response.text())
+            if TAPE_STREAMING:
+                builder = PageBuilder(converter)
+                async for prefix, event, value in ijson.parse_async(response.content):
+                    builder.feed(prefix, event, value)
+                page = builder.page
+            else:
+                content = json.loads(await response.text())
+                page = {'rows': converter.convert_page(content['records']), 'cursor': content.get('cursor'),
+                        'total': content.get('total')}
+        # Unlike `pytape`, the quota is known after every request
+        scheduler.observe({key.lower(): value for key, value in response.headers.items()})
+        return page
+
+    async def _fetch_page(self, app_id: int, args: dict, converter: RecordConverter, limit: int = None) -> dict:
+        """Request a page with the adaptive page size of the app, as `tape_pages._fetch_page`.
+
+        Timeouts of the HTTP session are retried like gateway errors.
+        """
+        for attempt in range(PAGE_MAX_RETRIES + 1):
+            args['limit'] = page_sizer.size(app_id, limit)
+            try:
+                async with self.inflight:
+                    with PAGE_SECONDS.time(app_id=app_id):
+                        # Only the request itself tells the latency of Tape, not the waits for a turn
+                        page, seconds = await scheduler.acall(app_id, atimed(self.get_record_rows), app_id, converter, **args)
+            except (TransportException, asyncio.TimeoutError) as err:
+                status = err.status.get('status') if isinstance(err, TransportException) else 'timeout'
+                if attempt == PAGE_MAX_RETRIES or (isinstance(err, TransportException) and not is_retryable(err)):
+                    raise
+                page_sizer.failed(app_id, args['limit'])
+                PAGE_RETRIES.inc(app_id=app_id, status=status)
+                wait = backoff_seconds(attempt)
+                logger.warning(f"Página do aplicativo {app_id} falhou ({status}). "
+                               f"Tentando novamente com {page_sizer.size(app_id, limit)} registros em {wait:.1f}s")
+                await asyncio.sleep(wait)
+                continue
+            page_sizer.observe(app_id, args['limit'], seconds, len(page['rows']))
+            return page
+
+    async def iter_pages(self, app_id: int, args: dict, converter: RecordConverter, is_last=None):
+        """Request the pages of records of an app, as `tape_pages.iter_pages`."""
+        args = dict(args)
+        limit = args.get('limit')
+        while True:
+            page = await self._fetch_page(app_id, args, converter, limit)
+            RECORDS_FETCHED.inc(len(page['rows']), app_id=app_id)
+            yield page
+
+            if not page.get('cursor') or not page['rows'] or (is_last and is_last(page)):
+                return
+            args['cursor'] = page['cursor']
+
+
+async def _prefetch(pages, depth: int = PREFETCH_DEPTH):
+    """Consume `pages` in a background task, keeping up to `depth` pages ready, as `tape_pages.prefetch`."""
+    if depth <= 0:
+        async for page in pages:
+            yield page
+        return
+
+    buffer = asyncio.Queue(maxsize=depth)
+
+    async def produce():
+        try:
+            async for page in pages:
+                await buffer.put((page, None))
+        except Exception as err:
+            await buffer.put((_DONE, err))
+        else:
+            await buffer.put((_DONE, None))
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            page, err = await buffer.get()
+            if err is not None:
+                raise err
+            if page is _DONE:
+                return
+            yield page
+    finally:
+        producer.cancel()
+
+
+async def _copy_staging(connection: asyncpg.Connection, table_name: str, columns: list, rows: list):
+    await connection.execute(staging_statement(table_name))
+    buffer = io.BytesIO(copy_buffer(rows).getvalue().encode())
+    await connection.copy_to_table('staging', source=buffer, columns=columns, format='text')
+
+
+async def _write_children(connection: asyncpg.Connection, table_name: str, converter: RecordConverter, rows: list):
+    """Replace the child rows of the records of a page, as `tape_children.write_children`."""
+    record_ids = [row[RECORD_ID] for row in rows]
+    for index, column in multi_valued_columns(converter):
+        await connection.execute(_numbered(delete_children_statement(table_name, column)), record_ids)
+        children = child_rows(rows, index)
+        if children:
+            await connection.execute(CHILD_STAGING)
+            buffer = io.BytesIO(copy_buffer(children).getvalue().encode())
+            await connection.copy_to_table('child_staging', source=buffer, columns=CHILD_COLUMNS, format='text')
+            await connection.execute(insert_children_statement(table_name, column))
+            await connection.execute(DROP_CHILD_STAGING)
+
+
+async def _write_page(connection: asyncpg.Connection, table_name: str, converter: RecordConverter, rows: list) -> int:
+    """Write a page of rows converted from Tape, as `tape_insert_records.write_page`.
+
+    Returns:
+        int: Number of rows written
+    """
+    if not rows:
+        return 0
+
+    record_ids = [row[RECORD_ID] for row in rows]
+    last_modified = [parse_timestamp(row[LAST_MODIFIED_ON]) for row in rows]
+    changed = {record_id: (is_new, stored_hash) for record_id, is_new, stored_hash
+               in await connection.fetch(_numbered(detect_changes_statement(table_name)), record_ids, last_modified)}
+
+    upserts, touches, new_count = split_by_content(rows, changed)
+    if upserts or touches:
+        message = f"{new_count} registros novos, {len(upserts) - new_count} atualizados e {len(touches)} "\
+            f"apenas com a data de modificação alterada no tape para a tabela `{table_name}`"
+        logger.info(message)
+        log_records('gravado', table_name, [row[RECORD_ID] for row in upserts])
+        log_records('com apenas a data de modificação atualizada', table_name, [row[RECORD_ID] for row in touches])
+
+    if upserts:
+        await _copy_staging(connection, table_name, [*converter.columns, HASH_COLUMN], upserts)
+        await connection.execute(upsert_statement(table_name, [*converter.columns, HASH_COLUMN]))
+        if NORMALIZED_FIELDS:
+            await _write_children(connection, table_name, converter, upserts)
+    if touches:
+        await connection.execute(_numbered(touch_statement(table_name)), [row[RECORD_ID] for row in touches],
+                                 [parse_timestamp(row[LAST_MODIFIED_ON]) for row in touches])
+    return len(upserts) + len(touches)
+
+
+async def _backfill_columns(engine: _Engine, app_id: int, table_name: str, converter: RecordConverter, columns: list):
+    """Fill the columns added to an existing table, as `tape_insert_records._backfill_columns`."""
+    converter = converter.subset(columns)
+    if converter.fields:
+        updated_columns = converter.columns[len(SIMPLE_ATTRIBUTES):]
+        message = f"Preenchendo as colunas {updated_columns} da tabela `{table_name}`"
+        logger.info(message)
+
+        async for page in _prefetch(engine.iter_pages(app_id, {"limit": 500}, converter)):
+            if page['rows']:
+                async with engine.pool.acquire() as connection, connection.transaction():
+                    await _copy_staging(connection, table_name, converter.columns, page['rows'])
+                    await connection.execute(update_statement(table_name, updated_columns))
+                    if NORMALIZED_FIELDS:
+                        await _write_children(connection, table_name, converter, page['rows'])
+
+    await engine.pool.execute(_numbered(FINISH_BACKFILL), app_id)
+
+
+class _AsyncSteps(PassSteps):
+    """I/O of a pass with `aiohttp` and `asyncpg`, see `tape_pass.run_pass`.
+
+    A connection is only held while a page is written, so the pool is shared
+    by all apps while their next pages are requested.
+    """
+
+    def __init__(self, engine: _Engine, app_id: int, table_name: str, converter: RecordConverter):
+        self.engine = engine
+        self.app_id = app_id
+        self.table_name = table_name
+        self.converter = converter
+
+    async def load_state(self) -> dict:
+        return state_from_row(await self.engine.pool.fetchrow(_numbered(SELECT_STATE), self.app_id))
+
+    async def refresh(self) -> bool:
+        return await _threaded(_refresh_table, self.engine.tape, self.app_id, self.table_name, self.converter)
+
+    async def backfill(self, columns: list):
+        await _backfill_columns(self.engine, self.app_id, self.table_name, self.converter, columns)
+
+    def pages(self, args: dict, is_last):
+        return _prefetch(self.engine.iter_pages(self.app_id, args, self.converter, is_last))
+
+    async def write(self, rows: list, checkpoint: tuple) -> int:
+        page_cursor, pass_high_water_mark, page_index = checkpoint
+        async with self.engine.pool.acquire() as connection, connection.transaction():
+            written = await _write_page(connection, self.table_name, self.converter, rows)
+            await connection.execute(_numbered(SAVE_PAGE_STATE), self.app_id, pass_high_water_mark, page_cursor, page_index)
+        return written
+
+    async def skip_page(self, checkpoint: tuple):
+        page_cursor, pass_high_water_mark, page_index = checkpoint
+        await self.engine.pool.execute(_numbered(SAVE_PAGE_STATE), self.app_id, pass_high_water_mark, page_cursor, page_index)
+
+    async def discard_checkpoint(self):
+        await self.engine.pool.execute(_numbered(DISCARD_CHECKPOINT), self.app_id)
+
+    async def finish(self, page_size: int):
+        await self.engine.pool.execute(_numbered(FINISH_PASS), self.app_id)
+        await self.engine.pool.execute(_numbered(SAVE_PAGE_SIZE), page_size, self.app_id)
+
+    async def run_blocking(self, function, *args):
+        # Parquet files are written in a thread, off the event loop
+        return await _threaded(function, *args)
+
+
+def _known_tables() -> set:
+    with borrow_db() as mydb:
+        return metadata_cache.get_tables(mydb.cursor())
+
+
+def _adapt_table(tape: Client, app_id: int, table_name: str, err: Exception):
+    """Rename, alter or drop the table of an app after a failed write, with the threaded engine."""
+    with borrow_db() as mydb:
+        handle_schema_change(thread_client(tape), app_id, mydb, mydb.cursor(), table_name, err)
+
+
+def _refresh_table(tape: Client, app_id: int, table_name: str, converter: RecordConverter) -> bool:
+    """Rebuild the table of an app in a shadow table with the threaded engine, see `tape_refresh`.
+
+    Returns:
+        bool: Whether the table was rebuilt, otherwise the refresh is retried after a backoff
+    """
+    with borrow_db() as mydb:
+        try:
+            refresh_table(thread_client(tape), app_id, mydb, mydb.cursor(), table_name, converter)
+            return True
+        except dbError as err:
+            mydb.rollback()
+            cursor = mydb.cursor()
+            retry_at = refresh_failed(cursor, app_id)
+            mydb.commit()
+            logger.error(f"Erro na reconstrução da tabela `{table_name}`. A tabela atual continua sendo sincronizada "
+                         f"e a reconstrução será tentada novamente a partir de {retry_at}. {err}")
+            return False
+
+
+async def _insert_app_records(engine: _Engine, app_id: int) -> int:
+    """Insert the records of a tape app in the database, as `tape_insert_records._insert_app_records`.
+
+    Returns:
+        int: Code to handle the main loop, as in `insert_records`
+    """
+    try:
+        # Metadata comes from `pytape` and is cached, so it is read with the threaded code
+        _, table_name = await _threaded(lambda: metadata_cache.get_table_name(thread_client(engine.tape), app_id))
+        if table_name not in await _threaded(_known_tables):
+            return 0
+        converter = await _threaded(lambda: metadata_cache.get_record_converter(thread_client(engine.tape), app_id))
+
+        if not await engine.set_app_lock(app_id, True):
+            logger.warning(f"Aplicativo {app_id} sendo sincronizado por outra réplica. Ignorando...")
+            return 0
+        try:
+            await run_pass(_AsyncSteps(engine, app_id, table_name, converter), app_id, table_name, converter)
+        except asyncpg.PostgresError as err:
+            if not is_schema_drift(err):
+                logger.error(f"Erro no acesso ao BD na sincronização da tabela `{table_name}`. {err}")
+                return 3
+            await _threaded(_adapt_table, engine.tape, app_id, table_name, err)
+        finally:
+            await engine.set_app_lock(app_id, False)
+
+    except TransportException as err:
+        logger.error(f"Erro no acesso ao Tape. {err}")
+        return 1
+
+    return 0
+
+
+async def _insert_records(tape: Client, apps_ids: list) -> int:
+    rate_limited = asyncio.Event()
+
+    async def run(engine, app_id):
+        if rate_limited.is_set():
+            return 1
+        try:
+            code = await _insert_app_records(engine, app_id)
+        except Exception as err:
+            logger.exception(f"Erro inesperado no aplicativo {app_id}. {err}")
+            return 3
+        if code == 1:
+            rate_limited.set()
+        return code
+
+    params = dict(DB_PARAMS)
+    params['database'] = params.pop('dbname')
+    params['port'] = int(params['port']) if params['port'] else None
+    headers = {'Authorization': f"Bearer {getenv('TAPE_USER_KEY')}"}
+    timeout = aiohttp.ClientTimeout(total=_REQUEST_TIMEOUT)
+
+    lock_connection = await asyncpg.connect(**params)
+    try:
+        async with aiohttp.ClientSession(headers=headers, timeout=timeout) as session, \
+                asyncpg.create_pool(min_size=1, max_size=DB_POOL_SIZE, **params) as pool:
+            engine = _Engine(tape, session, pool, lock_connection)
+            codes = await asyncio.gather(*(run(engine, app_id) for app_id in apps_ids))
+    finally:
+        await lock_connection.close()
+
+    return cycle_code(codes)
+
+
+def insert_records(tape: Client, apps_ids: list):
+    """Insert tape records in the database, synchronizing every app concurrently.
+
+    Args:
+        tape (Client): tape client, used for the apps metadata
+        apps_ids (list): List of tape apps IDs
+
+    Returns:
+        int: Code to handle the main loop, as in `tape_insert_records.insert_records`
+    """
+    return asyncio.run(_insert_records(tape, apps_ids))
@@ -0,0 +1,135 @@
+"""Normalized child tables of the multi-valued fields, enabled with `NORMALIZED_FIELDS=1`.
+
+Each `contact`, `category` and `app` field of an app gets the table
+`tape_fields."{table}__{field}"`, with one row per value: the record ID, the
+position of the value in the field, the value as in the array column of the
+app table and the ID of the linked user, category option or record. Child
+rows are replaced in the same transaction as their parent row, and deleted
+with it through a foreign key.
+"""
+from os import getenv
+
+from psycopg2._psycopg import cursor
+
+from copy_tools import copy_rows
+from tape_converters import RECORD_ID, SIMPLE_ATTRIBUTES, RecordConverter
+from logging_tools import logger
+
+
+# Maintain a child table per multi-valued field (`1`)
+NORMALIZED_FIELDS = getenv('NORMALIZED_FIELDS', '0') == '1'
+
+CHILD_SCHEMA = 'tape_fields'
+MULTI_VALUED_TYPES = ('contact', 'category', 'app')
+CHILD_COLUMNS = ['record_id', 'position', 'value', 'item_id']
+
+# Staging table of the child rows, dropped after each child table is written
+CHILD_STAGING = "CREATE TEMP TABLE child_staging (record_id TEXT, position INTEGER, value TEXT, item_id TEXT) ON COMMIT DROP"
+DROP_CHILD_STAGING = "DROP TABLE child_staging"
+
+# Child tables referencing an app table, whatever their names
+_SELECT_CHILD_TABLES = "SELECT c.relname FROM pg_constraint AS k JOIN pg_class AS c ON c.oid = k.conrelid "\
+    "WHERE k.contype = 'f' AND k.confrelid = %s::regclass "\
+    "AND c.relnamespace = (SELECT oid FROM pg_namespace WHERE nspname = %s)"
+
+
+def child_table(table_name: str, column: str) -> str:
+    """Qualified name of the child table of a column."""
+    return f'{CHILD_SCHEMA}."{table_name}__{column}"'
+
+
+def multi_valued_columns(converter: RecordConverter) -> list:
+    """`(row index, column)` of the multi-valued fields converted by `converter`."""
+    return [(index, field['external_id']) for index, field in enumerate(converter.fields, start=len(SIMPLE_ATTRIBUTES))
+            if field['type'] in MULTI_VALUED_TYPES]
+
+
+def child_rows(rows: list, index: int) -> list:
+    """Rows of the child table of the column at `index`, one per value of the field."""
+    return [(row[RECORD_ID], position, value, getattr(value, 'item_id', None))
+            for row in rows for position, value in enumerate(row[index] or ())]
+
+
+def delete_children_statement(table_name: str, column: str) -> str:
+    """Deletion of the child rows of the records, taking the array of record IDs."""
+    return f"DELETE FROM {child_table(table_name, column)} WHERE record_id = ANY(%s)"
+
+
+def insert_children_statement(table_name: str, column: str) -> str:
+    """Insertion of `child_staging` into the child table, skipping the records missing from the app table."""
+    return f"INSERT INTO {child_table(table_name, column)} (record_id, position, value, item_id) "\
+        "SELECT record_id, position, value, item_id FROM child_staging "\
+        f"WHERE EXISTS (SELECT 1 FROM tape.{table_name} AS parent WHERE parent.record_id = child_staging.record_id)"
+
+
+def ensure_child_tables(cursor: cursor, table_name: str, fields: list) -> list:
+    """Create the missing child tables of the multi-valued fields of an app. The caller commits.
+
+    Returns:
+        list: Columns whose child tables were created, to be backfilled if the app table is not new
+    """
+    cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {CHILD_SCHEMA}")
+    created = []
+    for field in fields:
+        column = field['external_id']
+        if field['type'] not in MULTI_VALUED_TYPES:
+            continue
+        cursor.execute("SELECT to_regclass(%s)", (child_table(table_name, column),))
+        if cursor.fetchone()[0] is not None:
+            continue
+
+        logger.info(f"Criando a tabela `{table_name}__{column}` do campo `{column}`")
+        cursor.execute(
+            f"CREATE TABLE {child_table(table_name, column)} ("
+            f"record_id TEXT NOT NULL REFERENCES tape.{table_name} (record_id) ON DELETE CASCADE"
+            ", position INTEGER NOT NULL"
+            ", value TEXT"
+            ", item_id TEXT"
+            ", PRIMARY KEY (record_id, position)"
+            ")")
+        cursor.execute(f"CREATE INDEX ON {child_table(table_name, column)} (value)")
+        cursor.execute(f"CREATE INDEX ON {child_table(table_name, column)} (item_id)")
+        created.append(column)
+    return created
+
+
+def write_children(cursor: cursor, table_name: str, converter: RecordConverter, rows: list):
+    """Replace the child rows of the records of a page. The caller commits the transaction.
+
+    Raises:
+        dbError: DB exception
+    """
+    record_ids = [row[RECORD_ID] for row in rows]
+    for index, column in multi_valued_columns(converter):
+        cursor.execute(delete_children_statement(table_name, column), (record_ids,))
+        children = child_rows(rows, index)
+        if children:
+            cursor.execute(CHILD_STAGING)
+            copy_rows(cursor, 'child_staging', CHILD_COLUMNS, children)
+            cursor.execute(insert_children_statement(table_name, column))
+            cursor.execute(DROP_CHILD_STAGING)
+
+
+def get_child_tables(cursor: cursor, table_name: str) -> list:
+    """Names of the child tables of an app table, without the schema."""
+    cursor.execute(_SELECT_CHILD_TABLES, (f"tape.{table_name}", CHILD_SCHEMA))
+    return [name for name, in cursor.fetchall()]
+
+
+def rename_child_tables(cursor: cursor, table_name: str, new_table_name: str):
+    """Follow the rename of an app table. The caller commits."""
+    prefix = f"{table_name}__"
+    for name in get_child_tables(cursor, table_name):
+        if name.startswith(prefix):
+            cursor.execute(f'ALTER TABLE {CHILD_SCHEMA}."{name}" RENAME TO "{new_table_name}__{name[len(prefix):]}"')
+
+
+def rename_child_table(cursor: cursor, table_name: str, column: str, new_column: str):
+    """Follow the rename of a column. The caller commits."""
+    cursor.execute(f'ALTER TABLE IF EXISTS {child_table(table_name, column)} RENAME TO "{table_name}__{new_column}"')
+
+
+def drop_child_tables(cursor: cursor, table_name: str):
+    """Drop the child tables of an app table, before the table itself. The caller commits."""
+    for name in get_child_tables(cursor, table_name):
+        cursor.execute(f'DROP TABLE {CHILD_SCHEMA}."{name}"')
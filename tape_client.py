@@ -0,0 +1,64 @@
+"""Tape clients for the main thread and for the sync workers."""
+from os import getenv
+import threading
+
+from pytape import api
+from pytape.client import Client
+from pytape.transport import TransportException
+import requests
+
+
+# Base URL of the Tape REST API, for the requests sent without `pytape`
+TAPE_API_URL = getenv('TAPE_API_URL', 'https://api.tapeapp.com/v1')
+
+_local = threading.local()
+
+
+def new_client() -> Client:
+    """Authenticate a new Tape client with `TAPE_USER_KEY`.
+
+    Raises:
+        TransportException: tape transport error exception
+    """
+    return api.BearerClient(getenv('TAPE_USER_KEY'))
+
+
+_client_factory = new_client
+
+
+def set_client_factory(factory):
+    """Replace the factory of the per-thread clients, `new_client` by default."""
+    global _client_factory
+    _client_factory = factory
+
+
+def thread_client(tape: Client) -> Client:
+    """Tape client to be used by the current thread.
+
+    `pytape` clients are not thread-safe, so each thread gets its own one,
+    created by the client factory (see `set_client_factory`).
+
+    Raises:
+        TransportException: tape transport error exception
+    """
+    if getattr(_local, 'client', None) is None:
+        _local.client = _client_factory()
+    return _local.client
+
+
+def thread_http_session() -> requests.Session:
+    """HTTP session of the current thread, authenticated with `TAPE_USER_KEY`, for raw API requests."""
+    if getattr(_local, 'session', None) is None:
+        _local.session = requests.Session()
+        _local.session.headers['Authorization'] = f"Bearer {getenv('TAPE_USER_KEY')}"
+    return _local.session
+
+
+def api_params(args: dict) -> dict:
+    """Query string parameters of a raw API request, with booleans written as in JSON."""
+    return {key: str(value).lower() if isinstance(value, bool) else str(value) for key, value in args.items()}
+
+
+def api_error(status: int, headers, content: str) -> TransportException:
+    """The `TransportException` `pytape` raises for an error response, for raw API requests."""
+    return TransportException(dict({key.lower(): value for key, value in headers.items()}, status=str(status)), content)
@@ -0,0 +1,246 @@
+"""Conversion of tape records into typed rows of the database tables."""
+from collections import namedtuple
+import datetime
+from decimal import Decimal, InvalidOperation
+from hashlib import md5
+
+from copy_tools import copy_encode
+from logging_tools import logger
+
+
+# Tape permits the following fields as simple attributes
+SIMPLE_ATTRIBUTES = ['record_id', 'created_on', 'last_modified_on']
+
+# Column with the `content_hash` of each row
+HASH_COLUMN = '_tape_hash'
+
+# Suffix of the column with the currency of each `money` field
+CURRENCY_SUFFIX = '_currency'
+
+# Position of the simple attributes in the rows
+RECORD_ID = SIMPLE_ATTRIBUTES.index('record_id')
+CREATED_ON = SIMPLE_ATTRIBUTES.index('created_on')
+LAST_MODIFIED_ON = SIMPLE_ATTRIBUTES.index('last_modified_on')
+
+FieldType = namedtuple('FieldType', ['sql_type', 'format_type', 'convert'])
+"""Column type of a tape field type: the type used in DDL, the same type
+as written by `format_type()` in the catalog, and the converter from the
+field `values` to a Python value."""
+
+FIELD_TYPES = {}
+
+
+def register(*tape_types: str, sql_type: str, format_type: str):
+    """Register a converter for the given tape field types."""
+    def decorator(convert):
+        for tape_type in tape_types:
+            FIELD_TYPES[tape_type] = FieldType(sql_type, format_type, convert)
+        return convert
+    return decorator
+
+
+def _first(values: list) -> dict:
+    # `next` obtém o primeiro valor
+    return next(iter(values), {})
+
+
+def _decimal(value):
+    if value is None or value == '':
+        return None
+    try:
+        return Decimal(str(value))
+    except InvalidOperation:
+        return None
+
+
+class LinkedValue(str):
+    """Value of a multi-valued field, carrying the ID of the linked user, category option or record.
+
+    It is written as the plain string, the ID only goes to the child tables of `tape_children`.
+    """
+
+    def __new__(cls, value: str, item_id=None):
+        linked = super().__new__(cls, value)
+        linked.item_id = None if item_id is None else str(item_id)
+        return linked
+
+
+def _linked(values: list, text_key: str, *id_keys: str):
+    linked = []
+    for elem in values:
+        value = elem.get('value', {})
+        item_id = next((value[key] for key in id_keys if value.get(key) is not None), None)
+        linked.append(LinkedValue(value.get(text_key, ''), item_id))
+    return linked or None
+
+
+@register('contact', sql_type='TEXT[]', format_type='text[]')
+def _contact(values: list):
+    return _linked(values, 'name', 'user_id', 'contact_id', 'id')
+
+
+@register('category', sql_type='TEXT[]', format_type='text[]')
+def _category(values: list):
+    return _linked(values, 'text', 'id')
+
+
+@register('app', sql_type='TEXT[]', format_type='text[]')
+def _app(values: list):
+    return _linked(values, 'title', 'record_id', 'id')
+
+
+def _parse_date(value: str):
+    """Parse a date of Tape: `2024-03-01 10:00:00`, `2024-03-01` or ISO 8601 with `T` and an offset or `Z`.
+
+    Dates with an offset are converted to UTC, as the timestamps of Tape.
+
+    Returns:
+        datetime: The naive date, or `None` if the value is not a date
+    """
+    value = value.strip()
+    if value.endswith(('Z', 'z')):
+        value = value[:-1] + '+00:00'
+    try:
+        date = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if date.tzinfo is not None:
+        date = date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return date
+
+
+@register('date', sql_type='TIMESTAMP', format_type='timestamp without time zone')
+def _date(values: list):
+    start = _first(values).get('start')
+    if not start:
+        return None
+    date = _parse_date(str(start))
+    if date is None:
+        # Written as NULL rather than failing the whole page in PostgreSQL
+        logger.warning(f"Data `{start}` em formato desconhecido ignorada")
+    return date
+
+
+@register('number', 'progress', 'rating', sql_type='NUMERIC', format_type='numeric')
+def _number(values: list):
+    return _decimal(_first(values).get('value'))
+
+
+@register('money', sql_type='NUMERIC', format_type='numeric')
+def _money(values: list):
+    return _decimal(_first(values).get('value'))
+
+
+@register('money_currency', sql_type='TEXT', format_type='text')
+def _money_currency(values: list):
+    return _first(values).get('currency') or None
+
+
+@register('calculation', sql_type='TEXT', format_type='text')
+def _calculation(values: list):
+    return _first(values).get('value_string')
+
+
+@register('file', sql_type='TEXT', format_type='text')
+def _file(values: list):
+    return _first(values).get('value', {}).get('link')
+
+
+@register('embed', sql_type='TEXT', format_type='text')
+def _embed(values: list):
+    return _first(values).get('embed', {}).get('url')
+
+
+def _text(values: list):
+    value = _first(values).get('value')
+    return None if value is None else str(value)
+
+
+TEXT = FieldType('TEXT', 'text', _text)
+
+
+def get_field_type(field: dict) -> FieldType:
+    """Column type and converter of an app field, `TEXT` for unregistered field types."""
+    return FIELD_TYPES.get(field['type'], TEXT)
+
+
+def currency_field(field: dict) -> dict:
+    """Column with the currency of a `money` field, converted from the values of the field."""
+    return {'field_id': f"{field['field_id']}{CURRENCY_SUFFIX}", 'external_id': f"{field['external_id']}{CURRENCY_SUFFIX}",
+            'type': 'money_currency', 'source': field['external_id']}
+
+
+def app_fields(app_info: dict) -> list:
+    """Fields of the app stored as columns, i.e. all but the simple attributes.
+
+    Each `money` field is followed by the `currency_field` of its currency.
+    """
+    fields = []
+    for field in app_info.get('fields'):
+        if field['external_id'] in SIMPLE_ATTRIBUTES:
+            continue
+        fields.append(field)
+        if field['type'] == 'money':
+            fields.append(currency_field(field))
+    return fields
+
+
+class RecordConverter:
+    """Conversion of the records of an app, compiled once from its schema.
+
+    The converter of each column is resolved up front, so converting a record
+    is a lookup and a call per field, with no dispatch on the field type.
+    """
+
+    def __init__(self, fields: list):
+        self.fields = fields
+        self.columns = [*SIMPLE_ATTRIBUTES, *(field['external_id'] for field in fields)]
+        # Columns of each field of the records, e.g. the amount and the currency of a `money` field
+        self._index = {}
+        for index, field in enumerate(fields, start=len(SIMPLE_ATTRIBUTES)):
+            self._index.setdefault(field.get('source', field['external_id']), []).append(index)
+        self._converters = [None] * len(SIMPLE_ATTRIBUTES) + [get_field_type(field).convert for field in fields]
+
+    def convert(self, record: dict) -> tuple:
+        """Convert a record into a row, in the order of `columns`. Missing fields are `None`."""
+        row = [None] * len(self.columns)
+        row[0] = str(record['record_id'])
+        row[1] = record['created_on']
+        row[2] = record['last_modified_on']
+        for field in record.get('fields'):
+            for index in self._index.get(field['external_id'], ()):
+                row[index] = self._converters[index](field['values'])
+        return tuple(row)
+
+    def convert_page(self, records: list) -> list:
+        """Convert a page of records into rows."""
+        return [self.convert(record) for record in records]
+
+    def subset(self, columns: list) -> 'RecordConverter':
+        """Converter restricted to the given field columns."""
+        return RecordConverter([field for field in self.fields if field['external_id'] in columns])
+
+
+def content_hash(row: tuple, linked: bool = False) -> str:
+    """Hash of the field values of a row, i.e. of everything but the simple attributes.
+
+    Args:
+        row (tuple): Row converted by a `RecordConverter`
+        linked (bool): Whether the IDs of the `LinkedValue` items are hashed
+            too, since the child tables store them and a relinked item may
+            keep its text
+
+    Returns:
+        str: Hexadecimal MD5 digest
+    """
+    values = row[len(SIMPLE_ATTRIBUTES):]
+    text = '\t'.join(map(copy_encode, values))
+    if linked:
+        text += '\n' + '\t'.join(copy_encode([getattr(item, 'item_id', None) for item in value])
+                                   if isinstance(value, list) else '' for value in values)
+    return md5(text.encode()).hexdigest()
+
+
+def compile_record_converter(app_info: dict) -> RecordConverter:
+    """Compile the record converter of an app from its schema."""
+    return RecordConverter(app_fields(app_info))
@@ -5,8 +5,15 @@ from pytape.client import Client
 from pytape.transport import TransportException
 
 from get_time import get_hour
-from get_mydb import get_db
+from get_mydb import borrow_db
+from tape_metadata_cache import metadata_cache
+from tape_children import NORMALIZED_FIELDS, ensure_child_tables
+from tape_converters import HASH_COLUMN, app_fields, get_field_type
+from tape_leases import lock_ddl, lock_schema
+from tape_schema import comment_column, evolve_schema
+from tape_sync_state import ensure_sync_state_table, request_backfill, reset_sync_state
 from tape_tools import handling_tape_error
+from tape_workers import run_for_apps
 # from telegram_tools import send_to_bot
 from logging_tools import logger
 
@@ -15,55 +22,83 @@ def create_tables(tape: Client, apps_ids: list):
     """Create tables in the database for each tape app.
 
     Args:
-        tape (_type_): _description_
-        apps_ids (_type_): _description_
+        tape (Client): tape client
+        apps_ids (list): List of tape apps IDs
 
     Returns:
         int: Code to handle the main loop. `0` if no errors,
         `1` if the tape API limit is reached.
         `2` encountered another error with tape,
+        `3` if some apps failed with an unexpected error
     """
-    # Waiting for DB connection
-    mydb = None
-    while not mydb:
-        mydb = get_db()
+    with borrow_db() as mydb:
+        cursor = mydb.cursor()
+        lock_schema(cursor)
+        ensure_sync_state_table(cursor)
+        mydb.commit()
 
-    cursor = mydb.cursor()
-    for app_id in apps_ids:
+    return run_for_apps(tape, apps_ids, _create_table)
+
+
+def create_table_statement(table_name: str, app_info: dict, primary_key: bool = True) -> str:
+    """`CREATE TABLE` of the table of an app, without the primary key for bulk loads."""
+    query = [f"CREATE TABLE IF NOT EXISTS tape.{table_name}", "("]
+    query.append('"record_id" TEXT PRIMARY KEY NOT NULL' if primary_key else '"record_id" TEXT NOT NULL')
+    query.append(', "created_on" TIMESTAMP')
+    query.append(', "last_modified_on" TIMESTAMP')
+
+    for field in app_fields(app_info):
+        query.append(f", \"{field['external_id']}\" {get_field_type(field).sql_type}")
+    query.append(f', "{HASH_COLUMN}" TEXT')
+    query.append(")")
+    return ''.join(query)
+
+
+def _create_table(tape: Client, app_id: int):
+    """Create the database table of a tape app, if it does not exist yet.
+
+    Returns:
+        int: Code to handle the main loop, as in `create_tables`
+    """
+    with borrow_db() as mydb:
+        cursor = mydb.cursor()
 
         # Creating database tables for each tape app
         try:
-            app_info = tape.App.find(app_id)
-            workspace_id = app_info.get('workspace_id')
-
-            # Retrieving all workspaces to get the workspace name
-            workspaces = tape.Workspace.get_all_for_org()
-            workspace = next(filter(lambda workspace: workspace['workspace_id'] == workspace_id, workspaces['workspaces']))
-
-            cursor.execute("SELECT table_name FROM information_schema.tables "\
-                "WHERE table_schema = 'tape' ORDER BY table_name;")
-            tables = cursor.fetchall()
-
-            table_name = workspace['slug'].replace('-', '_') + '__' + app_info['slug'].replace('-', '_')
-            if (table_name,) not in tables:
-                query = [f"CREATE TABLE IF NOT EXISTS tape.{table_name}", "("]
-                query.append('"record_id" TEXT PRIMARY KEY NOT NULL')
-                query.append(', "created_on" TIMESTAMP')
-                query.append(', "last_modified_on" TIMESTAMP')
-
-                for field in app_info.get('fields'):
-                    # Tape permits the following fields as simple attributes
-                    if field['external_id'] not in ['record_id', 'created_on', 'last_modified_on']:
-                        query.append(f", \"{field['external_id']}\" TEXT")
-                query.append(")")
+            app_info, table_name = metadata_cache.get_table_name(tape, app_id)
+            # Other replicas wait until the table is created or evolved, and the cache may predate it
+            lock_ddl(cursor, app_id)
+            tables = metadata_cache.get_tables(cursor)
+            cursor.execute("SELECT to_regclass(%s)", (f'tape.{table_name}',))
 
+            if table_name not in tables and cursor.fetchone()[0] is None:
                 message = f"Criando a tabela `{table_name}`"
-                cursor.execute(''.join(query))
+                cursor.execute(create_table_statement(table_name, app_info))
+                for field in app_fields(app_info):
+                    comment_column(cursor, table_name, field)
+                if NORMALIZED_FIELDS:
+                    ensure_child_tables(cursor, table_name, app_fields(app_info))
+                # A new table must be filled from scratch
+                reset_sync_state(cursor, app_id)
                 hour = get_hour()
                 mydb.commit()
+                metadata_cache.add_table(table_name)
                 logger.info(message)
 
+            else:
+                metadata_cache.add_table(table_name)
+                # Fields added or renamed in the app are applied to the existing table
+                added, _ = evolve_schema(cursor, table_name, app_info)
+                if NORMALIZED_FIELDS:
+                    # Child tables of existing columns are filled like added columns
+                    added += ensure_child_tables(cursor, table_name, app_fields(app_info))
+                if added:
+                    request_backfill(cursor, app_id, added)
+                # The schema changes, their backfill and the DDL lock end in the same transaction
+                mydb.commit()
+
         except dbError as err:
+            mydb.rollback()
             message = f"Erro no acesso ao BD. {err}"
             hour = get_hour()
             logger.error(message)
@@ -72,5 +107,4 @@ def create_tables(tape: Client, apps_ids: list):
             message = 'Erro no acesso ao Tape.'
             logger.error(message)
             return 1
-    mydb.close()
     return 0
@@ -1,7 +1,6 @@
 """Functions to insert records from tape to the database."""
-from collections import OrderedDict
-
-import datetime
+import asyncio
+from contextlib import closing
 
 from pytape.client import Client
 from pytape.transport import TransportException
@@ -9,12 +8,24 @@ from pytape.transport import TransportException
 from psycopg2 import Error as dbError
 from psycopg2._psycopg import connection, cursor
 
+from copy_tools import copy_rows
 from get_time import get_hour
-from get_mydb import get_db
+from get_mydb import borrow_db
 
-from tape_tools import handling_tape_error, get_field_text_values
+from tape_children import NORMALIZED_FIELDS, write_children
+from tape_converters import HASH_COLUMN, LAST_MODIFIED_ON, RECORD_ID, SIMPLE_ATTRIBUTES, RecordConverter, content_hash
+from tape_leases import app_lock
+from tape_metadata_cache import metadata_cache
+from tape_pages import iter_pages, prefetch
+from tape_pass import PassSteps, run_pass
+from tape_refresh import refresh_table
+from tape_schema import evolve_schema, is_schema_drift, rename_table
+from tape_sync_state import (discard_checkpoint, finish_backfill, finish_pass, get_sync_state, request_backfill,
+                             refresh_failed, request_refresh, save_page_size, save_page_state)
+from tape_tools import handling_tape_error
+from tape_workers import run_for_apps
 
-from logging_tools import logger
+from logging_tools import log_records, logger
 
 
 def insert_records(tape: Client, apps_ids: list):
@@ -28,132 +39,310 @@ def insert_records(tape: Client, apps_ids: list):
         int: Code to handle the main loop. `0` if no errors,
         `1` if the tape API limit is reached.
         `2` encountered another error with tape,
+        `3` if some apps failed with an unexpected error
     """
-    # Waiting for DB connection
-    mydb = None
-    while not mydb:
-        mydb = get_db()
-    cursor = mydb.cursor()
+    return run_for_apps(tape, apps_ids, _insert_app_records)
+
 
-    for app_id in apps_ids:
+def _insert_app_records(tape: Client, app_id: int):
+    """Insert the records of a tape app in the database.
+
+    Returns:
+        int: Code to handle the main loop, as in `insert_records`
+    """
+    with borrow_db() as mydb:
+        cursor = mydb.cursor()
         try:
-            app_info = tape.App.find(app_id)
-            workspace_id = app_info.get('workspace_id')
+            app_info, table_name = metadata_cache.get_table_name(tape, app_id)
+            tables = metadata_cache.get_tables(cursor)
+
+            if table_name in tables:
+                # Conversion of the records into rows of the table
+                converter = metadata_cache.get_record_converter(tape, app_id)
+
+                with app_lock(mydb, cursor, app_id) as locked:
+                    if not locked:
+                        logger.warning(f"Aplicativo {app_id} sendo sincronizado por outra réplica. Ignorando...")
+                        return 0
+                    try:
+
+                        _insert_record_values(tape, app_id, mydb, cursor, table_name, converter)
+
+                    except TransportException as err:
+                        logger.error(f"Erro no acesso ao Tape. {err}")
+                        return 1
+                    except dbError as err:
+                        mydb.rollback()
+                        if not is_schema_drift(err):
+                            logger.error(f"Erro no acesso ao BD na sincronização da tabela `{table_name}`. {err}")
+                            return 3
+                        handle_schema_change(tape, app_id, mydb, cursor, table_name, err)
 
-            # Retrieving all workspaces to get the workspace name
-            workspaces = tape.Workspace.get_all_for_org()
-            workspace = next(filter(lambda workspace: workspace['workspace_id'] == workspace_id, workspaces['workspaces']))
+        except TransportException as err:
+            logger.error(f"Erro no acesso ao Tape. {err}")
+            return 1
 
-            cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'tape' ORDER BY table_name;")
-            tables = cursor.fetchall()
+    return 0
 
-            table_name = workspace['slug'].replace('-', '_') + '__' + app_info['slug'].replace('-', '_')
-            if (table_name,) in tables:
-                # Data to fill in table
-                table_data_model = OrderedDict()
-                for field in app_info.get('fields'):
-                    # Tape permits the following fields as simple attributes
-                    if field['external_id'] not in ['record_id', 'created_on', 'last_modified_on']:
-                        table_data_model[field['external_id']] = "''"
 
-                try:
+def handle_schema_change(tape: Client, app_id: int, mydb: connection, cursor: cursor, table_name: str, err: dbError):
+    """Adapt the table of an app after a write failed because it no longer matches the app, see `tape_schema.is_schema_drift`.
 
-                    _insert_record_values(tape, app_id, mydb, cursor, table_name, table_data_model)
+    The table is renamed or altered in place whenever possible and, as a
+    last resort, rebuilt in a shadow table on the next pass (see `tape_refresh`).
 
-                except TransportException as err:
-                    mydb.close()
-                    logger.error(f"Erro no acesso ao Tape. {err}")
-                    return 1
-                except dbError as err:
-                    continue
+    Raises:
+        TransportException: tape transport error exception
+    """
+    metadata_cache.invalidate(app_id)
+    app_info, new_table_name = metadata_cache.get_table_name(tape, app_id)
+    try:
+        if new_table_name != table_name:
+            rename_table(mydb, cursor, table_name, new_table_name)
+            metadata_cache.discard_table(table_name)
+            metadata_cache.add_table(new_table_name)
+            return
+
+        added, renamed = evolve_schema(cursor, table_name, app_info)
+        if added:
+            request_backfill(cursor, app_id, added)
+        mydb.commit()
+        if added or renamed:
+            return
+    except dbError as evolve_err:
+        mydb.rollback()
+        err = evolve_err
 
-        except TransportException as err:
-            mydb.close()
-            logger.error(f"Erro no acesso ao Tape. {err}")
-            return 1
+    message = f"Aplicativo alterado. A tabela `{table_name}` será reconstruída. {err}"
+    logger.info(message)
+    request_refresh(cursor, app_id)
+    mydb.commit()
+
+
+def _insert_record_values(tape: Client, app_id: int, mydb: connection, cursor: cursor, table_name: str, converter: RecordConverter):
+    """Insert records from tape in the database, one `COPY` and one transaction per page, see `tape_pass.run_pass`."""
+    asyncio.run(run_pass(_ThreadedSteps(tape, app_id, mydb, cursor, table_name, converter), app_id, table_name, converter))
 
-    mydb.close()
-    return 0
 
+class _ThreadedSteps(PassSteps):
+    """I/O of a pass with `pytape`, the prefetching thread of `tape_pages` and a psycopg2 connection.
 
-def _insert_record_values(tape: Client, app_id: int, mydb: connection, cursor: cursor, table_name: str, table_data_model: dict):
-    """Insert records from tape in the database.
+    The coroutines block: `run_pass` runs alone in an event loop of its own
+    in the thread of the app.
     """
-    args = {"limit": 500}
-    response = tape.App.get_records(app_id, **args)
 
-    num_of_recs = response['total']
-    data_counter = 0
+    def __init__(self, tape: Client, app_id: int, mydb: connection, cursor: cursor, table_name: str, converter: RecordConverter):
+        self.tape = tape
+        self.app_id = app_id
+        self.mydb = mydb
+        self.cursor = cursor
+        self.table_name = table_name
+        self.converter = converter
 
-    for values in _process_records(cursor, table_name, response['records'], table_data_model):
-        _execute_insert_query(mydb, cursor, table_name, values)
-        data_counter += 1
+    async def load_state(self) -> dict:
+        return get_sync_state(self.cursor, self.app_id)
 
-    for _ in range(data_counter, num_of_recs, 500):
-        args['cursor'] = response['cursor']
+    async def refresh(self) -> bool:
+        try:
+            refresh_table(self.tape, self.app_id, self.mydb, self.cursor, self.table_name, self.converter)
+            return True
+        except dbError as err:
+            self.mydb.rollback()
+            retry_at = refresh_failed(self.cursor, self.app_id)
+            self.mydb.commit()
+            logger.error(f"Erro na reconstrução da tabela `{self.table_name}`. A tabela atual continua sendo sincronizada "
+                         f"e a reconstrução será tentada novamente a partir de {retry_at}. {err}")
+            return False
+
+    async def backfill(self, columns: list):
+        _backfill_columns(self.tape, self.app_id, self.mydb, self.cursor, self.table_name, self.converter, columns)
+
+    async def pages(self, args: dict, is_last):
+        with closing(prefetch(iter_pages(self.tape, self.app_id, args, self.converter, is_last))) as pages:
+            for page in pages:
+                yield page
+
+    async def write(self, rows: list, checkpoint: tuple) -> int:
+        written = write_page(self.cursor, self.table_name, self.converter, rows)
+        page_cursor, pass_high_water_mark, page_index = checkpoint
+        save_page_state(self.cursor, self.app_id, page_cursor, pass_high_water_mark, page_index)
+        self.mydb.commit()
+        return written
+
+    async def skip_page(self, checkpoint: tuple):
+        self.mydb.rollback()
+        save_page_state(self.cursor, self.app_id, *checkpoint)
+        self.mydb.commit()
+
+    async def discard_checkpoint(self):
+        discard_checkpoint(self.cursor, self.app_id)
+        self.mydb.commit()
+
+    async def finish(self, page_size: int):
+        finish_pass(self.cursor, self.app_id)
+        save_page_size(self.cursor, self.app_id, page_size)
+        self.mydb.commit()
+
+    async def run_blocking(self, function, *args):
+        return function(*args)
+
+
+def _backfill_columns(tape: Client, app_id: int, mydb: connection, cursor: cursor, table_name: str, converter: RecordConverter, columns: list):
+    """Fill the columns added to an existing table, leaving the other columns untouched."""
+    converter = converter.subset(columns)
+    if converter.fields:
+        updated_columns = converter.columns[len(SIMPLE_ATTRIBUTES):]
+        message = f"Preenchendo as colunas {updated_columns} da tabela `{table_name}`"
+        logger.info(message)
+
+        for page in prefetch(iter_pages(tape, app_id, {"limit": 500}, converter)):
+            if page['rows']:
+                _execute_update_query(cursor, table_name, converter.columns, updated_columns, page['rows'])
+                if NORMALIZED_FIELDS:
+                    write_children(cursor, table_name, converter, page['rows'])
+            mydb.commit()
 
-        response = tape.App.get_records(app_id, **args)
+    finish_backfill(cursor, app_id)
+    mydb.commit()
 
-        for values in _process_records(cursor, table_name, response['records'], table_data_model):
-            _execute_insert_query(mydb, cursor, table_name, values)
 
+def write_page(cursor: cursor, table_name: str, converter: RecordConverter, rows: list) -> int:
+    """Write a page of rows converted by `converter`. The caller commits the transaction.
 
-def _process_records(cursor: cursor, table_name: str, records: list, table_data_model: dict):
-    """Process records from Tape.
+    Rows not newer than the stored ones are ignored, so pages of a pass and
+    changes of the webhooks (see `tape_webhook`) may be written in any order.
+    Rows whose content did not change, e.g. when only a comment was added in
+    Tape, only get their `last_modified_on` updated. The child tables of the
+    multi-valued fields, if enabled, are written with the rows.
 
-    Yields:
-        list: values from possibly each record to be inserted in the database.
+    Returns:
+        int: Number of rows written
     """
-    for record in records:
-        # New record being the copy of the model
-        new_rec = table_data_model.copy()
+    changed = _detect_changes(cursor, table_name, rows)
+    upserts, touches, new_count = split_by_content(rows, changed)
+    if upserts or touches:
+        message = f"{new_count} registros novos, {len(upserts) - new_count} atualizados e {len(touches)} "\
+            f"apenas com a data de modificação alterada no tape para a tabela `{table_name}`"
+        logger.info(message)
+        log_records('gravado', table_name, [row[RECORD_ID] for row in upserts])
+        log_records('com apenas a data de modificação atualizada', table_name, [row[RECORD_ID] for row in touches])
 
-        last_modified_on_tape = datetime.datetime.strptime(record['last_modified_on'], "%Y-%m-%d %H:%M:%S")
-        cursor.execute(f"SELECT last_modified_on FROM tape.{table_name} WHERE record_id='{record['record_id']}'")
-        if cursor.rowcount:
+    if upserts:
+        _execute_upsert_query(cursor, table_name, [*converter.columns, HASH_COLUMN], upserts)
+        if NORMALIZED_FIELDS:
+            write_children(cursor, table_name, converter, upserts)
+    if touches:
+        _execute_touch_query(cursor, table_name, touches)
+    return len(upserts) + len(touches)
 
-            last_modified_on_db = cursor.fetchone()[0]
 
-            if last_modified_on_tape > last_modified_on_db:
-                message = f"Registro de ID={record['record_id']} atualizado no tape. Excluindo-o da tabela '{table_name}' e inserindo-o a seguir."
-                logger.info(message)
-                cursor.execute(f"DELETE FROM tape.{table_name} WHERE record_id='{record['record_id']}'")
+def _detect_changes(cursor: cursor, table_name: str, rows: list) -> dict:
+    """Compare a page of rows with the database in a single query.
 
-        if not cursor.rowcount or last_modified_on_tape > last_modified_on_db:
+    Returns:
+        dict: `record_id -> (is_new, stored content hash)` for the records
+        that are new or were modified in Tape
+    """
+    if not rows:
+        return {}
 
-            values = [f"'{str(record['record_id'])}'",f"'{record['created_on']}'",f"'{record['last_modified_on']}'"]
+    record_ids = [row[RECORD_ID] for row in rows]
+    last_modified = [row[LAST_MODIFIED_ON] for row in rows]
+    cursor.execute(detect_changes_statement(table_name), (record_ids, last_modified))
+    return {record_id: (is_new, stored_hash) for record_id, is_new, stored_hash in cursor.fetchall()}
 
-            # Update new database record data with the record data from Tape
-            for field in record.get('fields'):
 
-                if field['external_id'] in table_data_model:
-                    new_rec.update({field['external_id']: get_field_text_values(field)})
+def detect_changes_statement(table_name: str) -> str:
+    """Query of `_detect_changes`, taking the arrays of record IDs and of `last_modified_on`."""
+    return f"SELECT page.record_id, stored.record_id IS NULL, stored.\"{HASH_COLUMN}\" "\
+        "FROM unnest(%s::text[], %s::timestamp[]) AS page(record_id, last_modified_on) "\
+        f"LEFT JOIN tape.{table_name} AS stored ON stored.record_id = page.record_id "\
+        "WHERE stored.record_id IS NULL OR page.last_modified_on > stored.last_modified_on"
 
-            values.extend(list(new_rec.values()))
 
-            yield values
+def split_by_content(rows: list, changed: dict):
+    """Split the changed rows of a page by whether their content changed.
 
+    Args:
+        rows (list): Rows of the page
+        changed (dict): Result of `_detect_changes`
 
-def _execute_insert_query(mydb: connection, cursor: cursor, table_name: str, values: list):
-    """Execute the insert query.
+    Returns:
+        tuple: `(upserts, touches, new_count)`, the rows to be written, with
+        their content hash appended, the rows whose content hash matches the
+        stored one and the number of new rows
+    """
+    upserts, touches, new_count = [], [], 0
+    for row in rows:
+        if row[RECORD_ID] not in changed:
+            continue
+        is_new, stored_hash = changed[row[RECORD_ID]]
+        row_hash = content_hash(row, linked=NORMALIZED_FIELDS)
+        if row_hash == stored_hash:
+            touches.append(row)
+        else:
+            upserts.append((*row, row_hash))
+            new_count += is_new
+    return upserts, touches, new_count
+
+
+def _execute_upsert_query(cursor: cursor, table_name: str, columns: list, rows: list):
+    """Upsert a page of rows through a staging table.
+
+    Rows are copied into a temporary table and merged with a single
+    `INSERT ... ON CONFLICT (record_id) DO UPDATE`, which only overwrites
+    rows whose `last_modified_on` is older than the incoming one.
 
     Raises:
         dbError: DB exception
     """
-    query = [f"INSERT INTO tape.{table_name}", " VALUES", "("]
-    query.extend(','.join(values))
-    query.append(")")
+    cursor.execute(staging_statement(table_name))
+    copy_rows(cursor, "staging", columns, rows)
+    cursor.execute(upsert_statement(table_name, columns))
 
-    try:
-        message = f"Inserindo registro de ID={values[0]} na tabela `{table_name}`"
-        cursor.execute(''.join(query))
-        logger.info(message)
 
-        mydb.commit()
-    except dbError as err:
+def _execute_update_query(cursor: cursor, table_name: str, columns: list, updated_columns: list, rows: list):
+    """Update only `updated_columns` of existing rows, through a staging table.
+
+    Raises:
+        dbError: DB exception
+    """
+    cursor.execute(staging_statement(table_name))
+    copy_rows(cursor, "staging", columns, rows)
+    cursor.execute(update_statement(table_name, updated_columns))
+
+
+def _execute_touch_query(cursor: cursor, table_name: str, rows: list):
+    """Update only the `last_modified_on` of rows whose content did not change.
+
+    Raises:
+        dbError: DB exception
+    """
+    cursor.execute(touch_statement(table_name), ([row[RECORD_ID] for row in rows], [row[LAST_MODIFIED_ON] for row in rows]))
+
+
+def staging_statement(table_name: str) -> str:
+    """Creation of the `staging` table, dropped at the end of the transaction."""
+    return f"CREATE TEMP TABLE staging (LIKE tape.{table_name}) ON COMMIT DROP"
+
+
+def upsert_statement(table_name: str, columns: list) -> str:
+    """Merge of the `staging` table into the table, keeping the newest version of each record."""
+    column_list = ', '.join(f'"{column}"' for column in columns)
+    updates = ', '.join(f'"{column}" = excluded."{column}"' for column in columns if column != 'record_id')
+    return f"INSERT INTO tape.{table_name} AS stored ({column_list}) SELECT {column_list} FROM staging "\
+        f"ON CONFLICT (record_id) DO UPDATE SET {updates} "\
+        "WHERE excluded.last_modified_on > stored.last_modified_on"
+
+
+def touch_statement(table_name: str) -> str:
+    """Update of `last_modified_on`, taking the arrays of record IDs and of `last_modified_on`."""
+    return f"UPDATE tape.{table_name} AS stored SET last_modified_on = page.last_modified_on "\
+        "FROM unnest(%s::text[], %s::timestamp[]) AS page(record_id, last_modified_on) "\
+        "WHERE stored.record_id = page.record_id AND page.last_modified_on > stored.last_modified_on"
 
-        message = f"Aplicativo alterado. Excluindo a tabela `{table_name}`. {err}"
-        logger.info(message)
 
-        cursor.execute(f"DROP TABLE tape.{table_name}")
-        raise dbError('Tabela excluída com sucesso!') from err
+def update_statement(table_name: str, updated_columns: list) -> str:
+    """Update of `updated_columns` of the existing rows from the `staging` table."""
+    updates = ', '.join(f'"{column}" = staging."{column}"' for column in updated_columns)
+    return f"UPDATE tape.{table_name} AS stored SET {updates} FROM staging WHERE stored.record_id = staging.record_id"
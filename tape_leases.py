@@ -0,0 +1,217 @@
+"""Distribution of the apps among the replicas of the service sharing the same database.
+
+Each replica registers itself in `tape_sync.workers` and, at the start of
+each cycle, claims its share of the apps in `tape_sync.app_leases`. Leases
+are renewed by a heartbeat thread and expire when a replica dies, so that
+the others take its apps over on their next cycle. Whoever holds the lease,
+an app is only synchronized while its session advisory lock is held (see
+`app_lock`), so two replicas never write the same app at once.
+"""
+import atexit
+from contextlib import contextmanager
+import math
+from os import getenv, getpid
+import socket
+import threading
+
+from psycopg2 import Error as dbError
+from psycopg2._psycopg import cursor
+
+from get_mydb import borrow_db
+from tape_sync_state import ensure_sync_state_table
+from logging_tools import logger
+
+
+# Distribute the apps among replicas (`1`), instead of synchronizing all of them
+SHARDING = getenv('SHARDING', '0') == '1'
+# Name of this replica in the leases
+WORKER_ID = getenv('WORKER_ID') or f'{socket.gethostname()}-{getpid()}'
+# Seconds a lease lasts without being renewed
+LEASE_TTL = int(getenv('LEASE_TTL', '300'))
+
+# Keys of the advisory locks: per app while it is synchronized, per app for the DDL of its table, and the
+# global ones below, each in its own namespace so that no app ID collides with another lock
+APP_LOCK_NAMESPACE = 0x74617065
+DDL_LOCK_NAMESPACE = APP_LOCK_NAMESPACE + 1
+GLOBAL_LOCK_NAMESPACE = APP_LOCK_NAMESPACE + 2
+_SCHEMA_LOCK = 0
+_CLAIM_LOCK = 1
+
+TRY_LOCK_APP = f"SELECT pg_try_advisory_lock({APP_LOCK_NAMESPACE}, %s)"
+UNLOCK_APP = f"SELECT pg_advisory_unlock({APP_LOCK_NAMESPACE}, %s)"
+
+
+def lock_ddl(cursor: cursor, app_id: int):
+    """Serialize a DDL transaction on the table of an app among replicas, until it commits or rolls back."""
+    cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)", (DDL_LOCK_NAMESPACE, app_id))
+
+
+def _lock_global(cursor: cursor, key: int):
+    cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)", (GLOBAL_LOCK_NAMESPACE, key))
+
+
+def lock_schema(cursor: cursor):
+    """Serialize the creation of the shared schemas and tables among replicas, until commit."""
+    _lock_global(cursor, _SCHEMA_LOCK)
+
+
+@contextmanager
+def app_lock(mydb, cursor: cursor, app_id: int):
+    """Hold the session advisory lock of an app on the connection that writes it.
+
+    The lock is released when the block ends or, if the replica dies, with
+    its connection. Anything left uncommitted is rolled back on exit.
+
+    Yields:
+        bool: Whether the lock was acquired. If not, another replica is synchronizing the app
+    """
+    cursor.execute(TRY_LOCK_APP, (app_id,))
+    acquired = cursor.fetchone()[0]
+    mydb.commit()
+    try:
+        yield acquired
+    finally:
+        if acquired and not mydb.closed:
+            try:
+                mydb.rollback()
+                cursor.execute(UNLOCK_APP, (app_id,))
+                mydb.commit()
+            except dbError:
+                # A broken connection has already released its locks
+                pass
+
+
+def ensure_lease_tables(cursor: cursor):
+    """Create the tables of the replicas and leases and the `tape_sync.app_owners` status view.
+
+    The view lists, for each leased app, its replica, whether the lease is
+    alive, whether the app is being synchronized right now and its progress.
+    """
+    ensure_sync_state_table(cursor)
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS tape_sync.workers ("
+        "worker_id TEXT PRIMARY KEY NOT NULL"
+        ", started_at TIMESTAMP NOT NULL DEFAULT now()"
+        ", expires_at TIMESTAMP NOT NULL"
+        ")")
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS tape_sync.app_leases ("
+        "app_id BIGINT PRIMARY KEY NOT NULL"
+        ", worker_id TEXT NOT NULL"
+        ", acquired_at TIMESTAMP NOT NULL DEFAULT now()"
+        ", expires_at TIMESTAMP NOT NULL"
+        ")")
+    cursor.execute(
+        "CREATE OR REPLACE VIEW tape_sync.app_owners AS "
+        "SELECT lease.app_id, lease.worker_id, lease.acquired_at, lease.expires_at, lease.expires_at > now() AS alive, "
+        "EXISTS (SELECT 1 FROM pg_locks WHERE locktype = 'advisory' AND classid = "
+        f"{APP_LOCK_NAMESPACE}::bigint::oid AND objid = lease.app_id::oid AND granted) AS syncing, "
+        "state.high_water_mark, state.page_index, state.updated_at AS progress_at "
+        "FROM tape_sync.app_leases AS lease LEFT JOIN tape_sync.app_state AS state USING (app_id)")
+
+
+class LeaseManager:
+    """Leases of the apps synchronized by this replica."""
+
+    def __init__(self, worker_id: str = WORKER_ID, ttl: int = LEASE_TTL):
+        self.worker_id = worker_id
+        self.ttl = ttl
+        self._heartbeat = None
+        self._stop = threading.Event()
+
+    def claim(self, apps_ids: list) -> list:
+        """Renew and claim leases up to this replica's share of the apps, releasing the surplus.
+
+        The share is the number of apps divided by the number of live replicas.
+        Apps without a lease, or whose lease expired, are free to be claimed.
+
+        Returns:
+            list: The apps this replica synchronizes in the cycle
+        """
+        with borrow_db() as mydb:
+            cursor = mydb.cursor()
+            lock_schema(cursor)
+            ensure_lease_tables(cursor)
+            mydb.commit()
+
+            _lock_global(cursor, _CLAIM_LOCK)
+            ttl = f"now() + {self.ttl} * interval '1 second'"
+            cursor.execute(
+                f"INSERT INTO tape_sync.workers (worker_id, expires_at) VALUES (%s, {ttl}) "
+                "ON CONFLICT (worker_id) DO UPDATE SET expires_at = excluded.expires_at", (self.worker_id,))
+            cursor.execute("DELETE FROM tape_sync.workers WHERE expires_at < now()")
+            cursor.execute("SELECT count(*) FROM tape_sync.workers")
+            share = math.ceil(len(apps_ids) / cursor.fetchone()[0])
+
+            cursor.execute(
+                "SELECT app_id FROM tape_sync.app_leases WHERE worker_id = %s AND app_id = ANY(%s) ORDER BY app_id",
+                (self.worker_id, apps_ids))
+            owned = [app_id for app_id, in cursor.fetchall()]
+            released = owned[share:]
+            owned = owned[:share]
+            if released:
+                cursor.execute("DELETE FROM tape_sync.app_leases WHERE worker_id = %s AND app_id = ANY(%s)",
+                               (self.worker_id, released))
+
+            cursor.execute(
+                "SELECT app_id FROM unnest(%s::bigint[]) AS apps(app_id) "
+                "LEFT JOIN tape_sync.app_leases AS lease USING (app_id) "
+                "WHERE lease.app_id IS NULL OR lease.expires_at < now() ORDER BY app_id LIMIT %s",
+                (apps_ids, max(share - len(owned), 0)))
+            owned += [app_id for app_id, in cursor.fetchall()]
+
+            cursor.execute(
+                f"INSERT INTO tape_sync.app_leases (app_id, worker_id, expires_at) SELECT unnest(%s::bigint[]), %s, {ttl} "
+                "ON CONFLICT (app_id) DO UPDATE SET worker_id = excluded.worker_id, expires_at = excluded.expires_at, "
+                "acquired_at = CASE WHEN app_leases.worker_id = excluded.worker_id THEN app_leases.acquired_at ELSE now() END",
+                (owned, self.worker_id))
+            mydb.commit()
+
+        if released:
+            logger.info(f"Aplicativos {released} liberados para outras réplicas")
+        logger.info(f"Réplica `{self.worker_id}` sincronizando os aplicativos {sorted(owned)}")
+        self._start_heartbeat()
+        return sorted(owned)
+
+    def renew(self):
+        """Extend the registration of this replica and all its leases."""
+        ttl = f"now() + {self.ttl} * interval '1 second'"
+        with borrow_db() as mydb:
+            cursor = mydb.cursor()
+            cursor.execute(f"UPDATE tape_sync.workers SET expires_at = {ttl} WHERE worker_id = %s", (self.worker_id,))
+            cursor.execute(f"UPDATE tape_sync.app_leases SET expires_at = {ttl} WHERE worker_id = %s", (self.worker_id,))
+            mydb.commit()
+
+    def release(self):
+        """Give all leases up, e.g. when the replica stops."""
+        self._stop.set()
+        with borrow_db() as mydb:
+            cursor = mydb.cursor()
+            cursor.execute("DELETE FROM tape_sync.app_leases WHERE worker_id = %s", (self.worker_id,))
+            cursor.execute("DELETE FROM tape_sync.workers WHERE worker_id = %s", (self.worker_id,))
+            mydb.commit()
+
+    def _start_heartbeat(self):
+        if self._heartbeat is not None:
+            return
+
+        def beat():
+            while not self._stop.wait(self.ttl / 3):
+                try:
+                    self.renew()
+                except dbError as err:
+                    logger.warning(f"Erro na renovação das concessões de aplicativos. {err}")
+
+        self._heartbeat = threading.Thread(target=beat, name='lease-heartbeat', daemon=True)
+        self._heartbeat.start()
+        atexit.register(self.release)
+
+
+lease_manager = LeaseManager()
+
+
+def claim_apps(apps_ids: list) -> list:
+    """Apps to be synchronized by this replica in the cycle, all of them unless `SHARDING` is enabled."""
+    if not SHARDING:
+        return apps_ids
+    return lease_manager.claim(apps_ids)
@@ -0,0 +1,110 @@
+"""Cache of tape apps metadata and of the tables existing in the database."""
+from os import getenv
+import threading
+import time
+
+from pytape.client import Client
+from psycopg2._psycopg import cursor
+
+from tape_converters import RecordConverter, compile_record_converter
+from tape_rate_limit import scheduler
+
+
+class MetadataCache:
+    """TTL cache for app schemas, the workspace_id -> slug map and the `tape.*` tables.
+
+    Entries expire after `ttl` seconds or when explicitly invalidated, so
+    `create_tables` and `insert_records` share the same lookups in a cycle.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._apps = {}
+        self._converters = {}
+        self._workspaces = None
+        self._tables = None
+
+    def _is_fresh(self, entry) -> bool:
+        return entry is not None and time.monotonic() - entry[0] < self.ttl
+
+    def get_app(self, tape: Client, app_id: int) -> dict:
+        """Retrieve the app schema (`tape.App.find`)."""
+        with self._lock:
+            entry = self._apps.get(app_id)
+        if not self._is_fresh(entry):
+            # Fetched outside the lock so that workers of different apps do not wait for each other
+            entry = (time.monotonic(), scheduler.call(app_id, tape.App.find, app_id))
+            with self._lock:
+                self._apps[app_id] = entry
+        return entry[1]
+
+    def get_record_converter(self, tape: Client, app_id: int) -> RecordConverter:
+        """Retrieve the record converter of an app, compiled once per version of its schema."""
+        app_info = self.get_app(tape, app_id)
+        with self._lock:
+            entry = self._converters.get(app_id)
+            if entry is None or entry[0] is not app_info:
+                entry = (app_info, compile_record_converter(app_info))
+                self._converters[app_id] = entry
+            return entry[1]
+
+    def get_workspace_slugs(self, tape: Client) -> dict:
+        """Retrieve the map `workspace_id -> slug` of all workspaces of the organization."""
+        with self._lock:
+            entry = self._workspaces
+        if not self._is_fresh(entry):
+            # Fetched outside the lock, as in `get_app`, so that a slow request does not hold the other workers
+            workspaces = scheduler.call(None, tape.Workspace.get_all_for_org)
+            slugs = {workspace['workspace_id']: workspace['slug'] for workspace in workspaces['workspaces']}
+            entry = (time.monotonic(), slugs)
+            with self._lock:
+                self._workspaces = entry
+        return entry[1]
+
+    def get_tables(self, cursor: cursor) -> set:
+        """Retrieve the names of the tables in the `tape` schema."""
+        with self._lock:
+            entry = self._tables
+        if not self._is_fresh(entry):
+            cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = 'tape';")
+            entry = (time.monotonic(), {table for table, in cursor.fetchall()})
+            with self._lock:
+                self._tables = entry
+        return entry[1]
+
+    def get_table_name(self, tape: Client, app_id: int):
+        """Retrieve the app schema and the name of its table, `{workspace}__{app}`.
+
+        Returns:
+            tuple: `(app_info, table_name)`
+        """
+        app_info = self.get_app(tape, app_id)
+        workspace_slug = self.get_workspace_slugs(tape)[app_info.get('workspace_id')]
+        table_name = workspace_slug.replace('-', '_') + '__' + app_info['slug'].replace('-', '_')
+        return app_info, table_name
+
+    def add_table(self, table_name: str):
+        """Register a table just created."""
+        with self._lock:
+            if self._tables is not None:
+                self._tables[1].add(table_name)
+
+    def discard_table(self, table_name: str):
+        """Unregister a table just dropped."""
+        with self._lock:
+            if self._tables is not None:
+                self._tables[1].discard(table_name)
+
+    def invalidate(self, app_id: int = None):
+        """Invalidate the metadata of an app, or all cached metadata if no app is given."""
+        with self._lock:
+            if app_id is not None:
+                self._apps.pop(app_id, None)
+                return
+            self._apps.clear()
+            self._workspaces = None
+            self._tables = None
+
+
+metadata_cache = MetadataCache(float(getenv('METADATA_CACHE_TTL', '3600')))
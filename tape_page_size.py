@@ -0,0 +1,141 @@
+"""Adaptive size of the pages of records requested from Tape, and backoff of their retries."""
+import functools
+from os import getenv
+import random
+import threading
+import time
+
+from pytape.transport import TransportException
+
+from metrics import PAGE_SIZE
+
+
+# Bounds of the number of records requested per page
+PAGE_SIZE_MIN = int(getenv('PAGE_SIZE_MIN', '50'))
+PAGE_SIZE_MAX = int(getenv('PAGE_SIZE_MAX', '500'))
+# Seconds a page request should take: slower pages shrink the page size, pages twice as fast grow it
+PAGE_TARGET_SECONDS = float(getenv('PAGE_TARGET_SECONDS', '10'))
+# Consecutive fast pages before the page size grows
+PAGE_GROW_AFTER = int(getenv('PAGE_GROW_AFTER', '3'))
+# Retries of a page after a gateway error or a timeout, and base seconds of their exponential backoff
+PAGE_MAX_RETRIES = int(getenv('PAGE_MAX_RETRIES', '5'))
+PAGE_BACKOFF_SECONDS = float(getenv('PAGE_BACKOFF_SECONDS', '2'))
+
+_BACKOFF_MAX_SECONDS = 120
+# Weight of the last page in the moving average of the throughput of a page size
+_SMOOTHING = 0.3
+
+RETRYABLE_STATUSES = ('502', '503', '504')
+
+
+class PageSizer:
+    """Page size of each app, adapted to the latency of its page requests.
+
+    The page size is halved after a slow page or a failed request, and grows
+    by half after `grow_after` consecutive fast full pages. The throughput of
+    each page size is kept as a moving average, reset by failed requests, so
+    that an app starts its next pass at the page size with the best
+    throughput seen.
+    """
+
+    def __init__(self, minimum: int, maximum: int, target_seconds: float, grow_after: int):
+        self.minimum = max(minimum, 1)
+        self.maximum = max(maximum, self.minimum)
+        self.target_seconds = target_seconds
+        self.grow_after = grow_after
+        self._lock = threading.Lock()
+        self._sizes = {}
+        self._fast_pages = {}
+        self._throughput = {}
+
+    def start_pass(self, app_id: int, page_size: int = None):
+        """Start a pass of an app at the page size with the best throughput seen.
+
+        Args:
+            page_size (int): Best page size persisted by a previous run, used until this run measured one
+        """
+        with self._lock:
+            self._fast_pages[app_id] = 0
+            self._set(app_id, self._best(app_id) or page_size or self._sizes.get(app_id, self.maximum))
+
+    def size(self, app_id: int, limit: int = None) -> int:
+        """Page size of the next request of an app, capped by the `limit` asked by the caller."""
+        with self._lock:
+            if app_id not in self._sizes:
+                self._set(app_id, self.maximum)
+            return min(self._sizes[app_id], limit or self.maximum)
+
+    def observe(self, app_id: int, size: int, seconds: float, records: int):
+        """Adapt the page size of an app to the latency of a page of `size` records."""
+        with self._lock:
+            if records and seconds > 0:
+                throughput = self._throughput.setdefault(app_id, {})
+                previous = throughput.get(size)
+                current = records / seconds
+                throughput[size] = current if previous is None else previous + _SMOOTHING * (current - previous)
+
+            if seconds > self.target_seconds:
+                self._fast_pages[app_id] = 0
+                self._set(app_id, self._sizes.get(app_id, size) // 2)
+            elif seconds < self.target_seconds / 2 and records >= size:
+                # Only full pages tell that more records would fit
+                self._fast_pages[app_id] = self._fast_pages.get(app_id, 0) + 1
+                if self._fast_pages[app_id] >= self.grow_after:
+                    self._fast_pages[app_id] = 0
+                    current = self._sizes.get(app_id, size)
+                    self._set(app_id, current + max(current // 2, 1))
+
+    def failed(self, app_id: int, size: int):
+        """Shrink the page size of an app after a request of `size` records failed."""
+        with self._lock:
+            self._fast_pages[app_id] = 0
+            self._throughput.setdefault(app_id, {})[size] = 0
+            self._set(app_id, min(self._sizes.get(app_id, size), size) // 2)
+
+    def best(self, app_id: int) -> int:
+        """Page size with the best throughput seen for an app, or its current one."""
+        with self._lock:
+            return self._best(app_id) or self._sizes.get(app_id, self.maximum)
+
+    def _best(self, app_id: int):
+        throughput = self._throughput.get(app_id)
+        if throughput and max(throughput.values()) > 0:
+            return max(throughput, key=throughput.get)
+        return None
+
+    def _set(self, app_id: int, size: int):
+        self._sizes[app_id] = min(max(size, self.minimum), self.maximum)
+        PAGE_SIZE.set(self._sizes[app_id], app_id=app_id)
+
+
+def timed(function):
+    """Wrap a request to also return the seconds it took, without the wait for the rate limit around it."""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.monotonic()
+        result = function(*args, **kwargs)
+        return result, time.monotonic() - start
+    return wrapper
+
+
+def atimed(function):
+    """Wrap a coroutine function sending a request, as `timed`."""
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        start = time.monotonic()
+        result = await function(*args, **kwargs)
+        return result, time.monotonic() - start
+    return wrapper
+
+
+def is_retryable(err: TransportException) -> bool:
+    """Tell whether a failed page request may succeed later, e.g. after a gateway timeout."""
+    return err.status.get('status') in RETRYABLE_STATUSES
+
+
+def backoff_seconds(attempt: int, base: float = PAGE_BACKOFF_SECONDS) -> float:
+    """Seconds to wait before retry number `attempt`, from 0: exponential, with full jitter."""
+    return random.uniform(0, min(_BACKOFF_MAX_SECONDS, base * 2 ** attempt))
+
+
+page_sizer = PageSizer(PAGE_SIZE_MIN, PAGE_SIZE_MAX, PAGE_TARGET_SECONDS, PAGE_GROW_AFTER)
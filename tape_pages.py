@@ -0,0 +1,151 @@
+"""Paging over the records of a tape app."""
+from os import getenv
+import queue
+import threading
+import time
+
+from pytape.client import Client
+from pytape.transport import TransportException
+
+from metrics import PAGE_RETRIES, PAGE_SECONDS, RECORDS_FETCHED
+from tape_converters import RecordConverter
+from tape_page_size import PAGE_MAX_RETRIES, backoff_seconds, is_retryable, page_sizer, timed
+from tape_rate_limit import RequestCancelled, scheduler
+from tape_stream import TAPE_STREAMING, get_record_rows
+from logging_tools import logger
+
+
+# Maximum number of pages fetched ahead of the one being written (0 disables prefetching)
+PREFETCH_DEPTH = int(getenv('PREFETCH_DEPTH', '2'))
+# Longest wait for the prefetching thread to stop once its pages are no longer needed
+PREFETCH_JOIN_SECONDS = float(getenv('PREFETCH_JOIN_SECONDS', '5'))
+
+_DONE = object()
+
+
+def iter_pages(tape: Client, app_id: int, args: dict, converter: RecordConverter, is_last=None):
+    """Request the pages of records of an app, following the pagination cursor.
+
+    Records are converted into rows as pages arrive, incrementally when
+    `TAPE_STREAMING` is set (see `tape_stream`).
+
+    Args:
+        tape (Client): tape client
+        app_id (int): tape app ID
+        args (dict): Arguments of `tape.App.get_records`, e.g. `limit` and `cursor`. The
+            page size adapts to the latency of the app, up to `limit` (see `tape_page_size`)
+        converter (RecordConverter): converter of the records into rows
+        is_last (callable): Optional predicate telling, from a page, that no more pages are needed
+
+    Yields:
+        dict: The pages, with the `rows`, the `cursor` of the next page and the `total` of records of the app
+    """
+    args = dict(args)
+    limit = args.get('limit')
+    while True:
+        page = _fetch_page(tape, app_id, args, converter, limit)
+        RECORDS_FETCHED.inc(len(page['rows']), app_id=app_id)
+        yield page
+
+        if not page.get('cursor') or not page['rows'] or (is_last and is_last(page)):
+            return
+        args['cursor'] = page['cursor']
+
+
+def _fetch_page(tape: Client, app_id: int, args: dict, converter: RecordConverter, limit: int = None) -> dict:
+    """Request a page with the adaptive page size of the app, retrying gateway errors with backoff.
+
+    Args:
+        limit (int): Largest page size accepted by the caller
+
+    Raises:
+        TransportException: tape transport error exception, once the retries are exhausted
+    """
+    for attempt in range(PAGE_MAX_RETRIES + 1):
+        args['limit'] = page_sizer.size(app_id, limit)
+        try:
+            with PAGE_SECONDS.time(app_id=app_id):
+                # Only the request itself tells the latency of Tape, not the wait for the rate limit
+                if TAPE_STREAMING:
+                    page, seconds = scheduler.call(app_id, timed(get_record_rows), app_id, converter, **args)
+                else:
+                    response, seconds = scheduler.call(app_id, timed(tape.App.get_records), app_id, **args)
+                    page = {'rows': converter.convert_page(response['records']), 'cursor': response.get('cursor'),
+                            'total': response.get('total')}
+                    del response
+        except TransportException as err:
+            if attempt == PAGE_MAX_RETRIES or not is_retryable(err):
+                raise
+            page_sizer.failed(app_id, args['limit'])
+            PAGE_RETRIES.inc(app_id=app_id, status=err.status.get('status'))
+            wait = backoff_seconds(attempt)
+            logger.warning(f"Página do aplicativo {app_id} falhou (HTTP {err.status.get('status')}). "
+                           f"Tentando novamente com {page_sizer.size(app_id, limit)} registros em {wait:.1f}s")
+            time.sleep(wait)
+            continue
+        page_sizer.observe(app_id, args['limit'], seconds, len(page['rows']))
+        return page
+
+
+def prefetch(pages, depth: int = PREFETCH_DEPTH):
+    """Consume `pages` in a background thread, keeping up to `depth` pages ready.
+
+    While the caller writes a page to the database, the next ones are already
+    being requested from Tape. Errors raised while fetching are re-raised to the
+    caller. Once the caller stops iterating, the producer gives up its wait
+    for the rate limit (see `RateLimitScheduler.cancel_on`) and is waited for
+    `PREFETCH_JOIN_SECONDS` at most: a request already sent is left to finish
+    in the background, and its page is dropped.
+
+    Args:
+        pages (iterator): Pages to be fetched, e.g. from `iter_pages`
+        depth (int): Size of the bounded queue between fetching and writing
+
+    Yields:
+        dict: The same pages, in the same order
+    """
+    if depth <= 0:
+        yield from pages
+        return
+
+    buffer = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            with scheduler.cancel_on(stop):
+                for page in pages:
+                    if not put((page, None)):
+                        return
+        except RequestCancelled:
+            return
+        except Exception as err:
+            put((_DONE, err))
+        else:
+            put((_DONE, None))
+
+    producer = threading.Thread(target=produce, name=f'{threading.current_thread().name}-prefetch', daemon=True)
+    producer.start()
+    try:
+        while True:
+            page, err = buffer.get()
+            if err is not None:
+                raise err
+            if page is _DONE:
+                return
+            yield page
+    finally:
+        stop.set()
+        producer.join(timeout=PREFETCH_JOIN_SECONDS)
+        if producer.is_alive():
+            logger.warning(f"Busca antecipada de páginas ({producer.name}) ainda em andamento. "
+                           "A página será descartada ao chegar.")
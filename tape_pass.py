@@ -0,0 +1,190 @@
+"""Control flow of a synchronization pass of an app, shared by the threaded and the asyncio engines.
+
+Each engine provides the I/O of a pass as `PassSteps`: reading the state,
+requesting pages, writing them and so on. `run_pass` decides what is read
+and in which order, so that both engines resume, restart and checkpoint
+the same way.
+"""
+import abc
+import datetime
+import time
+
+from pytape.transport import TransportException
+
+from metrics import LAST_SYNC, PEAK_RSS, RECORDS_SKIPPED, RECORDS_WRITTEN, current_rss_bytes
+from tape_converters import LAST_MODIFIED_ON, RECORD_ID, RecordConverter
+from tape_page_size import page_sizer
+from tape_rate_limit import scheduler
+from tape_schema import is_data_error
+from tape_sinks import open_sinks, sinks_stale
+from tape_tools import is_stale_cursor_error
+
+from logging_tools import logger
+
+
+def parse_timestamp(value: str) -> datetime.datetime:
+    """Parse a Tape timestamp such as `last_modified_on`."""
+    return datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+
+
+class PassSteps(abc.ABC):
+    """I/O of a pass of an app with a given engine.
+
+    The methods are coroutines, so that the asyncio engine awaits its
+    requests and queries, while the threaded engine simply blocks in them.
+    """
+
+    @abc.abstractmethod
+    async def load_state(self) -> dict:
+        """Synchronization state of the app, see `tape_sync_state.get_sync_state`."""
+
+    @abc.abstractmethod
+    async def refresh(self) -> bool:
+        """Rebuild the table in a shadow table, see `tape_refresh`.
+
+        Returns:
+            bool: Whether the table was rebuilt, otherwise the refresh is retried after a backoff
+        """
+
+    @abc.abstractmethod
+    async def backfill(self, columns: list):
+        """Fill the columns added to the table, then clear them from the state."""
+
+    @abc.abstractmethod
+    def pages(self, args: dict, is_last):
+        """Asynchronous iterator of the pages of records, requested ahead of the writes."""
+
+    @abc.abstractmethod
+    async def write(self, rows: list, checkpoint: tuple) -> int:
+        """Write a page of rows and save `checkpoint`, `(cursor, pass high-water mark, page index)`, together.
+
+        Returns:
+            int: Number of rows written
+        """
+
+    @abc.abstractmethod
+    async def skip_page(self, checkpoint: tuple):
+        """Save `checkpoint` alone, after the write of its page failed and was rolled back."""
+
+    @abc.abstractmethod
+    async def discard_checkpoint(self):
+        """Forget the checkpoint of the pass, see `tape_sync_state.discard_checkpoint`."""
+
+    @abc.abstractmethod
+    async def finish(self, page_size: int):
+        """Record the pass as finished and the page size to start the next one with."""
+
+    @abc.abstractmethod
+    async def run_blocking(self, function, *args):
+        """Call a blocking function, e.g. a write of the sinks."""
+
+
+async def run_pass(steps: PassSteps, app_id: int, table_name: str, converter: RecordConverter):
+    """Insert records from tape in the database, one transaction per page.
+
+    Records are requested newest first and paging stops at the first record
+    that is not newer than the app's high-water mark, so unchanged apps cost
+    a single request. The next pages are requested while the current one is written.
+
+    Each committed page checkpoints the pass, which resumes from the next page
+    after a Tape error or a restart. A checkpoint whose cursor Tape no longer
+    accepts is discarded and the pass starts over from the first page. A page
+    rejected for its values (see `tape_schema.is_data_error`) is logged and
+    skipped; its records are written again once they change in Tape or with
+    a full resynchronization.
+
+    Raises:
+        TransportException: tape transport error exception
+    """
+    start = time.monotonic()
+
+    state = await steps.load_state()
+    high_water_mark = None if state['full_resync'] else state['high_water_mark']
+    pass_high_water_mark = state['pass_high_water_mark']
+    page_index = state['page_index'] or 0
+    scheduler.set_priority(app_id, high_water_mark)
+    page_sizer.start_pass(app_id, state['page_size'])
+
+    if state['refresh'] and await steps.refresh():
+        return
+
+    args = {"limit": 500, "sort_by": "last_modified_on", "sort_desc": True}
+    if state['cursor']:
+        args['cursor'] = state['cursor']
+        logger.info(f"Retomando a sincronização da tabela `{table_name}` a partir da página {page_index + 1}")
+
+    def is_last(page):
+        # Records come newest first, so the page ends below the high-water mark only once
+        rows = page['rows']
+        return high_water_mark is not None and parse_timestamp(rows[-1][LAST_MODIFIED_ON]) < high_water_mark
+
+    if state['backfill_columns']:
+        await steps.backfill(state['backfill_columns'])
+
+    if (high_water_mark is not None or 'cursor' in args) and await steps.run_blocking(sinks_stale, table_name, converter):
+        # A sink missed rows or columns, e.g. after a failed write or a schema change: every record is read again
+        logger.info(f"Exportação da tabela `{table_name}` desatualizada. Lendo todos os registros.")
+        high_water_mark = pass_high_water_mark = None
+        page_index = 0
+        args.pop('cursor', None)
+
+    rows_counter = 0
+    peak_rss = current_rss_bytes()
+    # Page index of the checkpoint being resumed, until a page is committed
+    resumed_index = page_index if 'cursor' in args else None
+    sinks = open_sinks(app_id, table_name, converter, full=high_water_mark is None and resumed_index is None)
+    restart = False
+    pages = steps.pages(args, is_last)
+    try:
+        async for page in pages:
+            rows = page['rows']
+
+            if rows and pass_high_water_mark is None:
+                pass_high_water_mark = parse_timestamp(rows[0][LAST_MODIFIED_ON])
+
+            fresh = [row for row in rows
+                     if high_water_mark is None or parse_timestamp(row[LAST_MODIFIED_ON]) >= high_water_mark]
+            page_index += 1
+            checkpoint = (page.get('cursor'), pass_high_water_mark, page_index)
+            try:
+                written = await steps.write(fresh, checkpoint)
+            except Exception as err:
+                if not is_data_error(err):
+                    raise
+                # The same values would fail every retry, and a schema change or a refresh would not help
+                logger.error(f"Página {page_index} da tabela `{table_name}` recusada pelo BD e ignorada. "
+                             f"Registros: {[row[RECORD_ID] for row in fresh]}. {err}")
+                await steps.skip_page(checkpoint)
+                written, fresh = 0, []
+            await steps.run_blocking(sinks.write, fresh)
+            rows_counter += written
+            RECORDS_WRITTEN.inc(written, app_id=app_id)
+            RECORDS_SKIPPED.inc(len(rows) - written, app_id=app_id)
+            peak_rss = max(peak_rss, current_rss_bytes())
+
+    except TransportException as err:
+        await steps.run_blocking(sinks.close, False)
+        if page_index != resumed_index or not is_stale_cursor_error(err):
+            raise
+        restart = True
+    except BaseException:
+        await steps.run_blocking(sinks.close, False)
+        raise
+    finally:
+        # Stops the requests of the pages ahead
+        await pages.aclose()
+
+    if restart:
+        logger.warning(f"Checkpoint da tabela `{table_name}` recusado pelo Tape. Reiniciando pela primeira página.")
+        await steps.discard_checkpoint()
+        return await run_pass(steps, app_id, table_name, converter)
+
+    await steps.finish(page_sizer.best(app_id))
+    await steps.run_blocking(sinks.close, True)
+    LAST_SYNC.set(time.time(), app_id=app_id)
+    PEAK_RSS.set(peak_rss, app_id=app_id)
+
+    elapsed = time.monotonic() - start
+    message = f"{rows_counter} registros gravados na tabela `{table_name}` em {elapsed:.1f}s "\
+        f"({rows_counter / elapsed if elapsed else 0:.0f} registros/s, pico de memória {peak_rss / 2 ** 20:.0f} MB)"
+    logger.info(message)
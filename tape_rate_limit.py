@@ -0,0 +1,267 @@
+"""Scheduler of Tape API requests, paced by the hourly rate limit."""
+import asyncio
+import contextlib
+import datetime
+import heapq
+import itertools
+from os import getenv
+import threading
+import time
+
+from pytape.transport import TransportException
+
+from metrics import RATE_LIMIT_REMAINING, TAPE_ERRORS, TAPE_REQUEST_SECONDS, TAPE_REQUESTS
+from tape_tools import handling_tape_error
+from logging_tools import logger
+
+
+# Requests allowed by Tape per hour and per API key
+TAPE_RATE_LIMIT_PER_HOUR = int(getenv('TAPE_RATE_LIMIT_PER_HOUR', '1000'))
+# Requests that may be sent in a burst, before pacing kicks in
+TAPE_RATE_LIMIT_BURST = int(getenv('TAPE_RATE_LIMIT_BURST', '50'))
+# Requests kept unused so that the quota never reaches zero
+TAPE_RATE_LIMIT_RESERVE = int(getenv('TAPE_RATE_LIMIT_RESERVE', '5'))
+
+# Longest sleep of a coroutine, or of a cancellable thread, waiting for its turn before it checks again
+_POLL_SECONDS = 1.0
+
+
+class RequestCancelled(Exception):
+    """A request gave its turn up while waiting for it, see `RateLimitScheduler.cancel_on`."""
+
+
+class RateLimitScheduler:
+    """Token bucket shared by every Tape call of the process.
+
+    Tokens are refilled at `limit_per_hour / 3600` per second. The quota and
+    reset time reported by Tape in the `x-rate-limit-*` headers take
+    precedence: when the remaining quota reaches the reserve, requests wait
+    until the reset time instead of failing. Waiting requests are served
+    first to the apps furthest behind, i.e. with the oldest high-water mark.
+    The quota reported by Tape is forgotten once its reset time passes, until
+    the next response reports the new one.
+
+    The pacing is per process: replicas sharing an API key (see `tape_leases`)
+    each pace their own requests, so `TAPE_RATE_LIMIT_PER_HOUR` should be
+    divided among them, while the headers of Tape still stop each replica
+    at the reserve of the shared quota.
+    """
+
+    def __init__(self, limit_per_hour: int, burst: int, reserve: int):
+        self.rate = max(limit_per_hour - reserve, 1) / 3600
+        self.capacity = max(burst, 1)
+        self.reserve = reserve
+        self.tokens = float(self.capacity)
+        self.remaining = None
+        self.reset_at = None
+        self._refilled_at = time.monotonic()
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._priorities = {}
+        self._local = threading.local()
+
+    def set_priority(self, app_id: int, high_water_mark: datetime.datetime = None):
+        """Rank an app by how far behind it is. Apps never synchronized come first."""
+        with self._cond:
+            self._priorities[app_id] = high_water_mark.timestamp() if high_water_mark else 0.0
+
+    def observe(self, headers: dict):
+        """Update the quota from the `x-rate-limit-remaining` and `x-rate-limit-reset` headers."""
+        with self._cond:
+            # A quota left from the previous period must not keep its expired reset time
+            self._expire()
+            if headers.get('x-rate-limit-remaining') is not None:
+                self.remaining = int(headers['x-rate-limit-remaining'])
+            if headers.get('x-rate-limit-reset') is not None:
+                reset = float(headers['x-rate-limit-reset'])
+                # Either an epoch timestamp or the seconds left until the reset
+                self.reset_at = reset if reset > 1e9 else time.time() + reset
+            if self.remaining is not None and self.reset_at is None:
+                # The quota is renewed every hour
+                self.reset_at = time.time() + 3600
+            if self.remaining is not None:
+                RATE_LIMIT_REMAINING.set(self.remaining)
+            self._cond.notify_all()
+
+    def seconds_until_reset(self) -> float:
+        """Seconds until Tape resets the quota, zero once it was reset, or one hour when it is not known."""
+        with self._cond:
+            if self.reset_at is None:
+                return 3600
+            seconds = max(self.reset_at - time.time(), 0)
+            self._expire()
+            return seconds
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+        self._expire()
+
+    def _expire(self):
+        """Forget the quota reported by Tape once its reset time passed. The caller holds the lock."""
+        if self.reset_at is not None and time.time() >= self.reset_at:
+            # The quota was renewed, so the remaining count reported before no longer applies
+            self.remaining = None
+            self.reset_at = None
+
+    def _delay(self) -> float:
+        """Seconds to wait before the next request may be sent."""
+        if self.remaining is not None and self.remaining <= self.reserve:
+            return self.reset_at - time.time()
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        return 0
+
+    @contextlib.contextmanager
+    def cancel_on(self, event: threading.Event):
+        """Give up the turns the current thread waits for once `event` is set.
+
+        Inside the block, `acquire` checks `event` at least every `_POLL_SECONDS`
+        and raises `RequestCancelled` when it is set, e.g. so that a prefetching
+        thread whose pages are no longer needed does not wait for the quota.
+        """
+        self._local.cancel = event
+        try:
+            yield
+        finally:
+            self._local.cancel = None
+
+    def acquire(self, app_id: int = None):
+        """Block until a request of `app_id` may be sent.
+
+        Raises:
+            RequestCancelled: the event of `cancel_on` was set while waiting
+        """
+        cancel = getattr(self._local, 'cancel', None)
+        with self._cond:
+            ticket = self._enqueue(app_id)
+            paused = False
+            while True:
+                self._refill()
+                delay = self._delay()
+                if self._waiting[0] == ticket and delay <= 0:
+                    break
+                if cancel is not None and cancel.is_set():
+                    self._give_up(ticket)
+                    raise RequestCancelled()
+                if delay > 60 and not paused:
+                    paused = True
+                    self._warn_pause(delay)
+                timeout = min(delay, 60) if delay > 0 else None
+                if cancel is not None:
+                    timeout = min(timeout or _POLL_SECONDS, _POLL_SECONDS)
+                self._cond.wait(timeout=timeout)
+            self._take()
+
+    async def aacquire(self, app_id: int = None):
+        """Wait until a request of `app_id` may be sent, as `acquire`, without blocking a thread.
+
+        The delay is computed under the lock and awaited with `asyncio.sleep`,
+        polling every `_POLL_SECONDS` at most, since the condition
+        notifying the threads cannot wake a coroutine.
+        """
+        with self._cond:
+            ticket = self._enqueue(app_id)
+        paused = False
+        try:
+            while True:
+                with self._cond:
+                    self._refill()
+                    delay = self._delay()
+                    if self._waiting[0] == ticket and delay <= 0:
+                        self._take()
+                        return
+                if delay > 60 and not paused:
+                    paused = True
+                    self._warn_pause(delay)
+                await asyncio.sleep(min(max(delay, 0.01), _POLL_SECONDS))
+        except BaseException:
+            # A cancelled request gives its turn up
+            with self._cond:
+                self._give_up(ticket)
+            raise
+
+    def _enqueue(self, app_id: int) -> tuple:
+        ticket = (self._priorities.get(app_id, float('inf')), next(self._sequence))
+        heapq.heappush(self._waiting, ticket)
+        return ticket
+
+    def _give_up(self, ticket: tuple):
+        """Remove a waiting request that will not be sent. The caller holds the lock."""
+        if ticket in self._waiting:
+            self._waiting.remove(ticket)
+            heapq.heapify(self._waiting)
+        self._cond.notify_all()
+
+    def _take(self):
+        """Give the first waiting request its turn. The caller holds the lock."""
+        heapq.heappop(self._waiting)
+        self.tokens -= 1
+        if self.remaining is not None:
+            self.remaining -= 1
+            RATE_LIMIT_REMAINING.set(self.remaining)
+        self._cond.notify_all()
+
+    @staticmethod
+    def _warn_pause(delay: float):
+        message = f"Limite de requisições ao Tape quase atingido. Aguardando {delay:.0f}s pela renovação."
+        logger.warning(message)
+
+    def call(self, app_id, function, *args, **kwargs):
+        """Send a Tape request through the scheduler.
+
+        When Tape still answers that the limit was reached, the request
+        waits for the reset time reported by Tape and is retried once.
+
+        Args:
+            app_id (int): tape app ID the request belongs to, or `None`
+            function (callable): tape client method, e.g. `tape.App.get_records`
+
+        Raises:
+            TransportException: tape transport error exception
+        """
+        method = getattr(function, '__name__', str(function))
+        for attempt in range(2):
+            self.acquire(app_id)
+            TAPE_REQUESTS.inc(app_id=app_id, method=method)
+            try:
+                with TAPE_REQUEST_SECONDS.time(method=method):
+                    return function(*args, **kwargs)
+            except TransportException as err:
+                TAPE_ERRORS.inc(method=method, status=err.status.get('status'))
+                self.observe(err.status)
+                if attempt or handling_tape_error(err) != 'rate_limit':
+                    raise
+                self.observe({'x-rate-limit-remaining': '0'})
+
+    async def acall(self, app_id, function, *args, **kwargs):
+        """Await a Tape request through the scheduler, with the same pacing and retry as `call`.
+
+        Blocking and asynchronous requests share the same quota and
+        priorities, and the wait for a turn holds no thread (see `aacquire`).
+
+        Args:
+            app_id (int): tape app ID the request belongs to, or `None`
+            function (callable): coroutine function sending the request
+
+        Raises:
+            TransportException: tape transport error exception
+        """
+        method = getattr(function, '__name__', str(function))
+        for attempt in range(2):
+            await self.aacquire(app_id)
+            TAPE_REQUESTS.inc(app_id=app_id, method=method)
+            try:
+                with TAPE_REQUEST_SECONDS.time(method=method):
+                    return await function(*args, **kwargs)
+            except TransportException as err:
+                TAPE_ERRORS.inc(method=method, status=err.status.get('status'))
+                self.observe(err.status)
+                if attempt or handling_tape_error(err) != 'rate_limit':
+                    raise
+                self.observe({'x-rate-limit-remaining': '0'})
+
+
+scheduler = RateLimitScheduler(TAPE_RATE_LIMIT_PER_HOUR, TAPE_RATE_LIMIT_BURST, TAPE_RATE_LIMIT_RESERVE)
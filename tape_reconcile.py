@@ -0,0 +1,185 @@
+"""Detection and removal of the records deleted in Tape."""
+from array import array
+from hashlib import md5
+from os import getenv
+
+from pytape.client import Client
+from pytape.transport import TransportException
+
+from psycopg2 import Error as dbError
+from psycopg2._psycopg import cursor
+
+from get_mydb import borrow_db
+from metrics import RECORDS_DELETED
+from tape_converters import CREATED_ON, RECORD_ID, RecordConverter
+from tape_leases import app_lock
+from tape_metadata_cache import metadata_cache
+from tape_pages import iter_pages, prefetch
+from tape_rate_limit import scheduler
+from tape_sinks import open_sinks
+from tape_sync_state import apps_due_for_reconciliation, finish_reconciliation
+from tape_workers import run_for_apps
+
+from logging_tools import log_records, logger
+
+
+# Minimum period in seconds between two reconciliations of an app (`0` disables them)
+RECONCILE_OFFSET = int(getenv('RECONCILE_OFFSET', '604800'))
+# Number of buckets the record IDs are hashed into
+RECONCILE_BUCKETS = int(getenv('RECONCILE_BUCKETS', '1024'))
+
+# Bucket and digest of a record ID, computed by PostgreSQL exactly as `_hash` does
+_BUCKET_SQL = "(get_byte(decode(md5(record_id), 'hex'), 14) * 256 + get_byte(decode(md5(record_id), 'hex'), 15)) %% %s"
+_DIGEST_SQL = "('x' || substr(md5(record_id), 1, 16))::bit(64)::bigint"
+
+
+def _hash(record_id: str, buckets: int):
+    """Bucket and 64-bit signed digest of a record ID."""
+    digest = md5(record_id.encode()).digest()
+    return int.from_bytes(digest[14:16], 'big') % buckets, int.from_bytes(digest[:8], 'big', signed=True)
+
+
+def reconcile_records(tape: Client, apps_ids: list) -> int:
+    """Delete from the database the records deleted in Tape, for the apps due for reconciliation.
+
+    Args:
+        tape (Client): tape client
+        apps_ids (list): List of tape apps IDs
+
+    Returns:
+        int: Code to handle the main loop, as in `insert_records`
+    """
+    if RECONCILE_OFFSET <= 0:
+        return 0
+    with borrow_db() as mydb:
+        due = apps_due_for_reconciliation(mydb.cursor(), apps_ids, RECONCILE_OFFSET)
+    if not due:
+        return 0
+    return run_for_apps(tape, due, _reconcile_app)
+
+
+def _reconcile_app(tape: Client, app_id: int) -> int:
+    """Reconcile the table of an app with the record IDs listed by Tape.
+
+    The IDs are listed oldest first, so that records created meanwhile are
+    appended to the listing, and hashed into buckets, each summarized by its
+    count and the sum of the digests of its IDs. Only the 8-byte digests are
+    kept. The database computes the same summaries in a single query, and
+    only the IDs of the buckets that differ are read from the table.
+
+    Nothing is deleted if the number of records in Tape changed during the
+    listing, or differs from the number listed, since records may have been
+    skipped. A database connection and the lock of the app are only held to
+    compare the table and delete the stale rows.
+
+    Returns:
+        int: Code to handle the main loop, as in `insert_records`
+    """
+    try:
+        _, table_name = metadata_cache.get_table_name(tape, app_id)
+        with borrow_db() as mydb:
+            if table_name not in metadata_cache.get_tables(mydb.cursor()):
+                return 0
+
+        tape_summaries, tape_digests, total, newest = _list_records(tape, app_id)
+        total_after = scheduler.call(app_id, tape.App.get_records, app_id, limit=1).get('total')
+        listed = sum(count for count, _ in tape_summaries.values())
+        if total is None or not total == total_after == listed:
+            message = f"Registros do aplicativo {app_id} alterados durante a listagem ({total} antes, {total_after} "\
+                f"depois, {listed} listados). Reconciliação da tabela `{table_name}` adiada."
+            logger.warning(message)
+            return 0
+
+        with borrow_db() as mydb:
+            cursor = mydb.cursor()
+            with app_lock(mydb, cursor, app_id) as locked:
+                if not locked:
+                    return 0
+                try:
+                    stale = _delete_stale_records(cursor, table_name, tape_summaries, tape_digests, newest)
+                    finish_reconciliation(cursor, app_id)
+                    mydb.commit()
+                except dbError as err:
+                    mydb.rollback()
+                    logger.error(f"Erro na reconciliação da tabela `{table_name}`. {err}")
+                    return 0
+
+        if stale:
+            sinks = open_sinks(app_id, table_name, metadata_cache.get_record_converter(tape, app_id), full=False)
+            sinks.delete(stale)
+            sinks.close(complete=True)
+
+    except TransportException as err:
+        logger.error(f"Erro no acesso ao Tape. {err}")
+        return 1
+
+    RECORDS_DELETED.inc(len(stale), app_id=app_id)
+    message = f"Reconciliação da tabela `{table_name}` concluída. {len(stale)} registros excluídos no tape removidos"
+    logger.info(message)
+    return 0
+
+
+def _list_records(tape: Client, app_id: int):
+    """List the record IDs of an app, oldest first, as bucket summaries and digests.
+
+    Returns:
+        tuple: `(summaries, digests, total, newest)`, the `(count, sum of
+        digests)` and the array of digests of each bucket, the number of
+        records reported by Tape on the first page and the newest
+        `created_on` listed
+
+    Raises:
+        TransportException: tape transport error exception
+    """
+    summaries, digests = {}, {}
+    total = newest = None
+    # Only the record IDs are needed, so no field is converted
+    args = {"limit": 500, "sort_by": "created_on", "sort_desc": False}
+    for page in prefetch(iter_pages(tape, app_id, args, RecordConverter([]))):
+        if total is None:
+            total = page.get('total')
+        for row in page['rows']:
+            bucket, digest = _hash(row[RECORD_ID], RECONCILE_BUCKETS)
+            digests.setdefault(bucket, array('q')).append(digest)
+            count, sum_digests = summaries.get(bucket, (0, 0))
+            summaries[bucket] = (count + 1, sum_digests + digest)
+            if newest is None or row[CREATED_ON] > newest:
+                newest = row[CREATED_ON]
+    return summaries, digests, total, newest
+
+
+def _delete_stale_records(cursor: cursor, table_name: str, tape_summaries: dict, tape_digests: dict, newest: str) -> list:
+    """Delete the rows whose IDs Tape no longer lists. The caller commits the transaction.
+
+    Rows created after the newest record listed are left alone, e.g. records
+    created after the listing and already written by a webhook.
+
+    Returns:
+        list: IDs of the rows deleted
+    """
+    if not tape_summaries:
+        # An app emptied in Tape is far less likely than a listing gone wrong
+        logger.warning(f"Nenhum registro listado pelo Tape para a tabela `{table_name}`. Reconciliação ignorada.")
+        return []
+
+    cursor.execute(
+        f"SELECT {_BUCKET_SQL} AS bucket, count(*), sum({_DIGEST_SQL}) FROM tape.{table_name} "
+        "WHERE created_on <= %s GROUP BY bucket", (RECONCILE_BUCKETS, newest))
+    db_summaries = {bucket: (count, int(total)) for bucket, count, total in cursor.fetchall()}
+
+    differing = [bucket for bucket, summary in db_summaries.items() if tape_summaries.get(bucket) != summary]
+    if not differing:
+        return []
+
+    listed = {bucket: set(tape_digests.get(bucket, ())) for bucket in differing}
+    cursor.execute(f"SELECT record_id FROM tape.{table_name} WHERE {_BUCKET_SQL} = ANY(%s) AND created_on <= %s",
+                   (RECONCILE_BUCKETS, differing, newest))
+    stale = []
+    for record_id, in cursor.fetchall():
+        bucket, digest = _hash(record_id, RECONCILE_BUCKETS)
+        if digest not in listed[bucket]:
+            stale.append(record_id)
+    if stale:
+        cursor.execute(f"DELETE FROM tape.{table_name} WHERE record_id = ANY(%s)", (stale,))
+        log_records('excluído', table_name, stale)
+    return stale
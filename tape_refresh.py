@@ -0,0 +1,223 @@
+"""Rebuild of the table of an app in a shadow table, swapped in atomically.
+
+Every record is bulk-loaded into `tape.{table}__shadow`, created without
+any index. The primary key and the indexes are built once the load is
+complete, and the shadow table replaces the table in a single transaction,
+so readers see either the old table or the complete new one.
+
+The new table keeps the owner and the table privileges of the old one.
+Column privileges are not kept, and views depending on the table prevent
+the swap (see `DependentViewsError`).
+"""
+import time
+
+from pytape.client import Client
+
+from psycopg2 import Error as dbError
+from psycopg2._psycopg import connection, cursor
+
+from copy_tools import copy_rows
+from metrics import LAST_SYNC, RECORDS_WRITTEN
+from tape_children import (CHILD_COLUMNS, CHILD_SCHEMA, NORMALIZED_FIELDS, child_rows, child_table, drop_child_tables,
+                           get_child_tables, multi_valued_columns, rename_child_tables)
+from tape_converters import HASH_COLUMN, LAST_MODIFIED_ON, RecordConverter, app_fields, content_hash
+from tape_create_tables import create_table_statement
+from tape_leases import lock_ddl
+from tape_metadata_cache import metadata_cache
+from tape_pages import iter_pages, prefetch
+from tape_schema import comment_column
+from tape_sinks import open_sinks
+from tape_sync_state import finish_refresh
+
+from logging_tools import logger
+
+
+SHADOW_SUFFIX = '__shadow'
+
+# Views and materialized views depending on any of the given tables
+_SELECT_DEPENDENT_VIEWS = "SELECT DISTINCT v.oid::regclass::text FROM pg_depend AS d "\
+    "JOIN pg_rewrite AS r ON r.oid = d.objid JOIN pg_class AS v ON v.oid = r.ev_class "\
+    "WHERE d.classid = 'pg_rewrite'::regclass AND d.refobjid = ANY(%s::regclass[]) AND v.oid <> d.refobjid ORDER BY 1"
+# Privileges granted on a table to roles other than its owner
+_SELECT_GRANTS = "SELECT CASE WHEN acl.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(pg_get_userbyid(acl.grantee)) END, "\
+    "acl.privilege_type, acl.is_grantable FROM pg_class AS c, aclexplode(c.relacl) AS acl "\
+    "WHERE c.oid = to_regclass(%s) AND acl.grantee <> c.relowner"
+
+
+class DependentViewsError(dbError):
+    """Views depend on a table being swapped, so it cannot be dropped without dropping them as well.
+
+    Recreating them on the new table could fail or change their results, so
+    they must be removed by hand. Until then the swap is retried with backoff,
+    without reloading the shadow table.
+    """
+
+
+def shadow_name(table_name: str) -> str:
+    """Name of the shadow table of a table."""
+    return f'{table_name}{SHADOW_SUFFIX}'
+
+
+def refresh_table(tape: Client, app_id: int, mydb: connection, cursor: cursor, table_name: str, converter: RecordConverter) -> int:
+    """Rebuild the table of an app from every record in Tape and swap it in.
+
+    The high-water mark is set to the newest record loaded, so the next
+    pass picks up the records modified during the load. A shadow table left
+    by an interrupted load is discarded, while a complete one, left by a
+    failed swap, is swapped in again without reloading it.
+
+    Returns:
+        int: Number of records in the new table
+
+    Raises:
+        TransportException: tape transport error exception
+        dbError: DB exception
+    """
+    start = time.monotonic()
+    app_info, _ = metadata_cache.get_table_name(tape, app_id)
+    shadow = shadow_name(table_name)
+    children = multi_valued_columns(converter) if NORMALIZED_FIELDS else []
+
+    if _is_complete(cursor, shadow):
+        logger.info(f"Substituindo a tabela `{table_name}` pela tabela `{shadow}` já carregada")
+        cursor.execute(f"SELECT count(*), max(last_modified_on) FROM tape.{shadow}")
+        loaded, high_water_mark = cursor.fetchone()
+        _swap(cursor, app_id, table_name, shadow)
+        finish_refresh(cursor, app_id, high_water_mark)
+        mydb.commit()
+        metadata_cache.add_table(table_name)
+        logger.info(f"Tabela `{table_name}` reconstruída com {loaded} registros")
+        return loaded
+
+    logger.info(f"Reconstruindo a tabela `{table_name}` em `{shadow}`")
+    _drop_shadow(cursor, shadow, children)
+    cursor.execute(create_table_statement(shadow, app_info, primary_key=False))
+    for _, column in children:
+        # The `last_modified_on` of the parent row tells the version of the record the child rows belong to
+        cursor.execute(f"CREATE TABLE {child_table(shadow, column)} (record_id TEXT NOT NULL, position INTEGER NOT NULL"
+                       ", value TEXT, item_id TEXT, last_modified_on TIMESTAMP)")
+    mydb.commit()
+
+    args = {"limit": 500, "sort_by": "last_modified_on", "sort_desc": True}
+    # The export of a refresh is a full snapshot, published once the table is swapped in
+    sinks = open_sinks(app_id, table_name, converter, full=True)
+    try:
+        for page in prefetch(iter_pages(tape, app_id, args, converter)):
+            rows = page['rows']
+            copy_rows(cursor, f"tape.{shadow}", [*converter.columns, HASH_COLUMN],
+                      [(*row, content_hash(row, linked=NORMALIZED_FIELDS)) for row in rows])
+            for index, column in children:
+                copy_rows(cursor, child_table(shadow, column), [*CHILD_COLUMNS, 'last_modified_on'],
+                          [(*child, row[LAST_MODIFIED_ON]) for row in rows for child in child_rows([row], index)])
+            mydb.commit()
+            sinks.write(rows)
+
+        loaded, high_water_mark = _build_indexes(cursor, shadow, app_info, children)
+        mydb.commit()
+
+        _swap(cursor, app_id, table_name, shadow)
+        finish_refresh(cursor, app_id, high_water_mark)
+        mydb.commit()
+    except BaseException:
+        sinks.close(complete=False)
+        raise
+    sinks.close(complete=True)
+    metadata_cache.add_table(table_name)
+    RECORDS_WRITTEN.inc(loaded, app_id=app_id)
+    LAST_SYNC.set(time.time(), app_id=app_id)
+
+    elapsed = time.monotonic() - start
+    message = f"Tabela `{table_name}` reconstruída com {loaded} registros em {elapsed:.1f}s"
+    logger.info(message)
+    return loaded
+
+
+def _is_complete(cursor: cursor, shadow: str) -> bool:
+    """Whether a shadow table was loaded and indexed, its primary key being committed with the indexes."""
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = to_regclass(%s) AND contype = 'p')",
+                   (f"tape.{shadow}",))
+    return cursor.fetchone()[0]
+
+
+def _drop_shadow(cursor: cursor, shadow: str, children: list):
+    for _, column in children:
+        cursor.execute(f"DROP TABLE IF EXISTS {child_table(shadow, column)}")
+    cursor.execute("SELECT to_regclass(%s)", (f"tape.{shadow}",))
+    if cursor.fetchone()[0] is not None:
+        drop_child_tables(cursor, shadow)
+        cursor.execute(f"DROP TABLE tape.{shadow}")
+
+
+def _build_indexes(cursor: cursor, shadow: str, app_info: dict, children: list):
+    """Keep the newest version of each record, then build the keys and indexes of the loaded tables.
+
+    Returns:
+        tuple: `(count, high_water_mark)` of the records in the shadow table
+    """
+    # Records modified while paging may have been listed twice
+    cursor.execute(f"DELETE FROM tape.{shadow} AS a USING tape.{shadow} AS b WHERE a.record_id = b.record_id "
+                   "AND (a.last_modified_on, a.ctid) < (b.last_modified_on, b.ctid)")
+    cursor.execute(f"ALTER TABLE tape.{shadow} ADD PRIMARY KEY (record_id)")
+    for field in app_fields(app_info):
+        comment_column(cursor, shadow, field)
+
+    for _, column in children:
+        child = child_table(shadow, column)
+        cursor.execute(f"DELETE FROM {child} AS c WHERE NOT EXISTS (SELECT 1 FROM tape.{shadow} AS p "
+                       "WHERE p.record_id = c.record_id AND p.last_modified_on IS NOT DISTINCT FROM c.last_modified_on)")
+        cursor.execute(f"DELETE FROM {child} AS a USING {child} AS b "
+                       "WHERE a.record_id = b.record_id AND a.position = b.position AND a.ctid < b.ctid")
+        cursor.execute(f"ALTER TABLE {child} DROP COLUMN last_modified_on, ADD PRIMARY KEY (record_id, position), "
+                       f"ADD FOREIGN KEY (record_id) REFERENCES tape.{shadow} (record_id) ON DELETE CASCADE")
+        cursor.execute(f"CREATE INDEX ON {child} (value)")
+        cursor.execute(f"CREATE INDEX ON {child} (item_id)")
+
+    cursor.execute(f"ANALYZE tape.{shadow}")
+    cursor.execute(f"SELECT count(*), max(last_modified_on) FROM tape.{shadow}")
+    return cursor.fetchone()
+
+
+def _swap(cursor: cursor, app_id: int, table_name: str, shadow: str):
+    """Replace the table by its shadow table, with their child tables. The caller commits.
+
+    The shadow tables first get the owner and privileges of the tables they replace.
+
+    Raises:
+        DependentViewsError: views depend on the table or its child tables
+        dbError: DB exception
+    """
+    lock_ddl(cursor, app_id)
+    cursor.execute("SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'p'", (f"tape.{shadow}",))
+    primary_key = cursor.fetchone()[0]
+
+    cursor.execute("SELECT to_regclass(%s)", (f"tape.{table_name}",))
+    if cursor.fetchone()[0] is not None:
+        children = get_child_tables(cursor, table_name)
+        cursor.execute(_SELECT_DEPENDENT_VIEWS, ([f"tape.{table_name}", *(f'{CHILD_SCHEMA}."{name}"' for name in children)],))
+        views = [view for view, in cursor.fetchall()]
+        if views:
+            raise DependentViewsError(f"Views dependentes da tabela `{table_name}` impedem a substituição: {', '.join(views)}")
+
+        _copy_access(cursor, f"tape.{table_name}", f"tape.{shadow}")
+        prefix = f"{shadow}__"
+        for name in get_child_tables(cursor, shadow):
+            column = name[len(prefix):]
+            _copy_access(cursor, child_table(table_name, column), child_table(shadow, column))
+        drop_child_tables(cursor, table_name)
+        cursor.execute(f"DROP TABLE tape.{table_name}")
+    rename_child_tables(cursor, shadow, table_name)
+    cursor.execute(f"ALTER TABLE tape.{shadow} RENAME TO {table_name}")
+    cursor.execute(f'ALTER INDEX tape."{primary_key}" RENAME TO "{table_name}_pkey"')
+
+
+def _copy_access(cursor: cursor, table: str, target: str):
+    """Give `target` the table privileges and the owner of `table`, if it exists. The caller commits."""
+    cursor.execute(_SELECT_GRANTS, (table,))
+    for grantee, privilege, grantable in cursor.fetchall():
+        cursor.execute(f"GRANT {privilege} ON {target} TO {grantee}{' WITH GRANT OPTION' if grantable else ''}")
+
+    cursor.execute("SELECT quote_ident(pg_get_userbyid(relowner)), pg_get_userbyid(relowner) = current_user "
+                   "FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+    row = cursor.fetchone()
+    if row is not None and not row[1]:
+        cursor.execute(f"ALTER TABLE {target} OWNER TO {row[0]}")
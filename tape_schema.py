@@ -0,0 +1,197 @@
+"""Evolution of the database tables when the schema of a tape app changes."""
+from psycopg2 import Error as dbError
+from psycopg2 import errorcodes
+from psycopg2._psycopg import connection, cursor
+
+from tape_children import rename_child_table, rename_child_tables
+from tape_converters import HASH_COLUMN, app_fields, get_field_type
+from logging_tools import logger
+
+
+# SQLSTATEs of a write failing because the table no longer matches the app
+SCHEMA_DRIFT_CODES = (errorcodes.UNDEFINED_TABLE, errorcodes.UNDEFINED_COLUMN, errorcodes.DATATYPE_MISMATCH)
+# SQLSTATE classes of a write rejected because of its values: data exceptions and integrity constraint violations
+DATA_ERROR_CLASSES = ('22', '23')
+
+
+def _sqlstate(err: Exception):
+    # `pgcode` of psycopg2, `sqlstate` of asyncpg
+    return getattr(err, 'pgcode', None) or getattr(err, 'sqlstate', None)
+
+
+def is_schema_drift(err: Exception) -> bool:
+    """Tell whether a failed write means that the app changed, e.g. a field was added or the table renamed."""
+    return _sqlstate(err) in SCHEMA_DRIFT_CODES
+
+
+def is_data_error(err: Exception) -> bool:
+    """Tell whether a failed write was rejected for the values of its rows, which fail the same way on every retry."""
+    return (_sqlstate(err) or '')[:2] in DATA_ERROR_CLASSES
+
+
+def comment_column(cursor: cursor, table_name: str, field: dict):
+    """Tag a column with the ID of its field, so that renamed fields can be recognized."""
+    cursor.execute(f"COMMENT ON COLUMN tape.{table_name}.\"{field['external_id']}\" IS %s",
+                   (f"field_id:{field['field_id']}",))
+
+
+def get_live_columns(cursor: cursor, table_name: str) -> dict:
+    """Retrieve the columns of a table.
+
+    Returns:
+        dict: `column name -> (field_id, type)`, with the field_id taken from
+        the column comment, `None` if there is none
+    """
+    cursor.execute(
+        "SELECT a.attname, col_description(a.attrelid, a.attnum), format_type(a.atttypid, a.atttypmod) "
+        "FROM pg_attribute a WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped",
+        (f"tape.{table_name}",))
+    columns = {}
+    for column, comment, column_type in cursor.fetchall():
+        field_id = None
+        if comment and comment.startswith('field_id:'):
+            field_id = comment[len('field_id:'):]
+        columns[column] = (field_id, column_type)
+    return columns
+
+
+def diff_schema(app_info: dict, live_columns: dict):
+    """Compare the fields of an app with the live columns of its table.
+
+    Returns:
+        tuple: `(added, renamed, retyped)`, the fields without a column, the
+        `(old column, field)` pairs of fields whose `external_id` changed and
+        the `(field, column type)` pairs of the columns whose type differs
+        from the one of their field type
+    """
+    columns_by_field = {field_id: column for column, (field_id, _) in live_columns.items() if field_id}
+    current_columns = {field['external_id'] for field in app_fields(app_info)}
+
+    added, renamed, retyped = [], [], []
+    for field in app_fields(app_info):
+        column = field['external_id']
+        if column not in live_columns:
+            old_column = columns_by_field.get(str(field['field_id']))
+            if old_column and old_column not in current_columns:
+                renamed.append((old_column, field))
+                column = old_column
+            else:
+                added.append(field)
+                continue
+        if live_columns[column][1] != get_field_type(field).format_type:
+            retyped.append((field, live_columns[column][1]))
+    return added, renamed, retyped
+
+
+def evolve_schema(cursor: cursor, table_name: str, app_info: dict) -> list:
+    """Alter the table of an app to match its current fields, without reloading it.
+
+    Renamed fields are renamed in place, new fields are added as empty
+    columns and columns whose type changed are converted in place (see
+    `conversion_expression`); columns of removed fields are kept. Tables created before
+    content hashes get an empty hash column. The caller commits, together
+    with the backfill of the returned columns, so that a failure in between
+    cannot leave them empty for good.
+
+    Returns:
+        tuple: `(backfill, renamed)`, names of the added columns and of the
+        retyped ones whose values could not all be converted, to be
+        backfilled from Tape, and of the renamed ones
+
+    Raises:
+        dbError: DB exception
+    """
+    live_columns = get_live_columns(cursor, table_name)
+    added, renamed, retyped = diff_schema(app_info, live_columns)
+
+    for old_column, field in renamed:
+        message = f"Renomeando a coluna `{old_column}` para `{field['external_id']}` na tabela `{table_name}`"
+        logger.info(message)
+        cursor.execute(f"ALTER TABLE tape.{table_name} RENAME COLUMN \"{old_column}\" TO \"{field['external_id']}\"")
+        rename_child_table(cursor, table_name, old_column, field['external_id'])
+
+    backfill = []
+    retyped_text = {field['external_id'] for field, column_type in retyped if column_type == 'text'}
+    for field in added:
+        message = f"Adicionando a coluna `{field['external_id']}` na tabela `{table_name}`"
+        logger.info(message)
+        cursor.execute(f"ALTER TABLE tape.{table_name} ADD COLUMN \"{field['external_id']}\" {get_field_type(field).sql_type}")
+        if field.get('source') in retyped_text:
+            # `money` columns stored as TEXT kept `<currency> <amount>`, the currency is taken before the conversion
+            cursor.execute(f"UPDATE tape.{table_name} SET \"{field['external_id']}\" = "
+                           f"substring(\"{field['source']}\" from '^([A-Z]{{3}}) ')")
+        else:
+            backfill.append(field['external_id'])
+
+    for field, column_type in retyped:
+        sql_type = get_field_type(field).sql_type
+        message = f"Alterando o tipo da coluna `{field['external_id']}` para {sql_type} na tabela `{table_name}`"
+        logger.info(message)
+        if not _convert_column(cursor, table_name, field['external_id'], column_type, sql_type):
+            backfill.append(field['external_id'])
+
+    if HASH_COLUMN not in live_columns:
+        cursor.execute(f"ALTER TABLE tape.{table_name} ADD COLUMN \"{HASH_COLUMN}\" TEXT")
+
+    for field in app_fields(app_info):
+        # Also tags the columns created before field IDs were tracked
+        if live_columns.get(field['external_id'], (None,))[0] != str(field['field_id']):
+            comment_column(cursor, table_name, field)
+
+    return backfill, [field['external_id'] for _, field in renamed]
+
+
+def conversion_expression(column: str, column_type: str, sql_type: str) -> str:
+    """Expression converting the values of a column of type `column_type` to `sql_type`.
+
+    TEXT columns hold the values as formatted before native column types:
+    `<currency> <amount>` for `money`, `None` for empty numbers and the values
+    of multi-valued fields joined by `|`. Values that cannot be converted
+    become `NULL`, or make the conversion fail for dates.
+    """
+    if column_type == 'text':
+        value = f"NULLIF(NULLIF(btrim({column}), ''), 'None')"
+        if sql_type == 'NUMERIC':
+            return f"substring({value} from '^(?:[A-Z]{{3}} )?(-?[0-9]+(?:[.][0-9]+)?(?:[eE][-+]?[0-9]+)?)$')::numeric"
+        if sql_type == 'TIMESTAMP':
+            return f"{value}::timestamp"
+        if sql_type == 'TEXT[]':
+            return f"string_to_array({value}, '|')"
+    if column_type == 'text[]' and sql_type == 'TEXT':
+        return f"array_to_string({column}, '|')"
+    return f"{column}::{sql_type}"
+
+
+def _convert_column(cursor: cursor, table_name: str, column: str, column_type: str, sql_type: str) -> bool:
+    """Convert a column to `sql_type` in place, or empty it if the conversion fails.
+
+    Returns:
+        bool: Whether every value was converted, otherwise the column must be backfilled
+    """
+    expression = conversion_expression(f'"{column}"', column_type, sql_type)
+    cursor.execute("SAVEPOINT convert_column")
+    try:
+        cursor.execute(f"SELECT count(*) FROM tape.{table_name} "
+                       f"WHERE NULLIF(NULLIF(btrim(\"{column}\"::text), ''), 'None') IS NOT NULL AND ({expression}) IS NULL")
+        lost = cursor.fetchone()[0]
+        cursor.execute(f"ALTER TABLE tape.{table_name} ALTER COLUMN \"{column}\" TYPE {sql_type} USING {expression}")
+        cursor.execute("RELEASE SAVEPOINT convert_column")
+    except dbError as err:
+        cursor.execute("ROLLBACK TO SAVEPOINT convert_column")
+        logger.warning(f"Valores da coluna `{column}` da tabela `{table_name}` não convertidos. Serão lidos novamente do Tape. {err}")
+        cursor.execute(f"ALTER TABLE tape.{table_name} ALTER COLUMN \"{column}\" TYPE {sql_type} USING NULL")
+        return False
+
+    if lost:
+        logger.warning(f"{lost} valores da coluna `{column}` da tabela `{table_name}` não convertidos. Serão lidos novamente do Tape.")
+    return not lost
+
+
+def rename_table(mydb: connection, cursor: cursor, table_name: str, new_table_name: str):
+    """Rename the table of an app whose slug, or the slug of its workspace, changed."""
+    message = f"Renomeando a tabela `{table_name}` para `{new_table_name}`"
+    logger.info(message)
+
+    rename_child_tables(cursor, table_name, new_table_name)
+    cursor.execute(f"ALTER TABLE tape.{table_name} RENAME TO {new_table_name}")
+    mydb.commit()
@@ -0,0 +1,349 @@
+"""Destinations of the rows synchronized from Tape, besides the PostgreSQL tables.
+
+PostgreSQL is always written, since it also keeps the synchronization state.
+The sinks listed in `SINKS` receive the same rows, page by page, once each
+page is committed to PostgreSQL, and the records deleted from PostgreSQL.
+A pass of an app opens a writer per sink and closes it when the pass ends,
+also when it is interrupted, so a sink receives exactly the rows committed
+to PostgreSQL. A sink that misses rows, e.g. after a failed write, is
+caught up by a full pass of the app (see `sinks_stale`).
+"""
+import abc
+import datetime
+from decimal import ROUND_HALF_EVEN, Decimal
+import json
+import os
+from os import getenv
+import threading
+import uuid
+
+from tape_converters import LAST_MODIFIED_ON, SIMPLE_ATTRIBUTES, RecordConverter, get_field_type
+from logging_tools import logger
+
+
+# Destinations of the rows, comma separated: `postgres` (always written) and `parquet`
+SINKS = [sink.strip() for sink in getenv('SINKS', 'postgres').split(',') if sink.strip()]
+# Directory of the Parquet datasets, one per table
+PARQUET_DIR = getenv('PARQUET_DIR', 'parquet')
+# Rows buffered in memory before they are written as a row group
+PARQUET_ROW_GROUP_SIZE = int(getenv('PARQUET_ROW_GROUP_SIZE', '10000'))
+
+MANIFEST = '_manifest.json'
+# Flag of the rows recording the deletion of a record
+DELETED_COLUMN = '_deleted'
+# Precision and scale of the NUMERIC columns, exact up to 9 decimal places
+NUMERIC_PRECISION = (38, 9)
+_NUMERIC_QUANTUM = Decimal(1).scaleb(-NUMERIC_PRECISION[1])
+
+
+class SinkWriter(abc.ABC):
+    """Rows of a pass of an app, written to a sink."""
+
+    @abc.abstractmethod
+    def write(self, rows: list):
+        """Write a page of rows, converted by the converter the writer was opened with."""
+
+    @abc.abstractmethod
+    def delete(self, record_ids: list):
+        """Write the deletion of records, e.g. removed by `tape_reconcile` or a webhook."""
+
+    @abc.abstractmethod
+    def close(self, complete: bool):
+        """Publish the rows written.
+
+        Args:
+            complete (bool): Whether the pass read every record it had to, as
+                opposed to one interrupted by an error
+        """
+
+    @abc.abstractmethod
+    def abandon(self):
+        """Discard the rows written after an error, and flag the sink for a full export (see `Sink.is_stale`)."""
+
+
+class Sink(abc.ABC):
+    """Destination of the rows of the apps."""
+
+    @abc.abstractmethod
+    def open(self, app_id: int, table_name: str, converter: RecordConverter, full: bool) -> SinkWriter:
+        """Start writing a pass of an app.
+
+        Args:
+            full (bool): Whether the pass reads every record of the app, e.g.
+                on its first pass, on a full resync or on a table refresh
+        """
+
+    @abc.abstractmethod
+    def is_stale(self, table_name: str, converter: RecordConverter) -> bool:
+        """Whether the sink misses rows of a table, so that its next pass must read every record."""
+
+
+class ParquetSink(Sink):
+    """Parquet datasets on local disk, written with `pyarrow`.
+
+    Each table gets the dataset `{PARQUET_DIR}/{table}`, with one file per
+    pass under a `date=YYYY-MM-DD` partition, holding the rows of the pass
+    and the deleted records, as rows with `_deleted` set. The manifest
+    `_manifest.json` of the dataset lists the latest complete full pass and
+    the files after it: reading them, keeping the row with the newest
+    `last_modified_on` of each `record_id`, a deletion winning ties, and
+    dropping the deleted records gives the current state of the app.
+
+    The manifest is flagged `stale` when a file could not be written, and
+    records the schema of the dataset. A stale dataset, or one whose table
+    gained, renamed or retyped columns, is rewritten by a full pass.
+    """
+
+    def __init__(self, directory: str = PARQUET_DIR, row_group_size: int = PARQUET_ROW_GROUP_SIZE):
+        # Optional dependency, only needed with `SINKS=...,parquet`
+        import pyarrow
+        import pyarrow.parquet
+
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.directory = directory
+        self.row_group_size = row_group_size
+
+    def open(self, app_id: int, table_name: str, converter: RecordConverter, full: bool) -> SinkWriter:
+        return _ParquetWriter(self, app_id, table_name, converter, full)
+
+    def is_stale(self, table_name: str, converter: RecordConverter) -> bool:
+        manifest = read_manifest(os.path.join(self.directory, table_name))
+        return manifest is None or manifest.get('stale', False) or manifest.get('schema') != self.describe(converter)
+
+    def schema(self, converter: RecordConverter):
+        """Arrow schema of the rows of a converter."""
+        pa = self.pa
+        types = {'TEXT': pa.string(), 'NUMERIC': pa.decimal128(*NUMERIC_PRECISION), 'TIMESTAMP': pa.timestamp('us'),
+                 'TEXT[]': pa.list_(pa.string())}
+        fields = [pa.field('record_id', pa.string(), nullable=False),
+                  pa.field('created_on', pa.timestamp('us')),
+                  pa.field('last_modified_on', pa.timestamp('us'))]
+        fields += [pa.field(field['external_id'], types[get_field_type(field).sql_type]) for field in converter.fields]
+        fields.append(pa.field(DELETED_COLUMN, pa.bool_(), nullable=False))
+        return pa.schema(fields)
+
+    def describe(self, converter: RecordConverter) -> list:
+        """`[column, type]` of the schema of a converter, as kept in the manifest."""
+        return [[field.name, str(field.type)] for field in self.schema(converter)]
+
+
+def read_manifest(dataset: str):
+    """Manifest of a dataset, or `None` if it has none or it cannot be read."""
+    try:
+        with open(os.path.join(dataset, MANIFEST)) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(dataset: str, manifest: dict):
+    manifest_path = os.path.join(dataset, MANIFEST)
+    os.makedirs(dataset, exist_ok=True)
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def _timestamp(value):
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    try:
+        return datetime.datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+
+
+def _decimal(value):
+    if value is None:
+        return None
+    return Decimal(str(value)).quantize(_NUMERIC_QUANTUM, rounding=ROUND_HALF_EVEN)
+
+
+def _arrow_values(sql_type: str, values: list) -> list:
+    """Python values of a column in the types of `ParquetSink.schema`."""
+    if sql_type == 'NUMERIC':
+        return [_decimal(value) for value in values]
+    if sql_type == 'TIMESTAMP':
+        return [_timestamp(value) for value in values]
+    if sql_type == 'TEXT[]':
+        return [None if value is None else [str(element) for element in value] for value in values]
+    if sql_type == 'BOOLEAN':
+        return list(values)
+    return [None if value is None else str(value) for value in values]
+
+
+class _ParquetWriter(SinkWriter):
+
+    def __init__(self, sink: ParquetSink, app_id: int, table_name: str, converter: RecordConverter, full: bool):
+        self.sink = sink
+        self.app_id = app_id
+        self.dataset = os.path.join(sink.directory, table_name)
+        self.full = full
+        self.schema = sink.schema(converter)
+        self.description = sink.describe(converter)
+        self.sql_types = ['TEXT', 'TIMESTAMP', 'TIMESTAMP'] + [get_field_type(field).sql_type for field in converter.fields]
+        self.sql_types.append('BOOLEAN')
+        self.width = len(converter.columns)
+        self.started_at = datetime.datetime.now()
+        self.path = os.path.join(f"date={self.started_at:%Y-%m-%d}",
+                                 f"{self.started_at:%H%M%S}-{uuid.uuid4().hex[:8]}.parquet")
+        self.rows = 0
+        self.deleted = 0
+        self.min_modified = self.max_modified = None
+        self._buffer = []
+        self._writer = None
+
+    def write(self, rows: list):
+        self._append([(*row, False) for row in rows])
+
+    def delete(self, record_ids: list):
+        # Deleted now, so newer than any version of the records
+        deleted_on = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        padding = (None,) * (self.width - len(SIMPLE_ATTRIBUTES))
+        self._append([(record_id, None, deleted_on, *padding, True) for record_id in record_ids])
+        self.deleted += len(record_ids)
+
+    def _append(self, rows: list):
+        for row in rows:
+            modified = row[LAST_MODIFIED_ON]
+            self.min_modified = modified if self.min_modified is None else min(self.min_modified, modified)
+            self.max_modified = modified if self.max_modified is None else max(self.max_modified, modified)
+        self._buffer.extend(rows)
+        self.rows += len(rows)
+        while len(self._buffer) >= self.sink.row_group_size:
+            self._write_row_group(self._buffer[:self.sink.row_group_size])
+            del self._buffer[:self.sink.row_group_size]
+
+    def _write_row_group(self, rows: list):
+        pa = self.sink.pa
+        columns = [pa.array(_arrow_values(sql_type, list(values)), type=field.type)
+                   for sql_type, field, values in zip(self.sql_types, self.schema, zip(*rows))]
+        if self._writer is None:
+            os.makedirs(os.path.dirname(self._temporary_path()), exist_ok=True)
+            self._writer = self.sink.pq.ParquetWriter(self._temporary_path(), self.schema)
+        self._writer.write_table(pa.Table.from_arrays(columns, schema=self.schema))
+
+    def _temporary_path(self) -> str:
+        return os.path.join(self.dataset, self.path + '.tmp')
+
+    def close(self, complete: bool):
+        if self._buffer:
+            self._write_row_group(self._buffer)
+            self._buffer = []
+        full = self.full and complete
+        if self._writer is None:
+            if full:
+                # An app without records still gets a manifest, or it would stay stale
+                self._update_manifest(full, None)
+            return
+        self._writer.close()
+        os.replace(self._temporary_path(), os.path.join(self.dataset, self.path))
+        self._update_manifest(full, self.path)
+        logger.info(f"{self.rows - self.deleted} registros e {self.deleted} exclusões exportados para "
+                    f"`{os.path.join(self.dataset, self.path)}`")
+
+    def abandon(self):
+        try:
+            if self._writer is not None:
+                self._writer.close()
+        finally:
+            if os.path.exists(self._temporary_path()):
+                os.remove(self._temporary_path())
+            manifest = read_manifest(self.dataset) or {'dataset': os.path.basename(self.dataset), 'app_id': self.app_id,
+                                                       'files': []}
+            manifest.update(stale=True, updated_at=datetime.datetime.now().isoformat())
+            _write_manifest(self.dataset, manifest)
+
+    def _update_manifest(self, full: bool, path: str):
+        manifest = read_manifest(self.dataset) or {}
+        files = manifest.get('files', [])
+        # Files before the latest complete full pass are superseded by it
+        if full:
+            files = []
+        if path:
+            files = files + [{'path': path, 'rows': self.rows - self.deleted, 'deleted': self.deleted, 'full': full,
+                              'created_at': self.started_at.isoformat(), 'min_last_modified_on': str(self.min_modified),
+                              'max_last_modified_on': str(self.max_modified)}]
+        _write_manifest(self.dataset, {
+            'dataset': os.path.basename(self.dataset), 'app_id': self.app_id,
+            'updated_at': datetime.datetime.now().isoformat(),
+            # Only a full pass fixes a stale dataset or a new schema
+            'stale': False if full else manifest.get('stale', True),
+            'schema': self.description if full else manifest.get('schema'),
+            'files': files})
+
+
+class SinkWriters:
+    """Writers of a pass of an app in every sink of `SINKS` other than PostgreSQL.
+
+    PostgreSQL stays the source of truth: a writer that fails is abandoned,
+    which flags its sink for a full export, and the sync goes on.
+    """
+
+    def __init__(self, writers: list):
+        self.writers = writers
+
+    def write(self, rows: list):
+        if rows:
+            self._each(lambda writer: writer.write(rows))
+
+    def delete(self, record_ids: list):
+        if record_ids:
+            self._each(lambda writer: writer.delete(record_ids))
+
+    def close(self, complete: bool):
+        self._each(lambda writer: writer.close(complete))
+        self.writers = []
+
+    def _each(self, action):
+        for writer in list(self.writers):
+            try:
+                action(writer)
+            except Exception as err:
+                logger.error(f"Erro na exportação dos registros. Exportação completa no próximo ciclo. {err}")
+                self.writers.remove(writer)
+                try:
+                    writer.abandon()
+                except Exception as abandon_err:
+                    logger.error(f"Erro ao descartar a exportação. {abandon_err}")
+
+
+SINK_TYPES = {'parquet': ParquetSink}
+
+_sinks = None
+_sinks_lock = threading.Lock()
+
+
+def get_sinks() -> list:
+    """Sinks enabled in `SINKS`, besides PostgreSQL."""
+    global _sinks
+    with _sinks_lock:
+        if _sinks is None:
+            unknown = [name for name in SINKS if name != 'postgres' and name not in SINK_TYPES]
+            if unknown:
+                logger.warning(f"Destinos desconhecidos em SINKS ignorados: {unknown}")
+            _sinks = []
+            for name in SINKS:
+                if name in SINK_TYPES:
+                    try:
+                        _sinks.append(SINK_TYPES[name]())
+                    except ImportError as err:
+                        logger.error(f"Destino `{name}` desativado, dependência não instalada. {err}")
+        return _sinks
+
+
+def open_sinks(app_id: int, table_name: str, converter: RecordConverter, full: bool) -> SinkWriters:
+    """Start writing a pass of an app in the sinks, see `Sink.open`."""
+    return SinkWriters([sink.open(app_id, table_name, converter, full) for sink in get_sinks()])
+
+
+def sinks_stale(table_name: str, converter: RecordConverter) -> bool:
+    """Whether a sink needs every record of a table, see `Sink.is_stale`."""
+    stale = False
+    for sink in get_sinks():
+        try:
+            stale = sink.is_stale(table_name, converter) or stale
+        except Exception as err:
+            logger.error(f"Erro na leitura da exportação da tabela `{table_name}`. {err}")
+    return stale
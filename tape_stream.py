@@ -0,0 +1,80 @@
+"""Incremental parsing of the pages of records, enabled with `TAPE_STREAMING=1`.
+
+`pytape` parses a whole response into nested dicts before returning it. In
+streaming mode the records endpoint is requested directly and its JSON is
+parsed with `ijson` as it arrives: each record is converted into a row as
+soon as its last token is read, so a full page of parsed records is never
+held in memory.
+"""
+from os import getenv
+
+import ijson
+from ijson.common import ObjectBuilder
+
+from tape_client import TAPE_API_URL, api_error, api_params, thread_http_session
+from tape_converters import RecordConverter
+from tape_rate_limit import scheduler
+
+
+# Parse the pages of records incrementally instead of through `pytape`
+TAPE_STREAMING = getenv('TAPE_STREAMING', '0') == '1'
+
+_REQUEST_TIMEOUT = 300
+
+
+def records_url(app_id: int) -> str:
+    """URL of the records endpoint of an app."""
+    return f'{TAPE_API_URL}/record/app/{app_id}'
+
+
+class PageBuilder:
+    """Page of rows built from the `ijson.parse` events of a records response.
+
+    Attributes:
+        page (dict): `rows`, `cursor` and `total` of the response read so far
+    """
+
+    def __init__(self, converter: RecordConverter):
+        self.converter = converter
+        self.page = {'rows': [], 'cursor': None, 'total': None}
+        self._record = None
+
+    def feed(self, prefix: str, event: str, value):
+        """Consume a parsing event."""
+        if self._record is not None:
+            self._record.event(event, value)
+            if prefix == 'records.item' and event == 'end_map':
+                self.page['rows'].append(self.converter.convert(self._record.value))
+                self._record = None
+        elif prefix == 'records.item' and event == 'start_map':
+            self._record = ObjectBuilder()
+            self._record.event(event, value)
+        elif prefix in ('cursor', 'total'):
+            self.page[prefix] = value
+
+
+def get_record_rows(app_id: int, converter: RecordConverter, **args) -> dict:
+    """Request a page of records as `tape.App.get_records` does, parsing it into rows.
+
+    Args:
+        app_id (int): tape app ID
+        converter (RecordConverter): converter of the records into rows
+        args: Arguments of `tape.App.get_records`, e.g. `limit` and `cursor`
+
+    Returns:
+        dict: `rows`, `cursor` and `total`
+
+    Raises:
+        TransportException: tape transport error exception
+    """
+    session = thread_http_session()
+    with session.get(records_url(app_id), params=api_params(args), stream=True, timeout=_REQUEST_TIMEOUT) as response:
+        if response.status_code >= 400:
+            raise api_error(response.status_code, response.headers, response.text)
+        response.raw.decode_content = True
+        builder = PageBuilder(converter)
+        for prefix, event, value in ijson.parse(response.raw):
+            builder.feed(prefix, event, value)
+    # Unlike `pytape`, the quota is known after every request
+    scheduler.observe({key.lower(): value for key, value in response.headers.items()})
+    return builder.page
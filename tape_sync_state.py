@@ -0,0 +1,209 @@
+"""Persisted synchronization state of each tape app."""
+import datetime
+
+from psycopg2._psycopg import cursor
+
+from get_mydb import borrow_db
+from logging_tools import logger
+
+
+STATE_COLUMNS = ['high_water_mark', 'pass_high_water_mark', 'cursor', 'page_index', 'full_resync', 'backfill_columns',
+                 'page_size', 'refresh']
+
+# A requested refresh is due once the backoff after its failures, if any, has elapsed
+_REFRESH_DUE = "refresh AND (refresh_after IS NULL OR refresh_after <= now())"
+
+# Statements shared with the asyncio engine, see `tape_async`
+SELECT_STATE = f"SELECT {', '.join(_REFRESH_DUE if column == 'refresh' else column for column in STATE_COLUMNS)} "\
+    "FROM tape_sync.app_state WHERE app_id = %s"
+SAVE_PAGE_STATE = "INSERT INTO tape_sync.app_state AS state (app_id, pass_high_water_mark, cursor, page_index) "\
+    "VALUES (%s, %s, %s, %s) ON CONFLICT (app_id) DO UPDATE SET pass_high_water_mark = excluded.pass_high_water_mark, "\
+    "cursor = excluded.cursor, page_index = excluded.page_index, updated_at = now()"
+FINISH_PASS = "UPDATE tape_sync.app_state SET high_water_mark = COALESCE(pass_high_water_mark, high_water_mark), "\
+    "pass_high_water_mark = NULL, cursor = NULL, page_index = NULL, full_resync = FALSE, updated_at = now() "\
+    "WHERE app_id = %s"
+DISCARD_CHECKPOINT = "UPDATE tape_sync.app_state SET pass_high_water_mark = NULL, cursor = NULL, page_index = NULL, "\
+    "updated_at = now() WHERE app_id = %s"
+FINISH_BACKFILL = "UPDATE tape_sync.app_state SET backfill_columns = NULL, updated_at = now() WHERE app_id = %s"
+SAVE_PAGE_SIZE = "UPDATE tape_sync.app_state SET page_size = %s WHERE app_id = %s"
+REQUEST_REFRESH = "INSERT INTO tape_sync.app_state (app_id, refresh) VALUES (%s, TRUE) "\
+    "ON CONFLICT (app_id) DO UPDATE SET refresh = TRUE, updated_at = now()"
+FINISH_REFRESH = "UPDATE tape_sync.app_state SET high_water_mark = %s, pass_high_water_mark = NULL, cursor = NULL, "\
+    "page_index = NULL, full_resync = FALSE, backfill_columns = NULL, refresh = FALSE, refresh_failures = 0, "\
+    "refresh_after = NULL, updated_at = now() WHERE app_id = %s"
+# Each failed refresh doubles the wait before the next one, from an hour up to a day
+REFRESH_FAILED = "UPDATE tape_sync.app_state SET refresh_failures = refresh_failures + 1, "\
+    "refresh_after = now() + least(interval '1 hour' * power(2, refresh_failures), interval '1 day'), updated_at = now() "\
+    "WHERE app_id = %s RETURNING refresh_after"
+
+
+def ensure_sync_state_table(cursor: cursor):
+    """Create the `tape_sync.app_state` table if it does not exist.
+
+    Columns:
+        app_id: tape app ID
+        high_water_mark: latest `last_modified_on` of a finished pass
+        pass_high_water_mark: latest `last_modified_on` seen by the pass in progress
+        cursor: pagination cursor of the pass in progress, after its last committed page
+        page_index: number of pages committed by the pass in progress
+        full_resync: when set, the next pass ignores the high-water mark
+        backfill_columns: columns added to the table that still must be filled
+        last_reconciled_at: last removal of the records deleted in Tape, see `tape_reconcile`
+        page_size: page size with the best throughput seen, see `tape_page_size`
+        refresh: when set, the next pass rebuilds the table in a shadow table, see `tape_refresh`
+        refresh_failures: number of consecutive failed refreshes
+        refresh_after: time before which a failed refresh is not retried
+    """
+    cursor.execute("CREATE SCHEMA IF NOT EXISTS tape_sync")
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS tape_sync.app_state ("
+        "app_id BIGINT PRIMARY KEY NOT NULL"
+        ", high_water_mark TIMESTAMP"
+        ", pass_high_water_mark TIMESTAMP"
+        ", cursor TEXT"
+        ", full_resync BOOLEAN NOT NULL DEFAULT FALSE"
+        ", updated_at TIMESTAMP NOT NULL DEFAULT now()"
+        ")")
+    cursor.execute("ALTER TABLE tape_sync.app_state ADD COLUMN IF NOT EXISTS backfill_columns TEXT[]")
+    cursor.execute("ALTER TABLE tape_sync.app_state ADD COLUMN IF NOT EXISTS page_index INTEGER")
+    cursor.execute("ALTER TABLE tape_sync.app_state ADD COLUMN IF NOT EXISTS last_reconciled_at TIMESTAMP DEFAULT now()")
+    cursor.execute("ALTER TABLE tape_sync.app_state ADD COLUMN IF NOT EXISTS page_size INTEGER")
+    cursor.execute("ALTER TABLE tape_sync.app_state ADD COLUMN IF NOT EXISTS refresh BOOLEAN NOT NULL DEFAULT FALSE")
+    cursor.execute("ALTER TABLE tape_sync.app_state ADD COLUMN IF NOT EXISTS refresh_failures INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("ALTER TABLE tape_sync.app_state ADD COLUMN IF NOT EXISTS refresh_after TIMESTAMP")
+
+
+def get_sync_state(cursor: cursor, app_id: int) -> dict:
+    """Retrieve the synchronization state of an app.
+
+    Returns:
+        dict: The state columns, with empty values if the app was never synchronized
+    """
+    cursor.execute(SELECT_STATE, (app_id,))
+    return state_from_row(cursor.fetchone())
+
+
+def state_from_row(row) -> dict:
+    """Synchronization state from a row of `SELECT_STATE`, or the state of an app never synchronized."""
+    if not row:
+        return {'high_water_mark': None, 'pass_high_water_mark': None, 'cursor': None, 'page_index': None,
+                'full_resync': False, 'backfill_columns': None, 'page_size': None,
+                'refresh': False}
+    return dict(zip(STATE_COLUMNS, row))
+
+
+def save_page_state(cursor: cursor, app_id: int, page_cursor: str, pass_high_water_mark: datetime.datetime, page_index: int):
+    """Checkpoint the pass in progress: the cursor of the next page and the number of pages committed.
+
+    It is not committed here, so it is saved in the same transaction of the page.
+    A pass interrupted by a Tape error or a restart resumes from this checkpoint.
+    """
+    cursor.execute(SAVE_PAGE_STATE, (app_id, pass_high_water_mark, page_cursor, page_index))
+
+
+def discard_checkpoint(cursor: cursor, app_id: int):
+    """Forget the checkpoint of the pass in progress, so that the next pass starts from the first page."""
+    cursor.execute(DISCARD_CHECKPOINT, (app_id,))
+
+
+def finish_pass(cursor: cursor, app_id: int):
+    """Promote the high-water mark of a finished pass and clear its cursor."""
+    cursor.execute(FINISH_PASS, (app_id,))
+
+
+def save_page_size(cursor: cursor, app_id: int, page_size: int):
+    """Remember the page size an app starts its next passes with."""
+    cursor.execute(SAVE_PAGE_SIZE, (page_size, app_id))
+
+
+def request_backfill(cursor: cursor, app_id: int, columns: list):
+    """Register columns added to the table of an app, to be filled on its next pass."""
+    cursor.execute(
+        "INSERT INTO tape_sync.app_state AS state (app_id, backfill_columns) VALUES (%s, %s::text[]) "
+        "ON CONFLICT (app_id) DO UPDATE SET backfill_columns = "
+        "ARRAY(SELECT DISTINCT unnest(COALESCE(state.backfill_columns, '{}') || excluded.backfill_columns)), "
+        "updated_at = now()", (app_id, columns))
+
+
+def finish_backfill(cursor: cursor, app_id: int):
+    """Clear the columns to be filled of an app."""
+    cursor.execute(FINISH_BACKFILL, (app_id,))
+
+
+def request_refresh(cursor: cursor, app_id: int):
+    """Flag an app so that its next pass rebuilds its table and swaps it in."""
+    cursor.execute(REQUEST_REFRESH, (app_id,))
+
+
+def refresh_failed(cursor: cursor, app_id: int) -> datetime.datetime:
+    """Postpone the next refresh of an app after a failed one.
+
+    Returns:
+        datetime: Time from which the refresh is retried
+    """
+    cursor.execute(REFRESH_FAILED, (app_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def finish_refresh(cursor: cursor, app_id: int, high_water_mark: datetime.datetime):
+    """Record a rebuilt table as a finished pass up to `high_water_mark`."""
+    cursor.execute(FINISH_REFRESH, (high_water_mark, app_id))
+
+
+def apps_due_for_reconciliation(cursor: cursor, apps_ids: list, offset: int) -> list:
+    """Apps synchronized before and not reconciled in the last `offset` seconds."""
+    cursor.execute(
+        "SELECT app_id FROM tape_sync.app_state WHERE app_id = ANY(%s) "
+        "AND last_reconciled_at < now() - %s * interval '1 second' ORDER BY last_reconciled_at",
+        (apps_ids, offset))
+    return [app_id for app_id, in cursor.fetchall()]
+
+
+def finish_reconciliation(cursor: cursor, app_id: int):
+    """Record the reconciliation of an app."""
+    cursor.execute("UPDATE tape_sync.app_state SET last_reconciled_at = now(), updated_at = now() WHERE app_id = %s", (app_id,))
+
+
+def reset_sync_state(cursor: cursor, app_id: int):
+    """Forget the synchronization state of an app, e.g. when its table is (re)created."""
+    cursor.execute("DELETE FROM tape_sync.app_state WHERE app_id = %s", (app_id,))
+
+
+def request_full_resync(apps_ids: list):
+    """Flag apps so that their next pass re-reads every record from Tape.
+
+    Args:
+        apps_ids (list): List of tape apps IDs
+    """
+    with borrow_db() as mydb:
+        cursor = mydb.cursor()
+        ensure_sync_state_table(cursor)
+        for app_id in apps_ids:
+            cursor.execute(
+                "INSERT INTO tape_sync.app_state (app_id, full_resync) VALUES (%s, TRUE) "
+                "ON CONFLICT (app_id) DO UPDATE SET full_resync = TRUE, pass_high_water_mark = NULL, "
+                "cursor = NULL, page_index = NULL, updated_at = now()", (app_id,))
+        mydb.commit()
+
+    message = f"Ressincronização completa solicitada para os aplicativos {apps_ids}"
+    logger.info(message)
+
+
+def request_table_refresh(apps_ids: list):
+    """Flag apps so that their next pass rebuilds their tables in shadow tables and swaps them in.
+
+    Args:
+        apps_ids (list): List of tape apps IDs
+    """
+    with borrow_db() as mydb:
+        cursor = mydb.cursor()
+        ensure_sync_state_table(cursor)
+        for app_id in apps_ids:
+            request_refresh(cursor, app_id)
+            # Requested by hand, so not postponed by earlier failures
+            cursor.execute("UPDATE tape_sync.app_state SET refresh_after = NULL WHERE app_id = %s", (app_id,))
+        mydb.commit()
+
+    message = f"Reconstrução das tabelas solicitada para os aplicativos {apps_ids}"
+    logger.info(message)
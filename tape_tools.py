@@ -23,13 +23,14 @@ def handling_tape_error(err: TransportException):
         return "token_expired"
 
     if err.status['status'] == '400':
-        if json.loads(err.content)['error_detail'] == 'oauth.client.invalid_secret':
+        error_detail = _error_detail(err)
+        if error_detail == 'oauth.client.invalid_secret':
             message = "Secret inválido!"
-        elif json.loads(err.content)['error_detail'] == 'user.invalid.username':
+        elif error_detail == 'user.invalid.username':
             message = "Usuário inválido!"
-        elif json.loads(err.content)['error_detail'] == 'oauth.client.invalid_id':
+        elif error_detail == 'oauth.client.invalid_id':
             message = "ID do cliente inválido!"
-        elif json.loads(err.content)['error_detail'] == 'user.invalid.password':
+        elif error_detail == 'user.invalid.password':
             message = "Senha do cliente inválida!"
         else:
             message = f"Parâmetro nulo na query! Detalhes: {err}"
@@ -44,95 +45,17 @@ def handling_tape_error(err: TransportException):
     return "not_known_yet"
 
 
-def get_field_text_values(field: dict) -> str:
-    """De um campo da coluna, é retornado o seu valor
+def _error_detail(err: TransportException):
+    """`error_detail` of the body of an error response, if any."""
+    try:
+        return json.loads(err.content).get('error_detail')
+    except (ValueError, TypeError, AttributeError):
+        return None
 
-    Args:
-        field (Dict): O campo da tabela em questão
-
-    Returns:
-        str: Retorna o valor da coluna
-    """
-
-    final_values = "'"
-
-    if field['type'] == "contact":
-
-        for elem in field['values']:
-            value = elem.get('value', {}).get('name', '')
-            final_values += value.replace("'", "") + "|"
-
-        final_values = final_values[:-1]
-
-    elif field['type'] == "category":
-
-        for elem in field['values']:
-            value = elem.get('value', {}).get('text', '')
-            final_values += value.replace("'", "") + "|"
-
-        final_values = final_values[:-1]
-
-    elif field['type'] == "date":
-
-        values = field['values']
-        # `next` obtém o primeiro valor
-        value = next(iter(values), {}).get('start', '')
-
-        final_values += value
-
-    elif field['type'] == "calculation":
-
-        values = field['values']
-        # `next` obtém o primeiro valor
-        value = next(iter(values), {}).get('value_string', '')
-
-        final_values += value
-
-    elif field['type'] == "money":
-
-        values = field['values']
-
-        currency = next(iter(values), {}).get('currency', '')
-        value = next(iter(values), {}).get('value', '')
-
-        final_values += f'{currency} {value}'
-
-    elif field['type'] == "file":
-
-        values = field['values']
-
-        value = next(iter(values), {}).get('value', {}).get('link', '')
-
-        final_values += value
-
-    elif field['type'] == "embed":
-
-        values = field['values']
-
-        value = next(iter(values), {}).get('embed', {}).get('url', '')
-
-        final_values += value
-
-    elif field['type'] == "app":
-
-        # Nesse caso o campo é multivalorado, então concatena-se com um pipe '|'
-        for val in field['values']:
-
-            value = val.get('value', {}).get('title', '')
-            final_values += value.replace("'", "") + "|"
-
-        final_values = final_values[:-1]
-
-    else:
-
-        values = field['values']
-        value = next(iter(values), {}).get('value')
-
-        final_values += str(value).replace("'", "")
-
-    final_values += "'"
 
-    return final_values
+def is_stale_cursor_error(err: TransportException) -> bool:
+    """Tell whether Tape rejected a request, presumably because its pagination cursor expired."""
+    return err.status.get('status') in ('400', '404', '410')
 
 
 def _value_or_null(value):
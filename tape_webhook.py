@@ -0,0 +1,210 @@
+"""Receiver of Tape webhooks, applying record changes in micro-batches between the periodic syncs."""
+import hmac
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+from os import getenv
+import queue
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+from pytape.client import Client
+from pytape.transport import TransportException
+
+from psycopg2 import Error as dbError
+
+from get_mydb import borrow_db
+from metrics import RECORDS_DELETED, RECORDS_WRITTEN, WEBHOOK_EVENTS
+from tape_client import thread_client
+from tape_insert_records import write_page
+from tape_metadata_cache import metadata_cache
+from tape_sinks import open_sinks
+
+from logging_tools import log_records, logger
+
+
+# Port of the webhook receiver (unset or `0` disables it)
+WEBHOOK_PORT = int(getenv('WEBHOOK_PORT', '0'))
+# Token expected in the `token` query parameter of the webhook URL, required with `WEBHOOK_PORT`
+WEBHOOK_TOKEN = getenv('WEBHOOK_TOKEN', '')
+# Maximum number of events applied together, and seconds waited to gather them
+WEBHOOK_BATCH_SIZE = int(getenv('WEBHOOK_BATCH_SIZE', '500'))
+WEBHOOK_BATCH_SECONDS = float(getenv('WEBHOOK_BATCH_SECONDS', '2'))
+
+
+# Record events of the webhooks, and the change applied for each
+RECORD_EVENTS = {'record.created': 'upsert', 'record.updated': 'upsert', 'record.deleted': 'delete'}
+
+
+def _is_id(value) -> bool:
+    return (isinstance(value, int) and not isinstance(value, bool)) or (isinstance(value, str) and value.isdigit())
+
+
+def parse_event(payload: dict):
+    """Extract a record change from a webhook payload.
+
+    Payloads are `{"event": "record.created", "app_id": 123, "record": {...}}`,
+    with `record` as returned by the records API, or only its `record_id`
+    for `record.deleted`. Anything else is rejected, never guessed.
+
+    Returns:
+        tuple: `(action, app_id, record_id, record)`, with `action` either
+        `'upsert'` or `'delete'`, or `None` if the payload is not a record event
+    """
+    action = RECORD_EVENTS.get(payload.get('event'))
+    record = payload.get('record')
+    app_id = payload.get('app_id')
+    if action is None or not isinstance(record, dict) or not _is_id(app_id) or not _is_id(record.get('record_id')):
+        return None
+    if record.get('app_id') is not None and str(record['app_id']) != str(app_id):
+        return None
+
+    if action == 'delete':
+        return 'delete', int(app_id), str(record['record_id']), None
+    if not isinstance(record.get('fields'), list) or not record.get('created_on') or not record.get('last_modified_on'):
+        return None
+    return 'upsert', int(app_id), str(record['record_id']), record
+
+
+class WebhookBatcher:
+    """Queue of record changes, applied by a background thread in batches.
+
+    Changes are grouped by app and, for each record, only the last change of
+    a batch is applied. Records are written as in `insert_records`, so a
+    change older than the stored row is ignored.
+    """
+
+    def __init__(self, tape: Client, apps_ids: list, batch_size: int = WEBHOOK_BATCH_SIZE,
+                 batch_seconds: float = WEBHOOK_BATCH_SECONDS):
+        self.tape = tape
+        self.apps_ids = set(apps_ids)
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.events = queue.Queue()
+
+    def put(self, change: tuple):
+        self.events.put(change)
+
+    def run(self):
+        while True:
+            batch = [self.events.get()]
+            deadline = time.monotonic() + self.batch_seconds
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.events.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self.apply(batch)
+
+    def apply(self, batch: list):
+        changes_by_app = {}
+        for action, app_id, record_id, record in batch:
+            if app_id in self.apps_ids:
+                changes_by_app.setdefault(app_id, {})[record_id] = (action, record)
+
+        for app_id, changes in changes_by_app.items():
+            try:
+                self._apply_app(app_id, changes)
+            except TransportException as err:
+                logger.error(f"Erro no acesso ao Tape. {err}")
+            except Exception as err:
+                logger.exception(f"Erro inesperado no webhook do aplicativo {app_id}. {err}")
+
+    def _apply_app(self, app_id: int, changes: dict):
+        tape = thread_client(self.tape)
+        _, table_name = metadata_cache.get_table_name(tape, app_id)
+        converter = metadata_cache.get_record_converter(tape, app_id)
+        records = [record for action, record in changes.values() if action == 'upsert']
+        deleted = [record_id for record_id, (action, _) in changes.items() if action == 'delete']
+
+        with borrow_db() as mydb:
+            cursor = mydb.cursor()
+            if table_name not in metadata_cache.get_tables(cursor):
+                return
+            try:
+                written = write_page(cursor, table_name, converter, converter.convert_page(records))
+                if deleted:
+                    cursor.execute(f"DELETE FROM tape.{table_name} WHERE record_id = ANY(%s)", (deleted,))
+                    log_records('excluído', table_name, deleted)
+                mydb.commit()
+            except dbError as err:
+                # The next periodic sync catches up
+                mydb.rollback()
+                logger.error(f"Erro no acesso ao BD. {err}")
+                return
+
+        if deleted:
+            # Upserts reach the sinks with the next pass, deletions are never listed again
+            sinks = open_sinks(app_id, table_name, converter, full=False)
+            sinks.delete(deleted)
+            sinks.close(complete=True)
+
+        RECORDS_WRITTEN.inc(written, app_id=app_id)
+        RECORDS_DELETED.inc(len(deleted), app_id=app_id)
+        message = f"Webhook: {written} registros gravados e {len(deleted)} excluídos na tabela `{table_name}`"
+        logger.info(message)
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    batcher = None
+
+    def do_POST(self):
+        token = parse_qs(urlparse(self.path).query).get('token', [''])[0]
+        if not hmac.compare_digest(token.encode(), WEBHOOK_TOKEN.encode()):
+            self.send_response(403)
+            self.end_headers()
+            return
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'null')
+        except ValueError:
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        ignored = 0
+        for event in payload if isinstance(payload, list) else [payload]:
+            change = parse_event(event) if isinstance(event, dict) else None
+            WEBHOOK_EVENTS.inc(action=change[0] if change else 'ignored')
+            if change:
+                self.batcher.put(change)
+            else:
+                ignored += 1
+        if ignored:
+            logger.warning(f"Webhook: {ignored} eventos fora do formato esperado ignorados")
+        self.send_response(202)
+        self.end_headers()
+
+    def log_request(self, code='-', size='-'):
+        # The request line is left out, its query string holds the token
+        logger.debug(f"Webhook {self.address_string()}: {self.command} {urlparse(self.path).path} {code}")
+
+    def log_message(self, format, *args):
+        logger.debug(f"Webhook {self.address_string()}: {format % args}")
+
+
+def start_webhook_server(tape: Client, apps_ids: list, port: int = WEBHOOK_PORT):
+    """Receive Tape webhooks at `http://0.0.0.0:{port}/` and apply them from background threads.
+
+    Args:
+        tape (Client): tape client, for the apps metadata
+        apps_ids (list): List of tape apps IDs, events of other apps are ignored
+        port (int): Port of the receiver, `0` disables it
+
+    Raises:
+        ValueError: `WEBHOOK_TOKEN` is not set, any client could write the tables
+    """
+    if not port:
+        return None
+    if not WEBHOOK_TOKEN:
+        raise ValueError("WEBHOOK_PORT definido sem WEBHOOK_TOKEN")
+    batcher = WebhookBatcher(tape, apps_ids)
+    threading.Thread(target=batcher.run, name='webhook-batcher', daemon=True).start()
+
+    handler = type('WebhookHandler', (_WebhookHandler,), {'batcher': batcher})
+    server = ThreadingHTTPServer(('0.0.0.0', port), handler)
+    threading.Thread(target=server.serve_forever, name='webhook', daemon=True).start()
+    logger.info(f"Recebendo webhooks do Tape na porta {port}")
+    return server
@@ -0,0 +1,72 @@
+"""Parallel execution of the per-app synchronization steps."""
+from concurrent.futures import ThreadPoolExecutor
+from os import getenv
+import threading
+
+from pytape.client import Client
+from pytape.transport import TransportException
+
+from tape_client import thread_client
+from logging_tools import logger
+
+
+# Number of apps synchronized at the same time
+SYNC_WORKERS = int(getenv('SYNC_WORKERS', '1'))
+
+
+def run_for_apps(tape: Client, apps_ids: list, task, workers: int = SYNC_WORKERS) -> int:
+    """Run `task(tape, app_id)` for each app, in parallel when `workers > 1`.
+
+    Each worker thread uses its own Tape client. An unexpected error in one
+    app is logged and does not abort the others, it is reported as `3`. Once an app reports that
+    the tape API limit was reached, the apps not started yet are skipped.
+
+    Args:
+        tape (Client): tape client, used as is when running sequentially
+        apps_ids (list): List of tape apps IDs
+        task (callable): Per-app step returning the codes of the main loop
+        workers (int): Number of worker threads
+
+    Returns:
+        int: Code to handle the main loop. `0` if no errors,
+        `1` if the tape API limit is reached.
+        `2` encountered another error with tape,
+        `3` if some apps failed with an unexpected error (see `cycle_code`)
+    """
+    rate_limited = threading.Event()
+
+    def run(app_id):
+        if rate_limited.is_set():
+            return 1
+        try:
+            code = task(tape if workers <= 1 else thread_client(tape), app_id)
+        except TransportException as err:
+            logger.error(f"Erro no acesso ao Tape. {err}")
+            code = 1
+        except Exception as err:
+            logger.exception(f"Erro inesperado no aplicativo {app_id}. {err}")
+            return 3
+        if code == 1:
+            rate_limited.set()
+        return code
+
+    if workers <= 1:
+        codes = [run(app_id) for app_id in apps_ids]
+    else:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sync') as executor:
+            codes = list(executor.map(run, apps_ids))
+
+    return cycle_code(codes)
+
+
+def cycle_code(codes: list) -> int:
+    """Code of a step of the main loop from the codes of its apps.
+
+    The rate limit and tape errors make the whole cycle wait or retry. Apps
+    failing with an unexpected error are retried only in the next cycle, so
+    that one app failing on every attempt does not hold the others back.
+    """
+    for code in (1, 2, 3):
+        if code in codes:
+            return code
+    return 0
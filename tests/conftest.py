@@ -0,0 +1,7 @@
+"""Settings read by the modules of the service on import, and their location."""
+import os
+import sys
+
+os.environ.setdefault('TIMEZONE_OFFSET', '-3')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
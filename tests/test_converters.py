@@ -0,0 +1,93 @@
+import datetime
+from decimal import Decimal
+
+from copy_tools import copy_buffer, copy_encode
+from tape_converters import (FIELD_TYPES, TEXT, LinkedValue, RecordConverter, app_fields, compile_record_converter,
+                             content_hash, get_field_type)
+
+
+def field(external_id, field_type, field_id=None):
+    return {'field_id': field_id or external_id, 'external_id': external_id, 'type': field_type}
+
+
+def record(record_id, *fields, last_modified_on='2024-01-02 00:00:00'):
+    return {
+        'record_id': record_id,
+        'created_on': '2024-01-01 00:00:00',
+        'last_modified_on': last_modified_on,
+        'fields': [{'external_id': external_id, 'values': values} for external_id, values in fields],
+    }
+
+
+def test_registry_types():
+    assert get_field_type(field('amount', 'money')).sql_type == 'NUMERIC'
+    assert get_field_type(field('due', 'date')).format_type == 'timestamp without time zone'
+    assert get_field_type(field('tags', 'category')).format_type == 'text[]'
+    assert get_field_type(field('notes', 'single_text')) is TEXT
+    for field_type in ('number', 'progress', 'rating'):
+        assert FIELD_TYPES[field_type].sql_type == 'NUMERIC'
+
+
+def test_converters():
+    convert = {field_type: FIELD_TYPES[field_type].convert for field_type in FIELD_TYPES}
+    assert convert['number']([{'value': '12.50'}]) == Decimal('12.50')
+    assert convert['number']([{'value': 'n/a'}]) is None
+    assert convert['number']([]) is None
+    assert convert['money']([{'value': '10.5', 'currency': 'BRL'}]) == Decimal('10.5')
+    assert convert['money_currency']([{'value': '10.5', 'currency': 'BRL'}]) == 'BRL'
+    assert convert['date']([{'start': '2024-03-01 10:00:00'}]) == datetime.datetime(2024, 3, 1, 10)
+    assert convert['date']([{'start': '2024-03-01'}]) == datetime.datetime(2024, 3, 1)
+    assert convert['date']([{'start': '2024-03-01T10:00:00Z'}]) == datetime.datetime(2024, 3, 1, 10)
+    assert convert['date']([{'start': '2024-03-01T10:00:00.500-03:00'}]) == datetime.datetime(2024, 3, 1, 13, 0, 0, 500000)
+    assert convert['date']([{'start': 'soon'}]) is None
+    assert convert['date']([{'start': '31/12/2024'}]) is None
+    assert convert['calculation']([{'value_string': '42'}]) == '42'
+    assert convert['file']([{'value': {'link': 'https://files/a.pdf'}}]) == 'https://files/a.pdf'
+    assert convert['embed']([{'embed': {'url': 'https://example.com'}}]) == 'https://example.com'
+    assert TEXT.convert([{'value': 3}]) == '3'
+    assert TEXT.convert([]) is None
+
+
+def test_linked_values():
+    contacts = FIELD_TYPES['contact'].convert([{'value': {'name': 'Ana', 'user_id': 7}}, {'value': {'name': 'Bia'}}])
+    assert contacts == ['Ana', 'Bia']
+    assert [value.item_id for value in contacts] == ['7', None]
+    assert FIELD_TYPES['app'].convert([]) is None
+
+
+def test_money_currency_column():
+    fields = app_fields({'fields': [field('record_id', 'text'), field('amount', 'money', 11), field('name', 'text')]})
+    assert [item['external_id'] for item in fields] == ['amount', 'amount_currency', 'name']
+    assert fields[1]['field_id'] == '11_currency'
+
+    converter = RecordConverter(fields)
+    row = converter.convert(record(1, ('amount', [{'value': '9.90', 'currency': 'USD'}]), ('name', [{'value': 'x'}])))
+    assert row == ('1', '2024-01-01 00:00:00', '2024-01-02 00:00:00', Decimal('9.90'), 'USD', 'x')
+
+
+def test_record_converter():
+    converter = compile_record_converter({'fields': [field('name', 'text'), field('score', 'number')]})
+    assert converter.columns == ['record_id', 'created_on', 'last_modified_on', 'name', 'score']
+    row = converter.convert(record(5, ('score', [{'value': '1'}]), ('unknown', [{'value': 'x'}])))
+    assert row[0] == '5'
+    assert row[3:] == (None, Decimal('1'))
+    assert converter.subset(['score']).columns == ['record_id', 'created_on', 'last_modified_on', 'score']
+
+
+def test_copy_encode():
+    assert copy_encode(None) == '\\N'
+    assert copy_encode('a\tb\nc\\d') == 'a\\tb\\nc\\\\d'
+    assert copy_encode(Decimal('1.50')) == '1.50'
+    assert copy_encode(['a', None, 'say "hi"']) == '{"a",NULL,"say \\\\"hi\\\\""}'
+    assert copy_buffer([(1, None), ('x', ['y'])]).read() == '1\t\\N\nx\t{"y"}\n'
+
+
+def test_content_hash():
+    row = ('1', '2024-01-01', '2024-01-02', 'x', [LinkedValue('Ana', 1)])
+    touched = ('1', '2024-01-01', '2024-01-03', 'x', [LinkedValue('Ana', 1)])
+    relinked = ('1', '2024-01-01', '2024-01-02', 'x', [LinkedValue('Ana', 2)])
+    assert content_hash(row) == content_hash(touched)
+    assert content_hash(row) != content_hash(('1', '2024-01-01', '2024-01-02', 'y', [LinkedValue('Ana', 1)]))
+    assert content_hash(row) == content_hash(relinked)
+    assert content_hash(row, linked=True) == content_hash(touched, linked=True)
+    assert content_hash(row, linked=True) != content_hash(relinked, linked=True)
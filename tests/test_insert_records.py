@@ -0,0 +1,23 @@
+from tape_converters import content_hash
+from tape_insert_records import split_by_content
+
+
+def row(record_id, value, last_modified_on='2024-01-02 00:00:00'):
+    return (record_id, '2024-01-01 00:00:00', last_modified_on, value)
+
+
+def test_split_by_content():
+    unchanged, edited, new, skipped = row('1', 'a'), row('2', 'b'), row('3', 'c'), row('4', 'd')
+    changed = {
+        '1': (False, content_hash(row('1', 'a', '2023-12-31 00:00:00'))),
+        '2': (False, content_hash(row('2', 'old'))),
+        '3': (True, None),
+    }
+    upserts, touches, new_count = split_by_content([unchanged, edited, new, skipped], changed)
+    assert touches == [unchanged]
+    assert upserts == [(*edited, content_hash(edited)), (*new, content_hash(new))]
+    assert new_count == 1
+
+
+def test_split_by_content_without_changes():
+    assert split_by_content([row('1', 'a')], {}) == ([], [], 0)
@@ -0,0 +1,112 @@
+from contextlib import contextmanager
+
+import pytest
+
+import tape_leases
+from tape_leases import LeaseManager, app_lock, lock_ddl, lock_schema
+
+
+class Cursor:
+    """Records the statements, answering each query but the transaction locks with the next scripted result."""
+
+    def __init__(self, results=()):
+        self.statements = []
+        self.results = list(results)
+        self._result = None
+
+    def execute(self, query, params=None):
+        self.statements.append((query, params))
+        if query.startswith('SELECT') and 'pg_advisory_xact_lock' not in query:
+            self._result = self.results.pop(0) if self.results else [(None,)]
+
+    def fetchone(self):
+        return self._result[0]
+
+    def fetchall(self):
+        return self._result
+
+
+class Connection:
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.closed = False
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self):
+        return self._cursor
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+def lock_keys(cursor):
+    return [params for query, params in cursor.statements if 'pg_advisory_xact_lock' in query]
+
+
+def test_global_locks_never_collide_with_apps():
+    cursor = Cursor()
+    lock_schema(cursor)
+    # Apps 0 and 1 share the keys of the schema and claim locks, but not their namespace
+    lock_ddl(cursor, 0)
+    lock_ddl(cursor, 1)
+    schema, app_0, app_1 = lock_keys(cursor)
+    assert schema[1] == app_0[1] == 0
+    assert schema[0] != app_0[0]
+    assert app_0[0] == app_1[0]
+    assert tape_leases.GLOBAL_LOCK_NAMESPACE not in (tape_leases.APP_LOCK_NAMESPACE, tape_leases.DDL_LOCK_NAMESPACE)
+
+
+@pytest.mark.parametrize('acquired', [True, False])
+def test_app_lock(acquired):
+    cursor = Cursor([[(acquired,)]])
+    mydb = Connection(cursor)
+    with app_lock(mydb, cursor, 7) as locked:
+        assert locked is acquired
+    unlocks = [params for query, params in cursor.statements if query == tape_leases.UNLOCK_APP]
+    assert unlocks == ([(7,)] if acquired else [])
+    # Whatever was left uncommitted is rolled back before the lock is released
+    assert mydb.rollbacks == (1 if acquired else 0)
+
+
+def test_claim_takes_the_share_of_the_live_replicas(monkeypatch):
+    # 2 live replicas for 5 apps: a share of 3, of which 1 is owned and 2 are free
+    cursor = Cursor([[(2,)], [(10,)], [(30,), (40,)]])
+
+    @contextmanager
+    def borrow_db():
+        yield Connection(cursor)
+    monkeypatch.setattr(tape_leases, 'borrow_db', borrow_db)
+    monkeypatch.setattr(tape_leases, 'ensure_lease_tables', lambda cursor: None)
+    monkeypatch.setattr(LeaseManager, '_start_heartbeat', lambda self: None)
+
+    owned = LeaseManager('worker-1', ttl=60).claim([10, 20, 30, 40, 50])
+    assert owned == [10, 30, 40]
+    free = [params for query, params in cursor.statements if 'unnest(%s::bigint[]) AS apps' in query]
+    assert free == [([10, 20, 30, 40, 50], 2)]
+    assert [params for query, params in cursor.statements if query.startswith('INSERT INTO tape_sync.app_leases')] \
+        == [([10, 30, 40], 'worker-1')]
+
+
+def test_claim_releases_the_surplus(monkeypatch):
+    # 3 live replicas for 3 apps: a share of 1, so 1 of the 2 owned apps is released
+    cursor = Cursor([[(3,)], [(10,), (20,)], []])
+
+    @contextmanager
+    def borrow_db():
+        yield Connection(cursor)
+    monkeypatch.setattr(tape_leases, 'borrow_db', borrow_db)
+    monkeypatch.setattr(tape_leases, 'ensure_lease_tables', lambda cursor: None)
+    monkeypatch.setattr(LeaseManager, '_start_heartbeat', lambda self: None)
+
+    assert LeaseManager('worker-1', ttl=60).claim([10, 20, 30]) == [10]
+    deleted = [params for query, params in cursor.statements if query.startswith('DELETE FROM tape_sync.app_leases')]
+    assert deleted == [('worker-1', [20])]
+
+
+def test_all_apps_without_sharding(monkeypatch):
+    monkeypatch.setattr(tape_leases, 'SHARDING', False)
+    assert tape_leases.claim_apps([1, 2]) == [1, 2]
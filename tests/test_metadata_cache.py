@@ -0,0 +1,54 @@
+import threading
+
+from tape_metadata_cache import MetadataCache
+
+
+class Workspace:
+    def __init__(self, cache):
+        self.cache = cache
+        self.calls = 0
+        self.lock_free = None
+
+    def get_all_for_org(self):
+        self.calls += 1
+        # Another worker must be able to use the cache while the request is in flight
+        result = []
+
+        def use_cache():
+            result.append(self.cache._lock.acquire(timeout=1))
+            if result[0]:
+                self.cache._lock.release()
+        other = threading.Thread(target=use_cache)
+        other.start()
+        other.join()
+        self.lock_free = result == [True]
+        return {'workspaces': [{'workspace_id': 1, 'slug': 'sales-team'}]}
+
+
+class Tape:
+    def __init__(self, cache):
+        self.Workspace = Workspace(cache)
+
+
+def test_workspace_slugs_are_fetched_outside_the_lock():
+    cache = MetadataCache(ttl=60)
+    tape = Tape(cache)
+    assert cache.get_workspace_slugs(tape) == {1: 'sales-team'}
+    assert tape.Workspace.lock_free
+    assert cache.get_workspace_slugs(tape) == {1: 'sales-team'}
+    assert tape.Workspace.calls == 1
+
+
+def test_expired_and_invalidated_entries_are_fetched_again():
+    cache = MetadataCache(ttl=0)
+    tape = Tape(cache)
+    cache.get_workspace_slugs(tape)
+    cache.get_workspace_slugs(tape)
+    assert tape.Workspace.calls == 2
+
+    cache = MetadataCache(ttl=60)
+    tape = Tape(cache)
+    cache.get_workspace_slugs(tape)
+    cache.invalidate()
+    cache.get_workspace_slugs(tape)
+    assert tape.Workspace.calls == 2
@@ -0,0 +1,65 @@
+from tape_page_size import PageSizer, backoff_seconds, timed
+
+
+def sizer():
+    return PageSizer(minimum=50, maximum=400, target_seconds=10, grow_after=2)
+
+
+def test_starts_at_maximum_and_respects_limit():
+    pages = sizer()
+    assert pages.size(1) == 400
+    assert pages.size(1, limit=100) == 100
+
+
+def test_slow_page_halves():
+    pages = sizer()
+    pages.observe(1, 400, seconds=20, records=400)
+    assert pages.size(1) == 200
+    for _ in range(5):
+        pages.observe(1, pages.size(1), seconds=20, records=50)
+    assert pages.size(1) == 50
+
+
+def test_grows_after_fast_full_pages():
+    pages = sizer()
+    pages.failed(1, 400)
+    assert pages.size(1) == 200
+    pages.observe(1, 200, seconds=1, records=200)
+    assert pages.size(1) == 200
+    pages.observe(1, 200, seconds=1, records=200)
+    assert pages.size(1) == 300
+    # Short pages, e.g. the last one, do not count
+    pages.observe(1, 300, seconds=1, records=10)
+    pages.observe(1, 300, seconds=1, records=10)
+    assert pages.size(1) == 300
+
+
+def test_pass_starts_at_best_throughput():
+    pages = sizer()
+    pages.observe(1, 400, seconds=40, records=400)
+    pages.observe(1, 200, seconds=4, records=200)
+    assert pages.best(1) == 200
+    pages.start_pass(1)
+    assert pages.size(1) == 200
+    pages.failed(1, 200)
+    assert pages.best(1) == 400
+
+
+def test_persisted_page_size():
+    pages = sizer()
+    pages.start_pass(1, page_size=150)
+    assert pages.size(1) == 150
+    pages.start_pass(2, page_size=1000)
+    assert pages.size(2) == 400
+
+
+def test_apps_are_independent():
+    pages = sizer()
+    pages.failed(1, 400)
+    assert pages.size(1) == 200
+    assert pages.size(2) == 400
+
+
+def test_backoff_and_timed():
+    assert all(0 <= backoff_seconds(attempt, base=2) <= min(120, 2 * 2 ** attempt) for attempt in range(10))
+    assert timed(lambda value: value * 2)(3)[0] == 6
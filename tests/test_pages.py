@@ -0,0 +1,73 @@
+import threading
+import time
+
+import pytest
+
+from tape_pages import prefetch
+from tape_rate_limit import RateLimitScheduler, RequestCancelled
+
+
+def test_prefetch_keeps_order():
+    assert list(prefetch(iter(range(10)), depth=2)) == list(range(10))
+    assert list(prefetch(iter(range(3)), depth=0)) == [0, 1, 2]
+
+
+def test_prefetch_fetches_ahead():
+    fetched = []
+
+    def pages():
+        for index in range(5):
+            fetched.append(index)
+            yield index
+
+    iterator = prefetch(pages(), depth=2)
+    assert next(iterator) == 0
+    deadline = time.monotonic() + 2
+    while len(fetched) < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # The page being written, plus the two waiting in the queue
+    assert fetched == [0, 1, 2]
+    iterator.close()
+
+
+def test_prefetch_reraises_errors():
+    def pages():
+        yield 1
+        raise ValueError('fetch failed')
+
+    iterator = prefetch(pages(), depth=2)
+    assert next(iterator) == 1
+    with pytest.raises(ValueError):
+        next(iterator)
+
+
+def test_prefetch_stops_producer_waiting_for_the_rate_limit(monkeypatch):
+    paced = RateLimitScheduler(limit_per_hour=3600, burst=1, reserve=0)
+    monkeypatch.setattr('tape_pages.scheduler', paced)
+    threads = []
+
+    def pages():
+        threads.append(threading.current_thread())
+        yield 'page'
+        # The quota is exhausted until the next hour
+        paced.observe({'x-rate-limit-remaining': '0', 'x-rate-limit-reset': '3600'})
+        paced.acquire()
+        yield 'page'
+
+    iterator = prefetch(pages(), depth=1)
+    assert next(iterator) == 'page'
+    start = time.monotonic()
+    iterator.close()
+    assert time.monotonic() - start < 3
+    threads[0].join(timeout=3)
+    assert not threads[0].is_alive()
+
+
+def test_cancel_on_gives_the_turn_up():
+    paced = RateLimitScheduler(limit_per_hour=3600, burst=1, reserve=0)
+    paced.observe({'x-rate-limit-remaining': '0', 'x-rate-limit-reset': '3600'})
+    stop = threading.Event()
+    stop.set()
+    with paced.cancel_on(stop), pytest.raises(RequestCancelled):
+        paced.acquire(1)
+    assert paced._waiting == []
@@ -0,0 +1,147 @@
+import asyncio
+import datetime
+
+import pytest
+from pytape.transport import TransportException
+
+from tape_converters import RecordConverter
+from tape_pass import PassSteps, run_pass
+
+
+class DataError(Exception):
+    pgcode = '22007'
+
+
+class DriftError(Exception):
+    pgcode = '42703'
+
+
+def row(record_id, last_modified_on):
+    return (str(record_id), '2024-01-01 00:00:00', last_modified_on)
+
+
+class Steps(PassSteps):
+    """Pages served from memory, recording what a pass writes."""
+
+    def __init__(self, pages, state=None, fail_at=None, reject=None):
+        self.all_pages = pages
+        self.state = {'high_water_mark': None, 'pass_high_water_mark': None, 'cursor': None, 'page_index': None,
+                      'full_resync': False, 'backfill_columns': None, 'page_size': None, 'refresh': False,
+                      **(state or {})}
+        self.fail_at = fail_at
+        self.reject = reject
+        self.written = []
+        self.checkpoints = []
+        self.requested = []
+        self.finished = False
+        self.discarded = False
+
+    async def load_state(self):
+        return dict(self.state)
+
+    async def refresh(self):
+        return False
+
+    async def backfill(self, columns):
+        self.state['backfill_columns'] = None
+
+    async def pages(self, args, is_last):
+        self.requested.append(dict(args))
+        start = int(args.get('cursor', 0))
+        for index, rows in enumerate(self.all_pages[start:], start=start):
+            if self.fail_at is not None and index == self.fail_at:
+                self.fail_at = None
+                raise TransportException({'status': '410'}, 'cursor expired')
+            page = {'rows': rows, 'cursor': str(index + 1) if index + 1 < len(self.all_pages) else None}
+            yield page
+            if is_last(page):
+                return
+
+    async def write(self, rows, checkpoint):
+        if self.reject and any(item[0] == self.reject for item in rows):
+            raise DataError()
+        self.written.extend(rows)
+        self.checkpoints.append(checkpoint)
+        return len(rows)
+
+    async def skip_page(self, checkpoint):
+        self.checkpoints.append(checkpoint)
+
+    async def discard_checkpoint(self):
+        self.discarded = True
+        self.state.update(cursor=None, page_index=None, pass_high_water_mark=None)
+
+    async def finish(self, page_size):
+        self.finished = True
+
+    async def run_blocking(self, function, *args):
+        return function(*args)
+
+
+PAGES = [
+    [row(3, '2024-01-05 00:00:00'), row(2, '2024-01-04 00:00:00')],
+    [row(1, '2024-01-03 00:00:00'), row(0, '2024-01-01 00:00:00')],
+]
+
+
+def run(steps):
+    asyncio.run(run_pass(steps, 1, 'space__app', RecordConverter([])))
+
+
+def test_full_pass():
+    steps = Steps(PAGES)
+    run(steps)
+    assert [item[0] for item in steps.written] == ['3', '2', '1', '0']
+    assert steps.checkpoints == [('1', datetime.datetime(2024, 1, 5), 1), (None, datetime.datetime(2024, 1, 5), 2)]
+    assert steps.finished
+
+
+def test_incremental_pass_stops_at_high_water_mark():
+    steps = Steps(PAGES + [[row(9, '2023-01-01 00:00:00')]], {'high_water_mark': datetime.datetime(2024, 1, 3)})
+    run(steps)
+    assert [item[0] for item in steps.written] == ['3', '2', '1']
+    assert len(steps.checkpoints) == 2
+
+
+def test_resumes_from_checkpoint():
+    steps = Steps(PAGES, {'cursor': '1', 'page_index': 1, 'pass_high_water_mark': datetime.datetime(2024, 1, 5)})
+    run(steps)
+    assert steps.requested[0]['cursor'] == '1'
+    assert [item[0] for item in steps.written] == ['1', '0']
+    assert steps.checkpoints == [(None, datetime.datetime(2024, 1, 5), 2)]
+
+
+def test_restarts_when_the_checkpoint_is_rejected():
+    steps = Steps(PAGES, {'cursor': '1', 'page_index': 1}, fail_at=1)
+    run(steps)
+    assert steps.discarded
+    assert 'cursor' not in steps.requested[1]
+    assert [item[0] for item in steps.written] == ['3', '2', '1', '0']
+    assert steps.finished
+
+
+def test_error_after_a_committed_page_is_raised():
+    steps = Steps(PAGES, fail_at=1)
+    with pytest.raises(TransportException):
+        run(steps)
+    assert not steps.discarded and not steps.finished
+    assert steps.checkpoints == [('1', datetime.datetime(2024, 1, 5), 1)]
+
+
+def test_page_rejected_for_its_values_is_skipped():
+    steps = Steps(PAGES, reject='2')
+    run(steps)
+    assert [item[0] for item in steps.written] == ['1', '0']
+    assert [checkpoint[2] for checkpoint in steps.checkpoints] == [1, 2]
+    assert steps.finished
+
+
+def test_schema_drift_is_raised():
+    steps = Steps(PAGES)
+
+    async def write(rows, checkpoint):
+        raise DriftError()
+    steps.write = write
+    with pytest.raises(DriftError):
+        run(steps)
+    assert not steps.finished
@@ -0,0 +1,86 @@
+import datetime
+import threading
+import time
+
+import pytest
+
+from tape_rate_limit import RateLimitScheduler
+
+
+class Clock:
+    """`time.time` and `time.monotonic` of `tape_rate_limit`, moved by hand."""
+
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr('tape_rate_limit.time.time', clock)
+    monkeypatch.setattr('tape_rate_limit.time.monotonic', clock)
+    return clock
+
+
+def test_burst_then_paced(clock):
+    paced = RateLimitScheduler(limit_per_hour=3605, burst=2, reserve=5)
+    paced.acquire()
+    paced.acquire()
+    assert paced._delay() == pytest.approx(1)
+    clock.now += 1
+    paced._refill()
+    assert paced._delay() == 0
+
+
+def test_waits_for_the_reset_at_the_reserve(clock):
+    paced = RateLimitScheduler(limit_per_hour=1000, burst=50, reserve=5)
+    paced.observe({'x-rate-limit-remaining': '5', 'x-rate-limit-reset': '120'})
+    assert paced._delay() == pytest.approx(120)
+    assert paced.seconds_until_reset() == pytest.approx(120)
+    # An epoch timestamp is accepted as well
+    paced.observe({'x-rate-limit-reset': str(clock.now + 30)})
+    assert paced._delay() == pytest.approx(30)
+
+
+def test_quota_expires_after_the_reset(clock):
+    paced = RateLimitScheduler(limit_per_hour=1000, burst=50, reserve=5)
+    paced.observe({'x-rate-limit-remaining': '0', 'x-rate-limit-reset': '60'})
+    clock.now += 61
+    assert paced.seconds_until_reset() == 0
+    assert paced.remaining is None and paced.reset_at is None
+    assert paced.seconds_until_reset() == 3600
+    paced.acquire()
+
+
+def test_new_quota_without_reset_is_not_expired_by_the_old_one(clock):
+    paced = RateLimitScheduler(limit_per_hour=1000, burst=50, reserve=5)
+    paced.observe({'x-rate-limit-remaining': '100', 'x-rate-limit-reset': '60'})
+    clock.now += 61
+    paced.observe({'x-rate-limit-remaining': '3'})
+    assert paced.remaining == 3
+    assert paced.reset_at == clock.now + 3600
+    paced._refill()
+    assert paced._delay() == pytest.approx(3600)
+
+
+def test_apps_furthest_behind_go_first():
+    paced = RateLimitScheduler(limit_per_hour=3600, burst=1, reserve=0)
+    paced.set_priority(1, None)
+    paced.set_priority(2, datetime.datetime(2024, 1, 1))
+    paced.acquire()
+    served = []
+
+    def request(app_id):
+        paced.acquire(app_id)
+        served.append(app_id)
+    threads = [threading.Thread(target=request, args=(app_id,)) for app_id in (2, 1)]
+    threads[0].start()
+    time.sleep(0.1)
+    threads[1].start()
+    for thread in threads:
+        thread.join(timeout=10)
+    # App 1 was never synchronized, so it is served first although it asked last
+    assert served == [1, 2]
@@ -0,0 +1,78 @@
+from array import array
+from hashlib import md5
+
+from tape_reconcile import _delete_stale_records, _hash
+
+BUCKETS = 1024
+
+
+def sql_hash(record_id: str, buckets: int = BUCKETS):
+    """Bucket and digest as `_BUCKET_SQL` and `_DIGEST_SQL` compute them from the hex MD5."""
+    hexdigest = md5(record_id.encode()).hexdigest()
+    bucket = (int(hexdigest[28:30], 16) * 256 + int(hexdigest[30:32], 16)) % buckets
+    # `('x' || substr(..., 1, 16))::bit(64)::bigint` reads the bits as a two's complement integer
+    digest = int(hexdigest[:16], 16)
+    return bucket, digest - 2 ** 64 if digest >= 2 ** 63 else digest
+
+
+def listing(record_ids):
+    summaries, digests = {}, {}
+    for record_id in record_ids:
+        bucket, digest = _hash(record_id, BUCKETS)
+        digests.setdefault(bucket, array('q')).append(digest)
+        count, total = summaries.get(bucket, (0, 0))
+        summaries[bucket] = (count + 1, total + digest)
+    return summaries, digests
+
+
+class Cursor:
+    """Table of record IDs answering the statements of `_delete_stale_records` as PostgreSQL would."""
+
+    def __init__(self, record_ids):
+        self.record_ids = list(record_ids)
+        self.deleted = []
+        self._result = []
+
+    def execute(self, query, params):
+        if query.startswith('DELETE'):
+            self.deleted.extend(params[0])
+        elif 'GROUP BY bucket' in query:
+            groups = {}
+            for record_id in self.record_ids:
+                bucket, digest = sql_hash(record_id, params[0])
+                count, total = groups.get(bucket, (0, 0))
+                groups[bucket] = (count + 1, total + digest)
+            self._result = [(bucket, count, total) for bucket, (count, total) in groups.items()]
+        else:
+            buckets = set(params[1])
+            self._result = [(record_id,) for record_id in self.record_ids if sql_hash(record_id, params[0])[0] in buckets]
+
+    def fetchall(self):
+        return self._result
+
+
+def test_hash_matches_sql():
+    for record_id in map(str, range(1, 5000, 7)):
+        assert _hash(record_id, BUCKETS) == sql_hash(record_id)
+    assert any(_hash(str(record_id), BUCKETS)[1] < 0 for record_id in range(100))
+
+
+def test_deletes_unlisted_records():
+    stored = [str(record_id) for record_id in range(1, 2001)]
+    summaries, digests = listing(record_id for record_id in stored if record_id not in ('7', '1500'))
+    cursor = Cursor(stored)
+    assert sorted(_delete_stale_records(cursor, 'space__app', summaries, digests, '2024-01-01')) == ['1500', '7']
+    assert sorted(cursor.deleted) == ['1500', '7']
+
+
+def test_nothing_to_delete():
+    stored = [str(record_id) for record_id in range(1, 500)]
+    cursor = Cursor(stored)
+    assert _delete_stale_records(cursor, 'space__app', *listing(stored), '2024-01-01') == []
+    assert cursor.deleted == []
+
+
+def test_empty_listing_deletes_nothing():
+    cursor = Cursor(['1', '2'])
+    assert _delete_stale_records(cursor, 'space__app', {}, {}, None) == []
+    assert cursor.deleted == []
@@ -0,0 +1,78 @@
+import pytest
+
+from tape_refresh import DependentViewsError, _swap, shadow_name
+
+
+class Cursor:
+    """Catalogue of an app table and its shadow table, answering the queries of `_swap`."""
+
+    def __init__(self, views=(), grants=(), owner=('sync', True), shadow_children=()):
+        self.views = list(views)
+        self.grants = list(grants)
+        self.owner = owner
+        self.shadow_children = list(shadow_children)
+        self.statements = []
+        self._result = []
+
+    def execute(self, query, params=None):
+        self.statements.append(query)
+        if 'FROM pg_constraint WHERE conrelid' in query:
+            self._result = [('space__app__shadow_pkey',)]
+        elif query.startswith('SELECT to_regclass'):
+            self._result = [('tape.space__app',)]
+        elif 'k.contype' in query:
+            self._result = [(name,) for name in self.shadow_children] if params[0].endswith('__shadow') else []
+        elif 'pg_rewrite' in query:
+            self._result = [(view,) for view in self.views]
+        elif 'aclexplode' in query:
+            self._result = self.grants if params[0] == 'tape.space__app' else []
+        elif 'current_user' in query:
+            self._result = [self.owner]
+        else:
+            self._result = []
+
+    def fetchone(self):
+        return self._result[0] if self._result else None
+
+    def fetchall(self):
+        return self._result
+
+
+def test_shadow_name():
+    assert shadow_name('space__app') == 'space__app__shadow'
+
+
+def test_swap_keeps_privileges_and_owner():
+    cursor = Cursor(grants=[('reporting', 'SELECT', False), ('PUBLIC', 'SELECT', False), ('etl', 'UPDATE', True)],
+                    owner=('"Analytics"', False))
+    _swap(cursor, 1, 'space__app', 'space__app__shadow')
+    statements = cursor.statements
+    grants = [query for query in statements if query.startswith('GRANT')]
+    assert grants == ['GRANT SELECT ON tape.space__app__shadow TO reporting',
+                      'GRANT SELECT ON tape.space__app__shadow TO PUBLIC',
+                      'GRANT UPDATE ON tape.space__app__shadow TO etl WITH GRANT OPTION']
+    owner = statements.index('ALTER TABLE tape.space__app__shadow OWNER TO "Analytics"')
+    drop = statements.index('DROP TABLE tape.space__app')
+    assert statements.index(grants[-1]) < owner < drop
+    assert statements[-2:] == ['ALTER TABLE tape.space__app__shadow RENAME TO space__app',
+                               'ALTER INDEX tape."space__app__shadow_pkey" RENAME TO "space__app_pkey"']
+
+
+def test_swap_keeps_the_owner_when_it_is_the_service():
+    cursor = Cursor()
+    _swap(cursor, 1, 'space__app', 'space__app__shadow')
+    assert not any('OWNER TO' in query for query in cursor.statements)
+
+
+def test_swap_copies_access_to_child_tables():
+    cursor = Cursor(shadow_children=['space__app__shadow__tags'])
+    _swap(cursor, 1, 'space__app', 'space__app__shadow')
+    copies = [query for query in cursor.statements if 'current_user' in query]
+    assert len(copies) == 2
+
+
+def test_dependent_views_prevent_the_swap():
+    cursor = Cursor(views=['reports.sales'])
+    with pytest.raises(DependentViewsError, match='reports.sales'):
+        _swap(cursor, 1, 'space__app', 'space__app__shadow')
+    assert not any(query.startswith(('DROP', 'ALTER', 'GRANT')) for query in cursor.statements)
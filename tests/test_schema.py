@@ -0,0 +1,85 @@
+from tape_schema import conversion_expression, diff_schema, is_data_error, is_schema_drift
+
+
+def field(external_id, field_type, field_id):
+    return {'field_id': field_id, 'external_id': external_id, 'type': field_type}
+
+
+def live(**columns):
+    return {'record_id': (None, 'text'), 'created_on': (None, 'timestamp without time zone'),
+            'last_modified_on': (None, 'timestamp without time zone'), **columns}
+
+
+def test_unchanged():
+    app_info = {'fields': [field('name', 'text', 1), field('score', 'number', 2)]}
+    assert diff_schema(app_info, live(name=('1', 'text'), score=('2', 'numeric'))) == ([], [], [])
+
+
+def test_added():
+    app_info = {'fields': [field('name', 'text', 1), field('tags', 'category', 2)]}
+    added, renamed, retyped = diff_schema(app_info, live(name=('1', 'text')))
+    assert [item['external_id'] for item in added] == ['tags']
+    assert renamed == [] and retyped == []
+
+
+def test_renamed():
+    app_info = {'fields': [field('full_name', 'text', 1)]}
+    added, renamed, retyped = diff_schema(app_info, live(name=('1', 'text')))
+    assert added == [] and retyped == []
+    assert [(old, item['external_id']) for old, item in renamed] == [('name', 'full_name')]
+
+
+def test_renamed_over_current_column_is_added():
+    # The old column still belongs to a current field, so it cannot be renamed
+    app_info = {'fields': [field('name', 'text', 3), field('alias', 'text', 1)]}
+    added, renamed, _ = diff_schema(app_info, live(name=('1', 'text')))
+    assert [item['external_id'] for item in added] == ['alias']
+    assert renamed == []
+
+
+def test_retyped():
+    app_info = {'fields': [field('score', 'number', 1), field('due', 'date', 2)]}
+    added, renamed, retyped = diff_schema(app_info, live(score=('1', 'text'), due=('2', 'timestamp without time zone')))
+    assert added == [] and renamed == []
+    assert [(item['external_id'], column_type) for item, column_type in retyped] == [('score', 'text')]
+
+
+def test_renamed_and_retyped():
+    app_info = {'fields': [field('total', 'money', 1)]}
+    added, renamed, retyped = diff_schema(app_info, live(amount=('1', 'text')))
+    assert [item['external_id'] for item in added] == ['total_currency']
+    assert [(old, item['external_id']) for old, item in renamed] == [('amount', 'total')]
+    assert [(item['external_id'], column_type) for item, column_type in retyped] == [('total', 'text')]
+
+
+def test_conversion_expression():
+    assert conversion_expression('"score"', 'text', 'NUMERIC').endswith('::numeric')
+    assert 'NULLIF(btrim("score"), \'\')' in conversion_expression('"score"', 'text', 'NUMERIC')
+    assert conversion_expression('"due"', 'text', 'TIMESTAMP') == "NULLIF(NULLIF(btrim(\"due\"), ''), 'None')::timestamp"
+    assert conversion_expression('"tags"', 'text', 'TEXT[]') == "string_to_array(NULLIF(NULLIF(btrim(\"tags\"), ''), 'None'), '|')"
+    assert conversion_expression('"tags"', 'text[]', 'TEXT') == "array_to_string(\"tags\", '|')"
+    assert conversion_expression('"score"', 'numeric', 'TEXT') == '"score"::TEXT'
+
+
+class PsycopgError(Exception):
+    def __init__(self, pgcode):
+        super().__init__(pgcode)
+        self.pgcode = pgcode
+
+
+class AsyncpgError(Exception):
+    def __init__(self, sqlstate):
+        super().__init__(sqlstate)
+        self.sqlstate = sqlstate
+
+
+def test_error_classes():
+    for code in ('42P01', '42703', '42804'):
+        assert is_schema_drift(PsycopgError(code)) and is_schema_drift(AsyncpgError(code))
+        assert not is_data_error(PsycopgError(code))
+    for code in ('22007', '22P02', '23505'):
+        assert is_data_error(PsycopgError(code)) and is_data_error(AsyncpgError(code))
+        assert not is_schema_drift(PsycopgError(code))
+    # Lost connections and the like have no SQLSTATE
+    assert not is_schema_drift(PsycopgError(None)) and not is_data_error(PsycopgError(None))
+    assert not is_data_error(Exception())
@@ -0,0 +1,112 @@
+import datetime
+import os
+from decimal import Decimal
+
+import pytest
+
+from tape_converters import RecordConverter
+from tape_sinks import ParquetSink, SinkWriters, read_manifest
+
+pq = pytest.importorskip('pyarrow.parquet')
+
+FIELDS = [{'field_id': 1, 'external_id': 'score', 'type': 'number'},
+          {'field_id': 2, 'external_id': 'tags', 'type': 'category'}]
+
+
+def row(record_id, last_modified_on='2024-01-02 00:00:00', score='1.5'):
+    return (str(record_id), '2024-01-01 00:00:00', last_modified_on, Decimal(score), ['a', 'b'])
+
+
+def files(sink, table_name='space__app'):
+    return [item['path'] for item in read_manifest(os.path.join(sink.directory, table_name))['files']]
+
+
+def read(sink, path, table_name='space__app'):
+    return pq.read_table(os.path.join(sink.directory, table_name, path))
+
+
+@pytest.fixture
+def sink(tmp_path):
+    return ParquetSink(str(tmp_path), row_group_size=2)
+
+
+def test_full_pass(sink):
+    converter = RecordConverter(FIELDS)
+    assert sink.is_stale('space__app', converter)
+    writer = sink.open(1, 'space__app', converter, full=True)
+    writer.write([row(1), row(2), row(3)])
+    writer.close(complete=True)
+
+    manifest = read_manifest(os.path.join(sink.directory, 'space__app'))
+    assert not manifest['stale'] and manifest['app_id'] == 1
+    assert manifest['files'][0]['rows'] == 3 and manifest['files'][0]['full']
+    assert not sink.is_stale('space__app', converter)
+
+    table = read(sink, files(sink)[0])
+    assert table.column_names == ['record_id', 'created_on', 'last_modified_on', 'score', 'tags', '_deleted']
+    assert pq.ParquetFile(os.path.join(sink.directory, 'space__app', files(sink)[0])).num_row_groups == 2
+    first = table.to_pylist()[0]
+    assert first['record_id'] == '1'
+    assert first['last_modified_on'] == datetime.datetime(2024, 1, 2)
+    assert first['score'] == Decimal('1.5')
+    assert first['tags'] == ['a', 'b'] and first['_deleted'] is False
+    assert not [name for name in os.listdir(os.path.dirname(os.path.join(sink.directory, 'space__app', files(sink)[0])))
+                if name.endswith('.tmp')]
+
+
+def test_incremental_passes_follow_the_full_one(sink):
+    converter = RecordConverter(FIELDS)
+    for full in (True, False, True, False):
+        writer = sink.open(1, 'space__app', converter, full=full)
+        writer.write([row(1)])
+        writer.close(complete=True)
+    # The second full pass superseded the files before it
+    manifest = read_manifest(os.path.join(sink.directory, 'space__app'))
+    assert [item['full'] for item in manifest['files']] == [True, False]
+
+
+def test_deletions(sink):
+    converter = RecordConverter(FIELDS)
+    writer = sink.open(1, 'space__app', converter, full=False)
+    writer.delete(['7'])
+    writer.close(complete=True)
+
+    manifest = read_manifest(os.path.join(sink.directory, 'space__app'))
+    assert manifest['files'][0]['deleted'] == 1 and manifest['files'][0]['rows'] == 0
+    deleted = read(sink, files(sink)[0]).to_pylist()
+    assert [(item['record_id'], item['_deleted'], item['score']) for item in deleted] == [('7', True, None)]
+    # Only a full pass makes a new dataset current
+    assert manifest['stale']
+
+
+def test_interrupted_full_pass_stays_stale(sink):
+    converter = RecordConverter(FIELDS)
+    writer = sink.open(1, 'space__app', converter, full=True)
+    writer.write([row(1)])
+    writer.close(complete=False)
+    assert sink.is_stale('space__app', converter)
+
+
+def test_new_schema_is_stale(sink):
+    writer = sink.open(1, 'space__app', RecordConverter(FIELDS), full=True)
+    writer.close(complete=True)
+    assert files(sink) == []
+    assert not sink.is_stale('space__app', RecordConverter(FIELDS))
+    assert sink.is_stale('space__app', RecordConverter(FIELDS + [{'field_id': 3, 'external_id': 'due', 'type': 'date'}]))
+
+
+def test_failed_write_is_abandoned(sink):
+    converter = RecordConverter(FIELDS)
+    writer = sink.open(1, 'space__app', converter, full=True)
+    writer.close(complete=True)
+
+    writers = SinkWriters([sink.open(1, 'space__app', converter, full=False)])
+    writers.write([row(1), row(2)])
+    # A value out of the NUMERIC range fails the row group
+    writers.write([row(3, score='1e40'), row(4)])
+    assert writers.writers == []
+    writers.close(complete=True)
+
+    assert sink.is_stale('space__app', converter)
+    dataset = os.path.join(sink.directory, 'space__app')
+    assert not [name for _, _, names in os.walk(dataset) for name in names if name.endswith('.tmp')]
@@ -0,0 +1,39 @@
+import io
+import json
+from decimal import Decimal
+
+import ijson
+
+from tape_converters import RecordConverter
+from tape_stream import PageBuilder
+
+
+def build(response: dict, converter: RecordConverter) -> dict:
+    builder = PageBuilder(converter)
+    for prefix, event, value in ijson.parse(io.BytesIO(json.dumps(response).encode())):
+        builder.feed(prefix, event, value)
+    return builder.page
+
+
+def test_page_builder():
+    converter = RecordConverter([{'field_id': 1, 'external_id': 'score', 'type': 'number'},
+                                 {'field_id': 2, 'external_id': 'tags', 'type': 'category'}])
+    records = [
+        {'record_id': 1, 'created_on': '2024-01-01', 'last_modified_on': '2024-01-02', 'fields': [
+            {'external_id': 'score', 'values': [{'value': 1.5}]},
+            {'external_id': 'tags', 'values': [{'value': {'text': 'a', 'id': 3}}, {'value': {'text': 'b', 'id': 4}}]},
+        ]},
+        {'record_id': 2, 'created_on': '2024-01-01', 'last_modified_on': '2024-01-03', 'fields': []},
+    ]
+    page = build({'total': 2, 'records': records, 'cursor': 'next'}, converter)
+
+    assert page['cursor'] == 'next'
+    assert page['total'] == 2
+    assert page['rows'] == [converter.convert(record) for record in records]
+    assert page['rows'][0][3] == Decimal('1.5')
+    assert [value.item_id for value in page['rows'][0][4]] == ['3', '4']
+
+
+def test_page_builder_last_page():
+    page = build({'total': 0, 'records': [], 'cursor': None}, RecordConverter([]))
+    assert page == {'rows': [], 'cursor': None, 'total': 0}
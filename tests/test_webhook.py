@@ -0,0 +1,28 @@
+from tape_webhook import parse_event
+
+
+def record(**extra):
+    return {'record_id': 10, 'created_on': '2024-01-01 00:00:00', 'last_modified_on': '2024-01-02 00:00:00',
+            'fields': [], **extra}
+
+
+def test_upsert():
+    payload = {'event': 'record.updated', 'app_id': 5, 'record': record(app_id=5)}
+    assert parse_event(payload) == ('upsert', 5, '10', payload['record'])
+    assert parse_event({'event': 'record.created', 'app_id': '5', 'record': record()})[:3] == ('upsert', 5, '10')
+
+
+def test_delete():
+    assert parse_event({'event': 'record.deleted', 'app_id': 5, 'record': {'record_id': '10'}}) == ('delete', 5, '10', None)
+
+
+def test_rejected():
+    assert parse_event({'event': 'app.updated', 'app_id': 5, 'record': record()}) is None
+    assert parse_event({'event': 'record.updated', 'record': record()}) is None
+    assert parse_event({'event': 'record.updated', 'app_id': True, 'record': record()}) is None
+    assert parse_event({'event': 'record.updated', 'app_id': 5, 'record': record(app_id=6)}) is None
+    assert parse_event({'event': 'record.deleted', 'app_id': 5, 'record_id': 10}) is None
+    assert parse_event({'event': 'record.deleted', 'app_id': 5, 'record': {'record_id': 'x'}}) is None
+    # An upsert needs the whole record
+    assert parse_event({'event': 'record.updated', 'app_id': 5, 'record': {'record_id': 10}}) is None
+    assert parse_event({'event': 'record.updated', 'app_id': 5, 'record': record(fields=None)}) is None
@@ -0,0 +1,65 @@
+"""Post sample Tape webhook payloads to a local receiver, to exercise `tape_webhook` without Tape.
+
+Example, with `WEBHOOK_PORT=8080` and the app 12345 in `TAPE_APPS_IDS`:
+
+    python webhook_stub.py --url 'http://localhost:8080/?token=...' --app-id 12345 \\
+        --fields title:single_text,amount:money,due:date --count 20 --delete 2
+
+Records get IDs from `--first-record-id` on, so running the stub again updates
+the same records. Fields whose `external_id` is not in the app are ignored by
+the receiver.
+"""
+import argparse
+import datetime
+import json
+import random
+import urllib.request
+
+from fake_tape import field_values
+from logging_tools import logger
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', default='http://localhost:8080/', help='URL of the receiver, with `?token=`')
+    parser.add_argument('--app-id', type=int, required=True, help='tape app ID of the records')
+    parser.add_argument('--fields', default='title:single_text',
+                        help='comma separated `external_id:type` of the fields of the records')
+    parser.add_argument('--count', type=int, default=10, help='records created or updated')
+    parser.add_argument('--delete', type=int, default=0, help='records deleted, among the first ones')
+    parser.add_argument('--first-record-id', type=int, default=10 ** 9, help='ID of the first record')
+    parser.add_argument('--batch', type=int, default=5, help='events per request')
+    return parser.parse_args()
+
+
+def _record(args, record_id: int, fields: list, now: str) -> dict:
+    rng = random.Random()
+    return {
+        'record_id': record_id,
+        'app_id': args.app_id,
+        'created_on': now,
+        'last_modified_on': now,
+        'fields': [{'external_id': external_id, 'type': field_type, 'values': field_values(field_type, rng)}
+                   for external_id, field_type in fields],
+    }
+
+
+def main():
+    args = _parse_args()
+    fields = [tuple(field.split(':', 1)) for field in args.fields.split(',')]
+    now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    events = [{'event': 'record.updated', 'app_id': args.app_id, 'record': _record(args, record_id, fields, now)}
+              for record_id in range(args.first_record_id, args.first_record_id + args.count)]
+    events += [{'event': 'record.deleted', 'app_id': args.app_id, 'record': {'record_id': record_id}}
+               for record_id in range(args.first_record_id, args.first_record_id + args.delete)]
+
+    for start in range(0, len(events), args.batch):
+        body = json.dumps(events[start:start + args.batch]).encode()
+        request = urllib.request.Request(args.url, data=body, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request) as response:
+            logger.info(f"{len(events[start:start + args.batch])} eventos enviados: HTTP {response.status}")
+
+
+if __name__ == '__main__':
+    main()